@@ -1,6 +1,3 @@
-import dropbox
-
-
 def dropbox_authorize(app_key):
     """Guides the user through the Dropbox authorization process.
 
@@ -10,6 +7,8 @@ def dropbox_authorize(app_key):
     Returns:
         The refresh token obtained after successful authorization.
     """
+    import dropbox  # slow to import, and only needed on the first run
+
     flow = dropbox.DropboxOAuth2FlowNoRedirect(
         app_key, use_pkce=True, token_access_type="offline"
     )
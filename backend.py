@@ -0,0 +1,56 @@
+from typing import Any, List, Optional, Protocol, Tuple
+
+from dropbox.files import (
+    CommitInfo,
+    DeleteArg,
+    FileMetadata,
+    RelocationPath,
+    UploadSessionCursor,
+    UploadSessionFinishArg,
+)
+
+
+class Backend(Protocol):
+    """The Dropbox API calls Drupebox makes, as provided by dropbox.Dropbox or a fake."""
+
+    def files_list_folder(self, path: str, recursive: bool = False) -> Any: ...
+
+    def files_list_folder_continue(self, cursor: str) -> Any: ...
+
+    def files_list_folder_get_latest_cursor(
+        self, path: str, recursive: bool = False
+    ) -> Any: ...
+
+    def files_list_folder_longpoll(self, cursor: str, timeout: int = 30) -> Any: ...
+
+    def files_upload_session_start(self, f: bytes, close: bool = False) -> Any: ...
+
+    def files_upload_session_append_v2(
+        self, f: bytes, cursor: UploadSessionCursor, close: bool = False
+    ) -> None: ...
+
+    def files_upload_session_finish(
+        self, f: bytes, cursor: UploadSessionCursor, commit: CommitInfo
+    ) -> FileMetadata: ...
+
+    def files_upload_session_finish_batch(
+        self, entries: List[UploadSessionFinishArg]
+    ) -> Any: ...
+
+    def files_upload_session_finish_batch_check(self, async_job_id: str) -> Any: ...
+
+    def files_create_folder_batch(self, paths: List[str]) -> Any: ...
+
+    def files_create_folder_batch_check(self, async_job_id: str) -> Any: ...
+
+    def files_delete_batch(self, entries: List[DeleteArg]) -> Any: ...
+
+    def files_delete_batch_check(self, async_job_id: str) -> Any: ...
+
+    def files_move_batch_v2(self, entries: List[RelocationPath]) -> Any: ...
+
+    def files_move_batch_check_v2(self, async_job_id: str) -> Any: ...
+
+    def files_download(
+        self, path: str, rev: Optional[str] = None, extra_headers: Optional[dict] = None
+    ) -> Tuple[FileMetadata, Any]: ...
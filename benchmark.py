@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, NamedTuple
+
+_REPO_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+
+class _Shape(NamedTuple):
+    """How a synthetic tree is laid out."""
+
+    files_per_folder: int
+    subfolders_per_folder: int
+    file_size: int
+    default_entries: int
+
+
+_SHAPES = {
+    "wide": _Shape(1000, 100, 100, 10000),  # many tiny files, in few large folders
+    "deep": _Shape(8, 2, 100, 10000),  # many tiny files, in many nested folders
+    "huge": _Shape(4, 1, 32 * 1024 * 1024, 8),  # a few huge files
+}
+
+_PHASES = ("first_sync", "noop_resync", "churn_sync")
+_CHURN = 0.01  # fraction of files changed before the last sync
+
+
+def _generate_tree(root: str, shape: _Shape, entries: int) -> List[str]:
+    """Creates a synthetic tree of files and folders.
+
+    Returns:
+        The paths of the files created.
+    """
+    file_paths = []
+    folders = [root]
+    made = 0
+    while folders and made < entries:
+        folder = folders.pop(0)
+        for i in range(shape.files_per_folder):
+            if made == entries:
+                break
+            file_path = os.path.join(folder, "file" + str(i))
+            _write_file(file_path, shape.file_size, made)
+            file_paths.append(file_path)
+            made += 1
+        for i in range(shape.subfolders_per_folder):
+            if made == entries:
+                break
+            subfolder = os.path.join(folder, "folder" + str(i))
+            os.mkdir(subfolder)
+            folders.append(subfolder)
+            made += 1
+    return file_paths
+
+
+def _write_file(file_path: str, size: int, seed: int):
+    """Writes a file of a given size, with contents that differ for each seed."""
+    with open(file_path, "wb") as f:
+        if size >= 1024 * 1024:
+            f.write(os.urandom(size))
+        else:
+            f.write((str(seed) + "\n").encode().ljust(size, b"."))
+
+
+def _write_config(home: str, dropbox_folder: str, client_requests_per_second: float):
+    """Writes a Drupebox config file, so that nothing is asked for."""
+    os.makedirs(os.path.join(home, ".config"))
+    with open(os.path.join(home, ".config", "drupebox"), "w") as f:
+        f.write("refresh_token = benchmark\n")
+        f.write("dropbox_local_path = " + dropbox_folder + "/\n")
+        f.write("excluded_folder_paths = ,\n")
+        f.write("requests_per_second = " + str(client_requests_per_second) + "\n")
+
+
+def _run_worker(args, work_folder: str) -> dict:
+    """Runs one sync in a fresh process, as a cron run would be.
+
+    Returns:
+        The wall time of the run, the time spent in each of its phases, and the
+        requests it made.
+    """
+    env = dict(
+        os.environ,
+        HOME=os.path.join(work_folder, "home"),
+        DRUPEBOX_CACHE_FOLDER=os.path.join(work_folder, "cache"),
+    )
+    start = time.perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--worker",
+            work_folder,
+            "--latency",
+            str(args.latency),
+            "--requests-per-second",
+            str(args.requests_per_second),
+            "--write-contention",
+            str(args.write_contention),
+        ]
+        + (["--async-batch-jobs"] if args.async_batch_jobs else []),
+        env=env,
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    seconds = time.perf_counter() - start
+    with open(
+        os.path.join(work_folder, "cache", "drupebox_run_reports.jsonl"),
+        encoding="utf-8",
+    ) as f:
+        report = json.loads(f.readlines()[-1])
+    return {
+        "seconds": round(seconds, 3),
+        "phases": report["phases"],
+        "api_calls": {
+            endpoint: stats["count"] for endpoint, stats in report["api_calls"].items()
+        },
+    }
+
+
+def _worker(args):
+    """Syncs the benchmark's folder with its fake Dropbox."""
+    sys.path.insert(0, _REPO_FOLDER)
+    import db_utils
+    import drupebox
+    from fake_dropbox import FakeDropbox
+
+    fake = FakeDropbox(
+        os.path.join(args.worker, "remote"),
+        args.latency,
+        args.requests_per_second,
+        args.async_batch_jobs,
+        args.write_contention,
+    )
+    db_utils.use_client(fake)
+    try:
+        drupebox.sync_all()
+    finally:
+        fake.save()
+
+
+def _churn(args, work_folder: str, file_paths: List[str], shape: _Shape):
+    """Changes a fraction of the files, half locally and half on the fake Dropbox."""
+    sys.path.insert(0, _REPO_FOLDER)
+    from fake_dropbox import FakeDropbox
+
+    changed = random.Random(0).sample(file_paths, max(2, int(len(file_paths) * _CHURN)))
+    dropbox_folder = os.path.join(work_folder, "home", "Dropbox")
+    fake = FakeDropbox(os.path.join(work_folder, "remote"))
+    for i, file_path in enumerate(changed):
+        if i % 2 == 0:
+            # saved the way most editors do, by replacing the file
+            _write_file(file_path + ".tmp", shape.file_size, -1 - i)
+            os.replace(file_path + ".tmp", file_path)
+        else:
+            with open(file_path, "rb") as f:
+                data = f.read()
+            fake.put_file(
+                "/" + os.path.relpath(file_path, dropbox_folder).replace(os.sep, "/"),
+                b"changed " + data,
+            )
+    fake.save()
+
+
+def _benchmark(args, name: str, shape: _Shape, entries: int) -> Dict[str, dict]:
+    """Times a first sync, a sync with nothing to do, and a sync after some churn."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="drupebox-benchmark-") as work_folder:
+        dropbox_folder = os.path.join(work_folder, "home", "Dropbox")
+        os.makedirs(dropbox_folder)
+        os.makedirs(os.path.join(work_folder, "cache"))
+        _write_config(
+            os.path.join(work_folder, "home"),
+            dropbox_folder,
+            args.client_requests_per_second,
+        )
+        print(name + ": generating " + str(entries) + " entries", flush=True)
+        file_paths = _generate_tree(dropbox_folder, shape, entries)
+        for phase in _PHASES:
+            if phase == "churn_sync":
+                _churn(args, work_folder, file_paths, shape)
+            results[phase] = _run_worker(args, work_folder)
+            print(
+                name + ": " + phase + " " + str(results[phase]["seconds"]) + "s",
+                flush=True,
+            )
+    return results
+
+
+def _git_commit() -> str:
+    """Gets the commit being benchmarked, if in a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=_REPO_FOLDER,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _compare(results: Dict[str, dict], baseline: dict, tolerance: float) -> bool:
+    """Prints how each timing compares with a baseline.
+
+    Returns:
+        If any timing is slower than the baseline by more than the tolerance.
+    """
+    print("compared with " + (baseline.get("commit") or "baseline") + ":")
+    regressed = False
+    for name, phases in results.items():
+        for phase, result in phases.items():
+            before = baseline["results"].get(name, {}).get(phase)
+            if before is None or before["seconds"] == 0:
+                continue
+            change = result["seconds"] / before["seconds"] - 1
+            slower = change > tolerance
+            regressed = regressed or slower
+            print(
+                f"  {name} {phase}: {before['seconds']}s -> {result['seconds']}s "
+                f"({change:+.0%}){' REGRESSION' if slower else ''}"
+            )
+    return regressed
+
+
+def main():
+    """Times syncing synthetic trees with a fake Dropbox, and compares with a baseline."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark Drupebox against a fake Dropbox, without a network."
+    )
+    parser.add_argument(
+        "--shape",
+        choices=sorted(_SHAPES),
+        action="append",
+        help="layout of the synthetic tree, repeat for more than one (default: all)",
+    )
+    parser.add_argument(
+        "--entries",
+        type=int,
+        help="files and folders in each tree (default: depends on the shape)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds the fake Dropbox takes to answer each request",
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        default=0.0,
+        help="requests the fake Dropbox allows before throttling (default: no limit)",
+    )
+    parser.add_argument(
+        "--async-batch-jobs",
+        action="store_true",
+        help="have the fake Dropbox's batch jobs still in progress when first checked",
+    )
+    parser.add_argument(
+        "--write-contention",
+        type=float,
+        default=0.0,
+        help="chance of each write in a batch failing from too many writes at once",
+    )
+    parser.add_argument(
+        "--client-requests-per-second",
+        type=float,
+        default=10000.0,
+        help="requests_per_second for Drupebox to pace its requests at",
+    )
+    parser.add_argument("--output", help="file to write the results to, as JSON")
+    parser.add_argument("--baseline", help="results from an earlier commit to compare")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="fraction slower than the baseline counted as a regression",
+    )
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        _worker(args)
+        return
+
+    results = {}
+    for name in args.shape or sorted(_SHAPES):
+        shape = _SHAPES[name]
+        entries = args.entries or shape.default_entries
+        results[name + "-" + str(entries)] = _benchmark(args, name, shape, entries)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"commit": _git_commit(), "results": results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if _compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
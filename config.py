@@ -1,11 +1,18 @@
+import itertools
 import os
+import re
+import time
 from functools import cache
+from typing import Dict, Optional, Tuple
 
 from configobj import ConfigObj
 
 import auth
 import log
+import metrics
 import paths
+import utils
+from exclusions import ExclusionMatcher
 
 APP_NAME = "drupebox"
 # To create new app key:
@@ -25,7 +32,26 @@ _REFRESH_TOKEN_KEY = "refresh_token"
 _DROPBOX_LOCAL_PATH_KEY = "dropbox_local_path"
 _MAX_FILE_SIZE_KEY = "max_file_size"
 _EXCLUDED_FOLDER_PATHS_KEY = "excluded_folder_paths"
+_EXCLUDED_PATTERNS_KEY = "excluded_patterns"
 _REALLY_DELETE_LOCAL_FILES_KEY = "really_delete_local_files"
+_TRANSFER_CONCURRENCY_KEY = "transfer_concurrency"
+_UPLOAD_CHUNK_SIZE_KEY = "upload_chunk_size"
+_DAEMON_DEBOUNCE_SECONDS_KEY = "daemon_debounce_seconds"
+_DAEMON_FULL_SYNC_INTERVAL_KEY = "daemon_full_sync_interval"
+_REQUESTS_PER_SECOND_KEY = "requests_per_second"
+_MAX_REQUEST_RETRIES_KEY = "max_request_retries"
+_REQUEST_TIMEOUT_KEY = "request_timeout"
+_FULL_SYNC_INTERVAL_KEY = "full_sync_interval"
+_CHECKPOINT_INTERVAL_KEY = "checkpoint_interval"
+_SYNC_ROOTS_KEY = "sync_roots"
+_TRANSFER_ORDER_KEY = "transfer_order"
+_UPLOAD_BYTES_PER_SECOND_KEY = "upload_bytes_per_second"
+_DOWNLOAD_BYTES_PER_SECOND_KEY = "download_bytes_per_second"
+_OFF_PEAK_HOURS_KEY = "off_peak_hours"
+_OFF_PEAK_MIN_SIZE_KEY = "off_peak_min_size"
+
+# the orders transfers can be made in, the first being the default
+TRANSFER_ORDERS = ("small_first", "newest_first", "walk")
 
 # default variables below
 # edit config file if you want to change after first run
@@ -33,10 +59,27 @@ _DEFAULTS = {
     _APP_KEY_KEY: _APP_KEY_DEFAULT,
     _MAX_FILE_SIZE_KEY: 100000000,
     _REALLY_DELETE_LOCAL_FILES_KEY: False,
+    _TRANSFER_CONCURRENCY_KEY: 4,
+    _UPLOAD_CHUNK_SIZE_KEY: 8388608,
+    _DAEMON_DEBOUNCE_SECONDS_KEY: 2.0,
+    _DAEMON_FULL_SYNC_INTERVAL_KEY: 21600,
+    _REQUESTS_PER_SECOND_KEY: 20.0,
+    _MAX_REQUEST_RETRIES_KEY: 6,
+    _REQUEST_TIMEOUT_KEY: 100.0,
+    _FULL_SYNC_INTERVAL_KEY: 21600,
+    _CHECKPOINT_INTERVAL_KEY: 60,
+    _TRANSFER_ORDER_KEY: TRANSFER_ORDERS[0],
+    _UPLOAD_BYTES_PER_SECOND_KEY: 0,
+    _DOWNLOAD_BYTES_PER_SECOND_KEY: 0,
+    # hours of the day, local time, such as "1-6" for 1am until 6am
+    _OFF_PEAK_HOURS_KEY: "",
+    _OFF_PEAK_MIN_SIZE_KEY: 50000000,
     _EXCLUDED_FOLDER_PATHS_KEY: [
         "/home/pi/SUPER_SECRET_LOCATION_1/",
         "/home/pi/SUPER SECRET LOCATION 2/",
     ],
+    # gitignore-style globs, such as "*.tmp" for any name or "/photos/raw" from the top
+    _EXCLUDED_PATTERNS_KEY: [],
 }
 
 
@@ -71,7 +114,10 @@ def _initialize_config_file(config_tmp: ConfigObj):
             config_tmp[_APP_KEY_KEY]
         )
         made_changes = True
-    if _DROPBOX_LOCAL_PATH_KEY not in config_tmp:
+    # not needed if several sync roots each have a local folder of their own
+    if _DROPBOX_LOCAL_PATH_KEY not in config_tmp and not config_tmp.get(
+        _SYNC_ROOTS_KEY
+    ):
         config_tmp[_DROPBOX_LOCAL_PATH_KEY] = _determine_dropbox_folder_location()
         made_changes = True
 
@@ -84,18 +130,53 @@ def _initialize_config_file(config_tmp: ConfigObj):
         _REALLY_DELETE_LOCAL_FILES_KEY
     )
     config_tmp[_MAX_FILE_SIZE_KEY] = int(config_tmp[_MAX_FILE_SIZE_KEY])
+    config_tmp[_EXCLUDED_PATTERNS_KEY] = config_tmp.as_list(_EXCLUDED_PATTERNS_KEY)
+    config_tmp[_TRANSFER_CONCURRENCY_KEY] = int(config_tmp[_TRANSFER_CONCURRENCY_KEY])
+    config_tmp[_UPLOAD_CHUNK_SIZE_KEY] = int(config_tmp[_UPLOAD_CHUNK_SIZE_KEY])
+    config_tmp[_DAEMON_DEBOUNCE_SECONDS_KEY] = float(
+        config_tmp[_DAEMON_DEBOUNCE_SECONDS_KEY]
+    )
+    config_tmp[_DAEMON_FULL_SYNC_INTERVAL_KEY] = int(
+        config_tmp[_DAEMON_FULL_SYNC_INTERVAL_KEY]
+    )
+    config_tmp[_REQUESTS_PER_SECOND_KEY] = float(config_tmp[_REQUESTS_PER_SECOND_KEY])
+    config_tmp[_MAX_REQUEST_RETRIES_KEY] = int(config_tmp[_MAX_REQUEST_RETRIES_KEY])
+    config_tmp[_REQUEST_TIMEOUT_KEY] = float(config_tmp[_REQUEST_TIMEOUT_KEY])
+    config_tmp[_FULL_SYNC_INTERVAL_KEY] = int(config_tmp[_FULL_SYNC_INTERVAL_KEY])
+    config_tmp[_CHECKPOINT_INTERVAL_KEY] = int(config_tmp[_CHECKPOINT_INTERVAL_KEY])
+    config_tmp[_UPLOAD_BYTES_PER_SECOND_KEY] = int(
+        config_tmp[_UPLOAD_BYTES_PER_SECOND_KEY]
+    )
+    config_tmp[_DOWNLOAD_BYTES_PER_SECOND_KEY] = int(
+        config_tmp[_DOWNLOAD_BYTES_PER_SECOND_KEY]
+    )
+    config_tmp[_OFF_PEAK_MIN_SIZE_KEY] = int(config_tmp[_OFF_PEAK_MIN_SIZE_KEY])
+    for pattern in config_tmp[_EXCLUDED_PATTERNS_KEY]:
+        if pattern.startswith("!"):
+            raise ValueError(
+                "excluded_patterns cannot re-include files with a leading !, "
+                "write \\! for a name starting with !: " + pattern
+            )
+    if config_tmp[_TRANSFER_ORDER_KEY] not in TRANSFER_ORDERS:
+        raise ValueError(
+            "transfer_order can only be one of "
+            + ", ".join(TRANSFER_ORDERS)
+            + ": "
+            + config_tmp[_TRANSFER_ORDER_KEY]
+        )
 
 
 def _sanitize_config(config_tmp: ConfigObj):
     """Sanitizes configuration values, such as paths."""
     made_changes = False
     # format dropbox local path with forward slashes on all platforms and end with forward slash to ensure prefix-free
-    original_dropbox_path = config_tmp[_DROPBOX_LOCAL_PATH_KEY]
-    sanitized_dropbox_path = paths.add_trailing_slash(original_dropbox_path)
-    if original_dropbox_path != sanitized_dropbox_path:
-        config_tmp[_DROPBOX_LOCAL_PATH_KEY] = sanitized_dropbox_path
-        log.note("Sanitized dropbox path")
-        made_changes = True
+    original_dropbox_path = config_tmp.get(_DROPBOX_LOCAL_PATH_KEY)
+    if original_dropbox_path is not None:  # not set for only several sync roots
+        sanitized_dropbox_path = paths.add_trailing_slash(original_dropbox_path)
+        if original_dropbox_path != sanitized_dropbox_path:
+            config_tmp[_DROPBOX_LOCAL_PATH_KEY] = sanitized_dropbox_path
+            log.note("Sanitized dropbox path")
+            made_changes = True
 
     # format excluded paths with forward slashes on all platforms and end with forward slash to ensure prefix-free
     original_excluded_paths = config_tmp.get(_EXCLUDED_FOLDER_PATHS_KEY, [])
@@ -111,6 +192,65 @@ def _sanitize_config(config_tmp: ConfigObj):
         config_tmp.write()
 
 
+def _read_sync_roots(config_tmp: ConfigObj) -> Dict[str, Tuple[str, str]]:
+    """Reads the sync roots, each a local folder and the Dropbox folder it is synced with, by name.
+
+    Raises:
+        ValueError: If a sync root is not given as two paths, or overlaps another.
+    """
+    sync_roots = {}
+    for name, value in config_tmp.get(_SYNC_ROOTS_KEY, {}).items():
+        # the name is part of the sync root's cache folder name
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+            raise ValueError(
+                "Sync root name can only have letters, digits, _ and -: " + name
+            )
+        if isinstance(value, str) or len(value) != 2:
+            raise ValueError(
+                "Sync root " + name + " needs a local path and a Dropbox path, "
+                "separated by a comma"
+            )
+        local_path, remote_path = value
+        sync_roots[name] = (
+            paths.add_trailing_slash(local_path),
+            paths.dbfmt(paths.unix_slash(remote_path)),
+        )
+    for (name, (local_path, remote_path)), (
+        other_name,
+        (other_local_path, other_remote_path),
+    ) in itertools.combinations(sync_roots.items(), 2):
+        # each file has to be synced by only one of them
+        if (
+            local_path.startswith(other_local_path)
+            or other_local_path.startswith(local_path)
+            or (remote_path.lower() + "/").startswith(other_remote_path.lower() + "/")
+            or (other_remote_path.lower() + "/").startswith(remote_path.lower() + "/")
+        ):
+            raise ValueError("Sync roots " + name + " and " + other_name + " overlap")
+    return sync_roots
+
+
+def _read_off_peak_hours(config_tmp: ConfigObj) -> Optional[Tuple[int, int]]:
+    """Reads the hours of the day large transfers are made in, or None if they can be made at any time.
+
+    Raises:
+        ValueError: If the hours are not given as two different whole hours, such as "1-6".
+    """
+    value = config_tmp[_OFF_PEAK_HOURS_KEY].strip()
+    if value == "":
+        return None
+    match = re.fullmatch(r"(\d+)\s*-\s*(\d+)", value)
+    if match is None or int(match[1]) > 24 or int(match[2]) > 24:
+        raise ValueError("off_peak_hours needs two hours, such as 1-6: " + value)
+    start, end = int(match[1]), int(match[2])
+    # "6-6" could mean no hours or all of them, and "24-0" is no hours either way
+    if start % 24 == end % 24 and (start, end) != (0, 24):
+        raise ValueError(
+            "off_peak_hours needs two different hours, or 0-24 for all day: " + value
+        )
+    return start, end
+
+
 def _get_config_real() -> ConfigObj:
     """Loads the configuration from the file, initializes, and sanitizes it."""
     config_dir = paths.join(paths.home, ".config")
@@ -143,17 +283,9 @@ def ok_to_delete_files() -> bool:
     return ok_to_delete
 
 
-def _is_excluded_folder(local_folder_path: str) -> bool:
-    """Checks if a folder is in the exclusion list."""
-    # forward slash at end of path ensures prefix-free matching
-    local_folder_path_with_slash = paths.add_trailing_slash(local_folder_path)
-    return any(
-        local_folder_path_with_slash.startswith(excluded_path)
-        for excluded_path in excluded_folder_paths_set
-    )
-
-
-_IGNORED_FILENAME_PREFIXES = (".fuse_hidden",)
+# files named with TEMP_FILE_PREFIX are Drupebox's own, such as partial downloads
+TEMP_FILE_PREFIX = ".drupebox-"
+_IGNORED_FILENAME_PREFIXES = (".fuse_hidden", TEMP_FILE_PREFIX)
 _IGNORED_FILENAME_SUFFIXES = (".pyc", "__pycache__", ".git")
 _IGNORED_FILENAMES = {
     ".DS_Store",
@@ -165,36 +297,116 @@ _IGNORED_FILENAMES = {
 
 def skip(local_file_path: str) -> bool:
     """Checks if a file should be skipped based on its name or path."""
-    local_file_name = paths.get_file_name(local_file_path)
-    should_skip = (
-        local_file_name.startswith(_IGNORED_FILENAME_PREFIXES)
-        or local_file_name.endswith(_IGNORED_FILENAME_SUFFIXES)
-        or local_file_name in _IGNORED_FILENAMES
-        or _is_excluded_folder(local_file_path)
-    )
+    should_skip = exclusions.excludes(local_file_path)
+    if should_skip:
+        log.fyi_ignore(local_file_path)
+        metrics.count(metrics.FILES_SKIPPED)
+    return should_skip
+
+
+def skip_entry(local_file_path: str) -> bool:
+    """Checks if a file should be skipped, given that the folder containing it is not."""
+    # excluded folders are pruned whole, so what is inside them is never checked
+    should_skip = exclusions.excludes_entry(local_file_path)
     if should_skip:
         log.fyi_ignore(local_file_path)
+        metrics.count(metrics.FILES_SKIPPED)
     return should_skip
 
 
+def _create_exclusions(config_tmp: ConfigObj, local_path: str) -> ExclusionMatcher:
+    """Compiles the rules for which files in a local folder are not synced."""
+    return ExclusionMatcher(
+        local_path,
+        _IGNORED_FILENAMES,
+        _IGNORED_FILENAME_PREFIXES,
+        _IGNORED_FILENAME_SUFFIXES,
+        config_tmp[_EXCLUDED_FOLDER_PATHS_KEY],
+        config_tmp[_EXCLUDED_PATTERNS_KEY],
+    )
+
+
+def planning_config() -> Dict[str, object]:
+    """Gets the settings, other than the exclusions, that decide what a sync does with the files it finds."""
+    return {
+        key: _config[key]
+        for key in (_MAX_FILE_SIZE_KEY, _REALLY_DELETE_LOCAL_FILES_KEY)
+    }
+
+
 def file_size_ok(local_file_path: str) -> bool:
     """Checks if a file's size is within the configured limit."""
     return os.path.getsize(local_file_path) < _config[_MAX_FILE_SIZE_KEY]
 
 
+def large_transfers_allowed() -> bool:
+    """Checks if a large transfer can be made now, given the off-peak hours, if any."""
+    return off_peak_hours is None or utils.within_hours(off_peak_hours, time.time())
+
+
 def get_remote_file_path(local_file_path: str) -> str:
     """Converts a local file path to a remote Dropbox path."""
-    return paths.dbfmt(local_file_path.removeprefix(dropbox_local_path))
+    return remote_root_path + paths.dbfmt(
+        local_file_path.removeprefix(dropbox_local_path)
+    )
 
 
 def get_local_file_path(remote_file_path: str) -> str:
     """Converts a remote Dropbox path to a local file path."""
-    return paths.join(dropbox_local_path, remote_file_path)
+    # same as paths.join, given the local path always ends with a slash,
+    # but cheap enough to call for every file in a sync
+    return dropbox_local_path + remote_file_path[len(remote_root_path) :].lstrip("/")
 
 
 _config = _get_config()
 
-dropbox_local_path = _config[_DROPBOX_LOCAL_PATH_KEY]
+# local folders synced with their own Dropbox folders, by name, in place of
+# dropbox_local_path, each by a worker process of its own
+sync_roots = _read_sync_roots(_config)
+# the sync root synced by this process, or "" if not one of several
+sync_root_name = paths.sync_root_name
+if sync_root_name != "":
+    dropbox_local_path, remote_root_path = sync_roots[sync_root_name]
+else:
+    # only not set if the process just starts those of several sync roots
+    dropbox_local_path = _config.get(_DROPBOX_LOCAL_PATH_KEY, "")
+    remote_root_path = ""  # the app folder itself
+# the processes of several sync roots each get an even share of the rate limits
+_process_share = len(sync_roots) if sync_root_name != "" else 1
 excluded_folder_paths_set = set(_config[_EXCLUDED_FOLDER_PATHS_KEY])
+# compiled once, as every local and remote item is checked against them
+exclusions = _create_exclusions(_config, dropbox_local_path)
 app_key = _config[_APP_KEY_KEY]
 refresh_token = _config[_REFRESH_TOKEN_KEY]
+# most transfers at once, shared between the processes of several sync roots
+transfer_concurrency = max(1, _config[_TRANSFER_CONCURRENCY_KEY])
+# files larger than one chunk are uploaded in chunks through an upload session
+upload_chunk_size = _config[_UPLOAD_CHUNK_SIZE_KEY]
+# in daemon mode, wait for changes to stop arriving for this long before syncing them
+daemon_debounce_seconds = _config[_DAEMON_DEBOUNCE_SECONDS_KEY]
+# in daemon mode, also sync everything this often in case a change was missed
+daemon_full_sync_interval = _config[_DAEMON_FULL_SYNC_INTERVAL_KEY]
+# most requests made to Dropbox per second, on average, split evenly between the
+# processes of several sync roots
+requests_per_second = max(0.1, _config[_REQUESTS_PER_SECOND_KEY]) / _process_share
+# times to retry a request that failed from a Dropbox server error, before giving up
+max_request_retries = _config[_MAX_REQUEST_RETRIES_KEY]
+# seconds to wait for Dropbox to respond to a request, other than a longpoll
+request_timeout = _config[_REQUEST_TIMEOUT_KEY]
+# a run still syncs everything this often, even what is in folders found
+# unchanged, to retry anything that could not be synced before
+full_sync_interval = _config[_FULL_SYNC_INTERVAL_KEY]
+# while transfers run, store the progress made this often, in seconds, so a run
+# that is stopped part way carries on from there
+checkpoint_interval = max(1, _config[_CHECKPOINT_INTERVAL_KEY])
+# transfers are made in this order, one of TRANSFER_ORDERS, rather than in the
+# order the folders are walked, so that a large file does not hold up small ones
+transfer_order = _config[_TRANSFER_ORDER_KEY]
+# most bytes sent and received per second by transfers, on average, or 0 for no
+# cap, split evenly between the processes of several sync roots
+upload_bytes_per_second = _config[_UPLOAD_BYTES_PER_SECOND_KEY] / _process_share
+download_bytes_per_second = _config[_DOWNLOAD_BYTES_PER_SECOND_KEY] / _process_share
+# files of at least off_peak_min_size bytes are only transferred in these hours of
+# the day, if set, and are left for a later run at other times
+off_peak_hours = _read_off_peak_hours(_config)
+off_peak_min_size = _config[_OFF_PEAK_MIN_SIZE_KEY]
@@ -0,0 +1,43 @@
+import hashlib
+
+# https://www.dropbox.com/developers/reference/content-hash
+_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def local_content_hash(local_file_path: str) -> str:
+    """Computes the Dropbox content hash of a local file."""
+    # sha256 of the concatenated sha256 digests of each 4 MiB block
+    block_hashes = hashlib.sha256()
+    with open(local_file_path, "rb") as f:
+        while block := f.read(_BLOCK_SIZE):
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+
+class ContentHasher:
+    """Computes the Dropbox content hash of data that arrives in pieces."""
+
+    def __init__(self):
+        self._block_hashes = hashlib.sha256()
+        self._block = hashlib.sha256()
+        self._block_filled = 0
+
+    def update(self, data: bytes):
+        """Adds the next piece of data."""
+        view = memoryview(data)
+        while view:
+            piece = view[: _BLOCK_SIZE - self._block_filled]
+            self._block.update(piece)
+            self._block_filled += len(piece)
+            view = view[len(piece) :]
+            if self._block_filled == _BLOCK_SIZE:
+                self._block_hashes.update(self._block.digest())
+                self._block = hashlib.sha256()
+                self._block_filled = 0
+
+    def hexdigest(self) -> str:
+        """Gets the content hash of all the data added so far."""
+        block_hashes = self._block_hashes.copy()
+        if self._block_filled:
+            block_hashes.update(self._block.digest())
+        return block_hashes.hexdigest()
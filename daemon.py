@@ -0,0 +1,127 @@
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Set
+
+import config
+import db_utils as db
+import local_tree
+import log
+from local_watcher import LocalWatcher, create_watcher
+from utils import readable_time
+
+_LOCAL_CHANGE = "local"
+_REMOTE_CHANGE = "remote"
+_UNKNOWN_CHANGES = "unknown"  # changes were missed, so everything needs checking
+_FULL_SYNC_DUE = "full"  # time for the periodic sync of every folder
+
+_LONGPOLL_TIMEOUT = 480  # longest Dropbox will hold a longpoll open, in seconds
+_LONGPOLL_RETRY_DELAY = 60
+_MAX_DEBOUNCE_FACTOR = 10  # sync a continuous burst after this many debounce periods
+
+
+def _watch_remote(events: queue.Queue, remote_synced: threading.Event):
+    """Reports changes on Dropbox, waiting for each to be synced before polling again."""
+    while True:
+        try:
+            changed = db.wait_for_remote_changes(_LONGPOLL_TIMEOUT)
+        except Exception as err:
+            log.note("Could not check Dropbox for changes, retrying: " + str(err))
+            time.sleep(_LONGPOLL_RETRY_DELAY)
+            continue
+        if changed:
+            remote_synced.clear()
+            events.put((_REMOTE_CHANGE, None))
+            # the cursor only moves on once the change is synced
+            remote_synced.wait()
+
+
+def _collect_burst(events: queue.Queue, first_event: tuple) -> List[tuple]:
+    """Collects events until they stop arriving, so a burst of writes is synced once."""
+    burst = [first_event]
+    deadline = time.time() + config.daemon_debounce_seconds * _MAX_DEBOUNCE_FACTOR
+    while time.time() < deadline:
+        try:
+            burst.append(events.get(timeout=config.daemon_debounce_seconds))
+        except queue.Empty:
+            break
+    return burst
+
+
+def _watch_all_folders(watcher: LocalWatcher):
+    """Watches the local Dropbox folder and every folder in it."""
+    watcher.watch(
+        [config.dropbox_local_path] + list(local_tree.get_snapshot().folder_paths())
+    )
+
+
+def run(
+    sync_all: Callable[..., None],
+    sync_changes: Callable[[Set[str], List[str]], None],
+):
+    """Keeps the local folder in sync, syncing only what changes as it changes.
+
+    Args:
+        sync_all: Syncs every local and remote file, skipping folders found
+            unchanged unless called with full=True.
+        sync_changes: Syncs only what is affected by the given changed local paths
+            and changed remote paths.
+    """
+    events: queue.Queue = queue.Queue()
+    remote_synced = threading.Event()
+
+    watcher = create_watcher(
+        lambda local_file_path: events.put((_LOCAL_CHANGE, local_file_path)),
+        lambda: events.put((_UNKNOWN_CHANGES, None)),
+    )
+    if watcher is not None:
+        # watch before the first sync, so that no change made during it is missed
+        _watch_all_folders(watcher)
+        watcher.start()
+    else:
+        log.note("Local changes will only be found by the periodic full sync")
+
+    print("Drupebox daemon started at", readable_time(time.time()))
+    sync_all()
+    last_full_sync = time.time()
+    threading.Thread(
+        target=_watch_remote, args=(events, remote_synced), daemon=True
+    ).start()
+
+    while True:
+        try:
+            first_event = events.get(
+                timeout=max(
+                    0.0, last_full_sync + config.daemon_full_sync_interval - time.time()
+                )
+            )
+        except queue.Empty:
+            first_event = (_FULL_SYNC_DUE, None)
+        burst = _collect_burst(events, first_event)
+
+        try:
+            changed_remote_paths: Optional[List[str]] = []
+            if any(kind != _LOCAL_CHANGE for kind, _ in burst):
+                changed_remote_paths = db.refresh_remote_index()
+            full = any(kind == _FULL_SYNC_DUE for kind, _ in burst)
+            if (
+                full
+                or changed_remote_paths is None
+                or any(kind == _UNKNOWN_CHANGES for kind, _ in burst)
+            ):
+                if full:
+                    last_full_sync = time.time()
+                local_tree.get_snapshot.cache_clear()
+                if watcher is not None:
+                    _watch_all_folders(watcher)
+                sync_all(full=full)
+            else:
+                sync_changes(
+                    {path for kind, path in burst if kind == _LOCAL_CHANGE},
+                    changed_remote_paths,
+                )
+        except Exception as err:
+            # keep running, the changes are picked up again by the next full sync
+            log.alert("Sync failed: " + repr(err))
+            last_full_sync = 0.0
+        remote_synced.set()
@@ -1,20 +1,34 @@
 import os
+import tempfile
+import threading
 import time
-from datetime import timezone
+from contextlib import closing
+from datetime import datetime, timezone
 from functools import cache
-from typing import List, Union, Dict
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import dropbox
-from dropbox.exceptions import ApiError
-from dropbox.files import FolderMetadata, FileMetadata
-from send2trash import send2trash
+from dropbox.exceptions import ApiError, BadInputError
+from dropbox.files import FileMetadata, DeletedMetadata, ListFolderResult
 
 import config
+import content_hash
+import download_parts
+import hash_cache
+import local_tree
 import log
+import metrics
 import paths
+import scheduler
 import state_cache
+import transfers
+import upload_sessions
 import utils
+from backend import Backend
 from config import get_remote_file_path, get_local_file_path
+from local_tree import LocalItem
+from remote_index import RemoteIndex, RemoteItem, to_remote_item
+from transfers import TransferResult, Transferred
 
 """
 Variables in the following formats
@@ -24,46 +38,510 @@ local_file_path -> posix format, no trailing slash
 local_folder_path -> posix format, no trailing slash
 """
 
-_db_client = dropbox.Dropbox(
-    app_key=config.app_key, oauth2_refresh_token=config.refresh_token
-)
+
+def _create_client() -> dropbox.Dropbox:
+    """Creates a Dropbox client, with a connection pool shared by all its requests."""
+    # a connection for each transfer worker, the main thread and the longpoll,
+    # so none has to be opened afresh, with a new TLS handshake, once the pool
+    # is warm; requests keeps connections alive between requests by default
+    session = dropbox.create_session(max_connections=config.transfer_concurrency + 2)
+    # retries are left to the scheduler, which paces every request together
+    return dropbox.Dropbox(
+        app_key=config.app_key,
+        oauth2_refresh_token=config.refresh_token,
+        max_retries_on_error=0,
+        max_retries_on_rate_limit=0,
+        session=session,
+        timeout=config.request_timeout,
+    )
+
+
+_db_client = scheduler.Scheduler(_create_client)
 
 
-def upload(local_file_path: str, remote_file_path: str):
-    """Uploads a local file to Dropbox."""
+def use_client(db_client: Backend):
+    """Replaces the Dropbox client, such as with a fake one for testing."""
+    global _db_client
+    _db_client = scheduler.Scheduler(lambda: db_client)
+
+
+def upload(
+    local_file_path: str,
+    remote_file_path: str,
+    remote_item: Optional[RemoteItem] = None,
+):
+    """Uploads a local file to Dropbox.
+
+    Args:
+        remote_item: The file it replaces on Dropbox, if any, for the upload to
+            be skipped if it has the same contents.
+    """
     if not config.file_size_ok(local_file_path):
         log.note("File above max size, ignoring: " + remote_file_path)
+        # checked again by the next sync, as max_file_size may be raised by then
+        _remote_index.mark_changed([remote_file_path])
+        return
+    if transfers.waits_for_off_peak(os.path.getsize(local_file_path)):
+        transfers.defer(remote_file_path)
         return
     print("upload", remote_file_path)
-    with open(local_file_path, "rb") as f:
-        remote_file = _db_client.files_upload(
-            f.read(),
+    transfers.queue(
+        _transfer,
+        remote_file_path,
+        _upload_real,
+        local_file_path,
+        remote_file_path,
+        remote_item,
+    )
+
+
+def _transfer(
+    remote_file_path: str, transfer: Callable[..., TransferResult], *args
+) -> TransferResult:
+    """Runs a transfer on the worker pool, recording its path as changed if it fails."""
+    try:
+        return transfer(*args)
+    except Exception:
+        # checked again by the next sync, rather than skipped with its folder
+        _remote_index.mark_changed([remote_file_path])
+        raise
+
+
+def _upload_real(
+    local_file_path: str, remote_file_path: str, remote_item: Optional[RemoteItem]
+) -> TransferResult:
+    """Uploads a local file to Dropbox, run on the transfer worker pool."""
+    # taken before the file is read, so an edit made while it is read or
+    # committed is not mistaken for the version uploaded
+    version = hash_cache.file_version(local_file_path)
+    if remote_item is not None and _only_time_differs(remote_item, local_file_path):
+        return remote_item, remote_file_path, version
+    if version.size > config.upload_chunk_size:
+        return (
+            to_remote_item(_upload_in_chunks(local_file_path, remote_file_path)),
             remote_file_path,
-            mute=True,
-            mode=dropbox.files.WriteMode("overwrite", None),
+            version,
+        )
+    # small files are sent in a closed upload session, and committed later
+    # together with the rest of the run's small files in one batch
+    with open(local_file_path, "rb") as f:
+        data = f.read()
+    _db_client.pace_upload(len(data))
+    session_id = _db_client.files_upload_session_start(data, close=True).session_id
+    metrics.count(metrics.BYTES_UPLOADED, len(data))
+    finish_arg = dropbox.files.UploadSessionFinishArg(
+        dropbox.files.UploadSessionCursor(session_id, len(data)),
+        _commit_info(remote_file_path, version.mtime_ns),
+    )
+    _queued_commits.append((finish_arg, version))
+    return None
+
+
+def _commit_info(remote_file_path: str, mtime_ns: int) -> dropbox.files.CommitInfo:
+    """Describes how an uploaded file is committed to Dropbox.
+
+    Args:
+        mtime_ns: The modified time of the version of the local file uploaded,
+            kept on Dropbox, so that an edit made before the upload is
+            committed is newer than the uploaded file, rather than older.
+    """
+    # Dropbox takes naive UTC times, to the second
+    client_modified = datetime.fromtimestamp(
+        mtime_ns // 1_000_000_000, timezone.utc
+    ).replace(tzinfo=None)
+    return dropbox.files.CommitInfo(
+        remote_file_path,
+        mode=dropbox.files.WriteMode("overwrite", None),
+        client_modified=client_modified,
+        mute=True,
+    )
+
+
+# each with the version of the local file uploaded; list.append is atomic, so
+# transfer workers can add to this without a lock
+_queued_commits: List[
+    Tuple[dropbox.files.UploadSessionFinishArg, hash_cache.FileVersion]
+] = []
+
+_UPLOAD_BATCH_SIZE = 1000  # most entries Dropbox accepts in one finish batch
+
+
+def _commit_queued_uploads() -> List[Transferred]:
+    """Commits the uploaded small files to Dropbox in batches."""
+    committed = []
+    # only those queued so far, as transfer workers may still be adding more
+    remaining = len(_queued_commits)
+    while remaining > 0:
+        batch = _queued_commits[: min(remaining, _UPLOAD_BATCH_SIZE)]
+        del _queued_commits[: len(batch)]
+        remaining -= len(batch)
+        log.fyi("Committing " + str(len(batch)) + " uploads to Dropbox")
+        results = _run_batch_job(
+            _db_client.files_upload_session_finish_batch,
+            _db_client.files_upload_session_finish_batch_check,
+            [finish_arg for finish_arg, _ in batch],
         )
-    _fix_local_time(remote_file, remote_file_path)
+        failed = []
+        for (finish_arg, version), result in zip(batch, results):
+            remote_file_path = finish_arg.commit.path
+            if result.is_success():
+                committed.append(
+                    (to_remote_item(result.get_success()), remote_file_path, version)
+                )
+            else:
+                log.alert("Failed to upload " + remote_file_path)
+                log.note(str(result.get_failure()))
+                failed.append(remote_file_path)
+        _remote_index.mark_changed(failed)
+    return committed
+
+
+_BATCH_JOB_POLL_INTERVAL = 0.5  # seconds, doubled on each check up to the maximum
+_BATCH_JOB_POLL_INTERVAL_MAX = 5
+
+
+def _wait_for_batch_job(launch, check_job):
+    """Waits for a Dropbox batch job to complete, polling if it is run asynchronously.
+
+    Returns:
+        The result of the job, or None if it failed from too many writes at once.
+    """
+    if launch.is_complete():
+        return launch.get_complete()
+    async_job_id = launch.get_async_job_id()
+    poll_interval = _BATCH_JOB_POLL_INTERVAL
+    while True:
+        time.sleep(poll_interval)
+        status = check_job(async_job_id)
+        if status.is_complete():
+            return status.get_complete()
+        if hasattr(status, "is_failed") and status.is_failed():
+            if scheduler.is_too_many_write_operations(status.get_failed()):
+                return None
+            raise RuntimeError("Dropbox batch job failed: " + str(status.get_failed()))
+        poll_interval = min(poll_interval * 2, _BATCH_JOB_POLL_INTERVAL_MAX)
+
+
+def _run_batch_job(start_job, check_job, batch: list) -> list:
+    """Runs a Dropbox batch job, retrying any entries that failed from too many writes at once.
+
+    Returns:
+        The result of each entry in the batch, in order.
+    """
+    results = [None] * len(batch)
+    pending = list(range(len(batch)))
+    attempt = 0
+    while pending:
+        job_result = _wait_for_batch_job(
+            start_job([batch[i] for i in pending]), check_job
+        )
+        if job_result is None:
+            throttled = pending
+        else:
+            throttled = []
+            for i, result in zip(pending, job_result.entries):
+                results[i] = result
+                if result.is_failure() and scheduler.is_too_many_write_operations(
+                    result.get_failure()
+                ):
+                    throttled.append(i)
+        if throttled:
+            _db_client.throttled(None, attempt)
+            attempt += 1
+        pending = throttled
+    return results
+
+
+def _upload_in_chunks(local_file_path: str, remote_file_path: str) -> FileMetadata:
+    """Uploads a large file through an upload session, resuming an interrupted one if possible."""
+    # only one chunk is held in memory at a time, and each committed offset is
+    # stored so that a run that is stopped part way through carries on from there
+    stat = os.stat(local_file_path)
+    chunk_size = config.upload_chunk_size
+    session = upload_sessions.resumable_session(
+        remote_file_path, stat.st_size, stat.st_mtime_ns
+    )
+    with open(local_file_path, "rb") as f:
+        if session is None:
+            chunk = f.read(chunk_size)
+            _db_client.pace_upload(len(chunk))
+            session_id = _db_client.files_upload_session_start(chunk).session_id
+            offset = f.tell()
+            metrics.count(metrics.BYTES_UPLOADED, offset)
+        else:
+            log.note("Resume interrupted upload of " + remote_file_path)
+            session_id, offset = session
+        while True:
+            upload_sessions.store_session(
+                remote_file_path, session_id, offset, stat.st_size, stat.st_mtime_ns
+            )
+            if transfers.waits_for_off_peak(stat.st_size):
+                raise transfers.Deferred(remote_file_path)  # resumed by a later run
+            f.seek(offset)
+            cursor = dropbox.files.UploadSessionCursor(session_id, offset)
+            try:
+                chunk = f.read(chunk_size)
+                _db_client.pace_upload(len(chunk))
+                if stat.st_size - offset <= chunk_size:
+                    remote_file = _db_client.files_upload_session_finish(
+                        chunk,
+                        cursor,
+                        _commit_info(remote_file_path, stat.st_mtime_ns),
+                    )
+                    metrics.count(metrics.BYTES_UPLOADED, len(chunk))
+                    break
+                _db_client.files_upload_session_append_v2(chunk, cursor)
+                metrics.count(metrics.BYTES_UPLOADED, len(chunk))
+                offset += chunk_size
+            except ApiError as err:
+                lookup_error = _upload_session_lookup_error(err)
+                if lookup_error is not None and lookup_error.is_incorrect_offset():
+                    offset = lookup_error.get_incorrect_offset().correct_offset
+                elif lookup_error is not None and session is not None:
+                    log.note("Could not resume upload, so start again")
+                    upload_sessions.discard_session(remote_file_path)
+                    return _upload_in_chunks(local_file_path, remote_file_path)
+                else:
+                    raise
+    upload_sessions.discard_session(remote_file_path)
+    return remote_file
+
+
+def _upload_session_lookup_error(err: ApiError):
+    """Gets the reason an upload session could not be continued, if that is why it failed."""
+    if hasattr(err.error, "is_lookup_failed") and err.error.is_lookup_failed():
+        return err.error.get_lookup_failed()  # from finishing a session
+    if hasattr(err.error, "is_incorrect_offset"):
+        return err.error  # from appending to a session
+    return None
 
 
 def create_remote_folder(remote_file_path: str):
-    """Creates a folder on Dropbox."""
+    """Queues a folder to be created on Dropbox."""
     print("create", remote_file_path)
-    _db_client.files_create_folder_v2(remote_file_path)
+    _queued_remote_folders.append(remote_file_path)
+
+
+_queued_remote_folders: List[str] = []
+
+_CREATE_FOLDER_BATCH_SIZE = 10000  # most entries Dropbox accepts in one batch
+
+
+def _create_queued_remote_folders():
+    """Creates the queued folders on Dropbox in batches."""
+    while _queued_remote_folders:
+        batch = _queued_remote_folders[:_CREATE_FOLDER_BATCH_SIZE]
+        del _queued_remote_folders[:_CREATE_FOLDER_BATCH_SIZE]
+        results = _run_batch_job(
+            _db_client.files_create_folder_batch,
+            _db_client.files_create_folder_batch_check,
+            batch,
+        )
+        failed = []
+        for remote_file_path, result in zip(batch, results):
+            if result.is_success():
+                continue
+            error = result.get_failure()
+            if (
+                error.is_path()
+                and error.get_path().is_conflict()
+                and error.get_path().get_conflict().is_folder()
+            ):
+                log.note("Tried to create folder on dropbox, but it was already there")
+            else:
+                log.note(
+                    "Unexpected Dropbox API error on create of "
+                    + remote_file_path
+                    + ": "
+                    + str(error)
+                )
+                failed.append(remote_file_path)
+        _remote_index.mark_changed(failed)
 
 
 def create_local_folder(remote_file_path: str, local_file_path: str):
     """Creates a local folder."""
     print("create", remote_file_path)
     os.makedirs(local_file_path, exist_ok=True)
+    local_tree.get_snapshot().add(local_file_path)
+
+
+def download_file(
+    remote_file_path: str,
+    local_file_path: str,
+    size: int,
+    remote_item: Optional[RemoteItem] = None,
+):
+    """Downloads a file from Dropbox to the local filesystem.
+
+    Args:
+        remote_item: The file to download, for the download to be skipped if the
+            local file already has the same contents.
+    """
+    if transfers.waits_for_off_peak(size):
+        transfers.defer(remote_file_path)
+        return
+    print("downld", remote_file_path)
+    transfers.queue(
+        _transfer,
+        remote_file_path,
+        _download_file_real,
+        remote_file_path,
+        local_file_path,
+        remote_item,
+    )
 
 
-def download_file(remote_file_path: str, local_file_path: str):
-    """Downloads a file from Dropbox to the local filesystem."""
-    print("downld", remote_file_path)
-    if paths.exists(local_file_path):
+def _download_file_real(
+    remote_file_path: str, local_file_path: str, remote_item: Optional[RemoteItem]
+) -> TransferResult:
+    """Downloads a file from Dropbox, run on the transfer worker pool."""
+    if remote_item is not None and os.path.isfile(local_file_path):
+        version = hash_cache.file_version(local_file_path)
+        if _only_time_differs(remote_item, local_file_path):
+            return remote_item, remote_file_path, version
+    # the download goes to a temporary file next to the local file, which
+    # replaces it in one step once complete, so the local file is never
+    # missing or partly written, and an interrupted download can carry on
+    part_file_path = paths.join(
+        paths.get_containing_db_folder_path(local_file_path),
+        config.TEMP_FILE_PREFIX + "part." + paths.get_file_name(local_file_path),
+    )
+    remote_file = _download_to_part_file(remote_file_path, part_file_path)
+    # moving the file into place keeps its version
+    version = hash_cache.file_version(part_file_path)
+    _replace_with_part_file(part_file_path, local_file_path)
+    return to_remote_item(remote_file), remote_file_path, version
+
+
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # most of a download held in memory at a time
+
+
+def _resumable_offset(part_file_path: str) -> int:
+    """Gets how much of an interrupted download can be kept, or 0 to start again."""
+    part = download_parts.resumable_part(part_file_path)
+    if part is None or not paths.exists(part_file_path):
+        return 0
+    offset = os.path.getsize(paths.system_slash(part_file_path))
+    return offset if offset < part[1] else 0
+
+
+def _download_to_part_file(remote_file_path: str, part_file_path: str) -> FileMetadata:
+    """Streams a file from Dropbox into a temporary file, resuming an interrupted download if possible."""
+    offset = _resumable_offset(part_file_path)
+    part = download_parts.resumable_part(part_file_path)
+    remote_file, response = _db_client.files_download(
+        remote_file_path,
+        extra_headers={"Range": "bytes=" + str(offset) + "-"} if offset else None,
+    )
+    with closing(response):
+        # the file may have changed on Dropbox since, making the partial file stale
+        stale = offset != 0 and (
+            response.status_code != 206 or part is None or remote_file.rev != part[0]
+        )
+        if not stale:
+            _stream_to_part_file(remote_file, response, part_file_path, offset)
+    if stale:
+        log.note("Could not resume download, so start again")
+        download_parts.discard_part(part_file_path)
+        return _download_to_part_file(remote_file_path, part_file_path)
+    return remote_file
+
+
+def _stream_to_part_file(
+    remote_file: FileMetadata, response, part_file_path: str, offset: int
+):
+    """Writes a download to a temporary file, checking it against the Dropbox content hash."""
+    if offset:
+        log.note("Resume interrupted download of " + remote_file.path_display)
+    else:
+        download_parts.store_part(part_file_path, remote_file.rev, remote_file.size)
+
+    hasher = content_hash.ContentHasher()
+    with open(paths.system_slash(part_file_path), "r+b" if offset else "wb") as f:
+        # only one chunk is held in memory at a time, however large the file
+        while offset and (chunk := f.read(_DOWNLOAD_CHUNK_SIZE)):
+            hasher.update(chunk)
+        for chunk in response.iter_content(_DOWNLOAD_CHUNK_SIZE):
+            f.write(chunk)
+            hasher.update(chunk)
+            metrics.count(metrics.BYTES_DOWNLOADED, len(chunk))
+            if transfers.waits_for_off_peak(remote_file.size):
+                # the part file is kept, for a later run to resume
+                raise transfers.Deferred(remote_file.path_display)
+            _db_client.pace_download(len(chunk))
+        f.flush()
+        os.fsync(f.fileno())
+
+    download_parts.discard_part(part_file_path)
+    if remote_file.content_hash and hasher.hexdigest() != remote_file.content_hash:
+        os.remove(paths.system_slash(part_file_path))
+        raise IOError(
+            "Downloaded file does not match Dropbox: " + remote_file.path_display
+        )
+
+
+def _replace_with_part_file(part_file_path: str, local_file_path: str):
+    """Moves a complete download into place, then sends the old version to the trash."""
+    if not paths.exists(local_file_path):
+        os.replace(
+            paths.system_slash(part_file_path), paths.system_slash(local_file_path)
+        )
+        return
+    # keep the old version under its own name, so it is trashed under that name
+    backup_folder_path = paths.unix_slash(
+        tempfile.mkdtemp(
+            prefix=config.TEMP_FILE_PREFIX + "old.",
+            dir=paths.system_slash(
+                paths.get_containing_db_folder_path(local_file_path)
+            ),
+        )
+    )
+    backup_file_path = paths.join(
+        backup_folder_path, paths.get_file_name(local_file_path)
+    )
+    try:
+        os.link(
+            paths.system_slash(local_file_path), paths.system_slash(backup_file_path)
+        )
+    except OSError:  # e.g. a folder, or hard links not supported
+        os.rmdir(paths.system_slash(backup_folder_path))
         _delete_real(local_file_path)
-    remote_file = _db_client.files_download_to_file(local_file_path, remote_file_path)
-    _fix_local_time(remote_file, remote_file_path)
+        os.replace(
+            paths.system_slash(part_file_path), paths.system_slash(local_file_path)
+        )
+        return
+    os.replace(paths.system_slash(part_file_path), paths.system_slash(local_file_path))
+    _delete_real(backup_file_path)
+    os.rmdir(paths.system_slash(backup_folder_path))
+
+
+def finish_transfers():
+    """Creates queued folders and finishes queued transfers, then fixes local modified times."""
+    first_error = None
+    while True:
+        _create_queued_remote_folders()
+        completed, error = transfers.take_finished(config.checkpoint_interval)
+        first_error = first_error or error
+        completed += _commit_queued_uploads()
+        # fix times on the main thread as transfers finish
+        for remote_item, remote_file_path, version in completed:
+            fix_local_time(remote_item, remote_file_path, version)
+        if not transfers.pending():
+            break
+        _store_checkpoint()
+    if first_error is not None:
+        raise first_error
+
+
+def _store_checkpoint():
+    """Stores the progress of a sync so far, for a run that is stopped part way to carry on from."""
+    # the finished transfers are committed and in the local tree, so a restarted
+    # run finds them in sync rather than transferring or hashing them again,
+    # while the cursor from the last complete sync is kept until this one completes
+    log.fyi("Storing sync progress")
+    local_tree.store_current_tree()
+    state_cache.store_checkpoint()
 
 
 def local_delete(local_file_path: str):
@@ -74,116 +552,373 @@ def local_delete(local_file_path: str):
     )  # as already checked this before calling local_delete
     log.alert(remote_file_path)
     _delete_real(local_file_path)
+    local_tree.get_snapshot().remove(local_file_path)
+
+
+# send2trash checks then creates the trash folder and names, so transfer workers take turns
+_trash_lock = threading.Lock()
 
 
 def _delete_real(local_file_path: str):
     """Sends a file to the system's trash."""
     # deleting local files uses send2trash so no files are permanently deleted locally
-    send2trash(paths.system_slash(local_file_path))
+    from send2trash import send2trash  # only imported if anything is deleted
 
+    with _trash_lock:
+        send2trash(paths.system_slash(local_file_path))
 
-def remote_delete(local_file_path: str):
-    """Deletes a file from Dropbox."""
-    remote_file_path = get_remote_file_path(local_file_path)
-    log.alert(remote_file_path)
-    try:
-        _db_client.files_delete_v2(remote_file_path)
-    except ApiError as err:
-        if (
-            hasattr(err.error, "is_path_lookup")
-            and err.error.is_path_lookup()
-            and hasattr(err.error.get_path_lookup(), "is_not_found")
-            and err.error.get_path_lookup().is_not_found()
-        ):
-            log.note("Tried to delete file on dropbox, but it was not there")
-        else:
-            log.note("Unexpected Dropbox API error on delete: " + str(err))
+
+_DELETE_BATCH_SIZE = 1000  # most entries Dropbox accepts in one batch
+
+
+def remote_delete(local_file_paths: List[str]):
+    """Deletes files from Dropbox."""
+    remote_file_paths = _top_most_paths(
+        [get_remote_file_path(local_file_path) for local_file_path in local_file_paths]
+    )
+    for remote_file_path in remote_file_paths:
+        log.alert(remote_file_path)
+    for i in range(0, len(remote_file_paths), _DELETE_BATCH_SIZE):
+        batch = remote_file_paths[i : i + _DELETE_BATCH_SIZE]
+        results = _run_batch_job(
+            _db_client.files_delete_batch,
+            _db_client.files_delete_batch_check,
+            [dropbox.files.DeleteArg(remote_file_path) for remote_file_path in batch],
+        )
+        _remote_index.apply_changes(
+            (remote_file_path, None)
+            for remote_file_path, result in zip(batch, results)
+            if result.is_success()
+        )
+        failed = []
+        for remote_file_path, result in zip(batch, results):
+            if result.is_success():
+                continue
+            error = result.get_failure()
+            if error.is_path_lookup() and error.get_path_lookup().is_not_found():
+                log.note("Tried to delete file on dropbox, but it was not there")
+            else:
+                log.note("Unexpected Dropbox API error on delete: " + str(error))
+                failed.append(remote_file_path)
+        _remote_index.mark_changed(failed)
+
+
+_MOVE_BATCH_SIZE = 1000  # most entries Dropbox accepts in one batch
+
+
+def remote_move(remote_moves: List[Tuple[str, str]]):
+    """Moves files on Dropbox, rather than uploading them again.
+
+    Args:
+        remote_moves: The old and new remote path of each item, in the order to
+            move them.
+    """
+    for old_remote_file_path, new_remote_file_path in remote_moves:
+        print("move", old_remote_file_path, "->", new_remote_file_path)
+    for i in range(0, len(remote_moves), _MOVE_BATCH_SIZE):
+        batch = remote_moves[i : i + _MOVE_BATCH_SIZE]
+        results = _run_batch_job(
+            _db_client.files_move_batch_v2,
+            _db_client.files_move_batch_check_v2,
+            [
+                dropbox.files.RelocationPath(old_remote_file_path, new_remote_file_path)
+                for old_remote_file_path, new_remote_file_path in batch
+            ],
+        )
+        failed: List[str] = []
+        for (old_remote_file_path, new_remote_file_path), result in zip(batch, results):
+            if result.is_success():
+                _remote_index.move(old_remote_file_path, new_remote_file_path)
+            else:
+                # left to upload again on the next run
+                log.note(
+                    "Unexpected Dropbox API error on move: " + str(result.get_failure())
+                )
+                failed.extend((old_remote_file_path, new_remote_file_path))
+        _remote_index.mark_changed(failed)
+
+
+def local_move(old_local_file_path: str, new_local_file_path: str):
+    """Moves a local file or folder, rather than downloading it again."""
+    print("move", old_local_file_path, "->", new_local_file_path)
+    os.makedirs(
+        paths.system_slash(new_local_file_path.rsplit("/", 1)[0]), exist_ok=True
+    )
+    os.rename(
+        paths.system_slash(old_local_file_path), paths.system_slash(new_local_file_path)
+    )
+    local_tree.get_snapshot().remove(old_local_file_path)
+    local_tree.refresh(new_local_file_path)
+
+
+def _top_most_paths(remote_file_paths: List[str]) -> List[str]:
+    """Drops paths inside another of the paths, as deleting a folder deletes its contents."""
+    remote_file_paths_set = set(remote_file_paths)
+
+    def has_ancestor_in_set(remote_file_path: str) -> bool:
+        while remote_file_path != "":
+            remote_file_path = paths.get_containing_db_folder_path(remote_file_path)
+            if remote_file_path in remote_file_paths_set:
+                return True
+        return False
+
+    return [p for p in remote_file_paths if not has_ancestor_in_set(p)]
 
 
-def is_file(remote_item: Union[FileMetadata, FolderMetadata]) -> bool:
+def is_file(remote_item: RemoteItem) -> bool:
     """Checks if a Dropbox item is a file."""
-    return not isinstance(remote_item, dropbox.files.FolderMetadata)
+    return not remote_item.is_dir
 
 
-def local_modified_time(local_file_path: str) -> float:
+def local_modified_time(local_item: LocalItem) -> float:
     """Gets the modification time of a local file."""
-    return os.path.getmtime(local_file_path)
+    return local_item.mtime
 
 
-def remote_modified_time(remote_item: FileMetadata) -> float:
+def remote_modified_time(remote_item: RemoteItem) -> float:
     """Gets the modification time of a remote Dropbox item."""
-    db_naive_time = remote_item.client_modified
-    db_utc_time = db_naive_time.replace(tzinfo=timezone.utc)
-    return db_utc_time.timestamp()
+    return remote_item.client_modified
 
 
-def _fix_local_time(remote_file: FileMetadata, remote_file_path: str):
-    """Sets the local file's modification time to match the remote file."""
-    log.note("Fix local time for file")
-    file_modified_time = int(remote_modified_time(remote_file))
-    local_file_path = get_local_file_path(remote_file_path)
-    os.utime(local_file_path, (file_modified_time, file_modified_time))
+def same_contents(remote_item: RemoteItem, local_file_path: str) -> bool:
+    """Checks if a local file has the same contents as a remote file, reading it if its hash is not known."""
+    return (
+        _same_size(remote_item, local_file_path)
+        and hash_cache.local_content_hash(local_file_path) == remote_item.content_hash
+    )
+
+
+def known_same_contents(remote_item: RemoteItem, local_file_path: str) -> bool:
+    """Checks if a local file is known to have the same contents as a remote file, without reading it.
+
+    Cheap enough to check while planning, as only an already known hash is
+    used, leaving a file with no known hash for its transfer to check.
+    """
+    return (
+        _same_size(remote_item, local_file_path)
+        and hash_cache.cached_content_hash(local_file_path) == remote_item.content_hash
+    )
 
 
-def get_remote_folder(
-    remote_folder_path: str,
-) -> List[Union[FolderMetadata, FileMetadata]]:
-    """Gets the contents of a remote folder."""
-    return [
-        element
-        for element in _get_all_remote_files()
-        if paths.get_containing_db_folder_path(element.path_display)
-        == remote_folder_path
-    ]
+def _same_size(remote_item: RemoteItem, local_file_path: str) -> bool:
+    """Checks if a local file could have the same contents as a remote file, from its size."""
+    return (
+        remote_item.content_hash != ""
+        and os.path.isfile(local_file_path)
+        and os.path.getsize(local_file_path) == remote_item.size
+    )
+
+
+def _only_time_differs(remote_item: RemoteItem, local_file_path: str) -> bool:
+    """Checks, before transferring a file, if it only needs its time fixed instead."""
+    if not same_contents(remote_item, local_file_path):
+        return False
+    log.note("Found file with same contents on remote Dropbox, so fix time")
+    return True
+
+
+def fix_local_time(
+    remote_item: RemoteItem, remote_file_path: str, version: hash_cache.FileVersion
+):
+    """Sets the local file's modification time to match the remote file.
+
+    Args:
+        version: The version of the local file known to match the remote file.
+            If the file has changed since, such as edited while its upload
+            waited to be committed, its time is left alone, for the next sync
+            to find the change.
+    """
+    local_file_path = get_local_file_path(remote_file_path)
+    if not hash_cache.unchanged_since(local_file_path, version):
+        log.note("File changed since it was synced, so sync it again next time")
+        _remote_index.mark_changed([remote_file_path])
+        return
+    log.note("Fix local time for file")
+    mtime_ns = int(remote_modified_time(remote_item)) * 1_000_000_000
+    os.utime(local_file_path, ns=(mtime_ns, mtime_ns))
+    # stored with the new time, so the next run does not find the file changed
+    local_tree.get_snapshot().add(local_file_path)
+    if remote_item.content_hash != "":
+        # only setting the time, the version transferred is the one now on disk,
+        # unless the file is written to again in between
+        hash_cache.record_hash(
+            local_file_path,
+            remote_item.content_hash,
+            version._replace(mtime_ns=mtime_ns),
+        )
 
 
-def _get_all_remote_files_real() -> List[Union[FolderMetadata, FileMetadata]]:
+def _list_folder_pages(cursor: str) -> Iterator[ListFolderResult]:
+    """Yields each page of the listing from the cursor, or of a full listing if no cursor."""
+    if cursor == "":
+        if config.remote_root_path != "":
+            _create_remote_root()
+        result = _db_client.files_list_folder(config.remote_root_path, recursive=True)
+    else:
+        result = _db_client.files_list_folder_continue(cursor)
+    yield result
+    while result.has_more:
+        result = _db_client.files_list_folder_continue(result.cursor)
+        yield result
+
+
+def _create_remote_root():
+    """Creates the Dropbox folder a sync root is synced with, if it is not there yet."""
+    (result,) = _run_batch_job(
+        _db_client.files_create_folder_batch,
+        _db_client.files_create_folder_batch_check,
+        [config.remote_root_path],
+    )
+    if result.is_failure() and not (
+        result.get_failure().is_path() and result.get_failure().get_path().is_conflict()
+    ):
+        log.note("Unexpected Dropbox API error on create: " + str(result.get_failure()))
+
+
+def _apply_remote_changes(cursor: str, changed_paths: Optional[List[str]] = None):
+    """Applies the changes on Dropbox since the cursor to the index."""
+    # entries are fed into the index one page at a time, so only the compact
+    # records are kept in memory rather than every metadata object, and the
+    # index never falls behind the cursor stored with it
+    for page in _list_folder_pages(cursor):
+        remote_changes = [
+            (
+                delta.path_display,
+                None if isinstance(delta, DeletedMetadata) else to_remote_item(delta),
+            )
+            for delta in page.entries
+            # a sync root's own folder is listed too, but is not synced as an item
+            if delta.path_display.lower() != config.remote_root_path.lower()
+        ]
+        _remote_index.apply_changes(remote_changes, page.cursor)
+        if changed_paths is not None:
+            changed_paths.extend(path for path, _ in remote_changes)
+
+
+def _get_all_remote_files_real():
     """Fetches the list of all remote files from Dropbox."""
-    return _db_client.files_list_folder("", recursive=True).entries
+    _remote_index.clear()
+    _apply_remote_changes("")
 
 
-_CACHE_DATA_KEY = "data"
-_CACHE_TIME_KEY = "checked_time"
+def _is_cursor_reset(err: Exception) -> bool:
+    """Checks if Dropbox can no longer continue from a cursor."""
+    return isinstance(err, BadInputError) or (
+        isinstance(err, ApiError)
+        and hasattr(err.error, "is_reset")
+        and err.error.is_reset()
+    )
+
+
+def _get_remote_index_real(cursor: str) -> Optional[List[str]]:
+    """Brings the remote index up to date, using only the changes since the cursor if possible.
 
-_all_remote_files_cache_data: Dict[str, List[Union[FolderMetadata, FileMetadata]]] = {
-    _CACHE_DATA_KEY: []
-}
+    Returns:
+        The remote paths that changed, or None if everything had to be listed again.
+    """
+    if cursor != "":
+        try:
+            changed_paths: List[str] = []
+            _apply_remote_changes(cursor, changed_paths)
+            return changed_paths
+        except (ApiError, BadInputError) as err:
+            if not _is_cursor_reset(err):
+                raise
+            log.note("Dropbox cursor was reset, so rescan all files on Dropbox")
+    _get_all_remote_files_real()
+    return None
 
-_all_remote_files_cache_time = {_CACHE_TIME_KEY: 0.0}
 
+_remote_index = RemoteIndex()
 
-def _get_all_remote_files() -> List[Union[FolderMetadata, FileMetadata]]:
-    """Gets a cached list of all remote files."""
-    if utils.is_server_connection_stale(_all_remote_files_cache_time[_CACHE_TIME_KEY]):
-        if _all_remote_files_cache_time[_CACHE_TIME_KEY] != 0:
+_CACHE_TIME_KEY = "checked_time"
+
+_remote_index_cache_time = {_CACHE_TIME_KEY: 0.0}
+
+
+def get_remote_index() -> RemoteIndex:
+    """Gets an up to date index of all remote files."""
+    if utils.is_server_connection_stale(_remote_index_cache_time[_CACHE_TIME_KEY]):
+        cursor = _remote_index.get_cursor()
+        if _remote_index_cache_time[_CACHE_TIME_KEY] != 0:
             log.note("Last checked in with server over 60 seconds ago, refreshing")
+        elif cursor != "":
+            log.fyi("Scanning for changes on Dropbox since last Drupebox run")
         else:
             log.fyi("Scanning for files on Dropbox")
-        _all_remote_files_cache_data[_CACHE_DATA_KEY] = _get_all_remote_files_real()
-        _all_remote_files_cache_time[_CACHE_TIME_KEY] = time.time()
-    return _all_remote_files_cache_data[_CACHE_DATA_KEY]
+        _get_remote_index_real(cursor)
+        _remote_index_cache_time[_CACHE_TIME_KEY] = time.time()
+    return _remote_index
 
 
-def item_not_found_at_remote(
-    remote_folder: List[Union[FolderMetadata, FileMetadata]], remote_file_path: str
-) -> bool:
-    """Checks if an item is not found in the remote folder."""
-    return not any(
-        remote_item.path_display == remote_file_path for remote_item in remote_folder
-    )
+def refresh_remote_index() -> Optional[List[str]]:
+    """Brings the remote index up to date now, rather than when it is next stale.
+
+    Returns:
+        The remote paths that changed, or None if everything had to be listed again.
+    """
+    changed_paths = _get_remote_index_real(_remote_index.get_cursor())
+    _remote_index_cache_time[_CACHE_TIME_KEY] = time.time()
+    return changed_paths
+
+
+def wait_for_remote_changes(timeout: int) -> bool:
+    """Waits, for up to timeout seconds, for anything to change on Dropbox."""
+    result = _db_client.files_list_folder_longpoll(_remote_index.get_cursor(), timeout)
+    if result.backoff is not None:
+        time.sleep(result.backoff)  # asked by Dropbox not to poll again until then
+    return result.changes
+
+
+_remote_changes_mark = 0  # the last remote change got for a full sync
+_remote_moves_mark = 0  # the last remote move got for a sync
+
+
+def remote_changes() -> Set[str]:
+    """Gets the remote paths, in lower case, changed on Dropbox since a full sync last completed."""
+    global _remote_changes_mark
+    changed_paths, _remote_changes_mark = _remote_index.changed_paths()
+    return changed_paths
+
+
+def forget_synced_remote_changes():
+    """Forgets the remote changes got for a full sync, once it has completed."""
+    _remote_index.forget_changes(_remote_changes_mark)
+
+
+def remote_moves() -> Dict[str, str]:
+    """Gets the items found moved on Dropbox when refreshing the index, not yet synced.
+
+    Returns:
+        The old remote path of each moved item, by its new remote path.
+    """
+    global _remote_moves_mark
+    moves, _remote_moves_mark = _remote_index.moves()
+    return moves
+
+
+def forget_synced_remote_moves():
+    """Forgets the remote moves got for a sync, once it has completed."""
+    _remote_index.forget_moves(_remote_moves_mark)
+
+
+def get_remote_item(remote_file_path: str) -> Optional[RemoteItem]:
+    """Gets an item on Dropbox, if it is there."""
+    return get_remote_index().get(remote_file_path)
 
 
-def _determine_remotely_deleted_files() -> List[str]:
+def _determine_remotely_deleted_files() -> Set[str]:
     """Determines which files have been deleted on Dropbox since the last run."""
     cursor_last_run = state_cache.cursor_from_last_run
     log.fyi("Scanning for any remotely deleted files since last Drupebox run")
     if cursor_last_run == "":
-        return []
-    deleted_files = [
+        return set()
+    deleted_files = {
         delta.path_display
-        for delta in _db_client.files_list_folder_continue(cursor_last_run).entries
-        if isinstance(delta, dropbox.files.DeletedMetadata)
-    ]
+        for page in _list_folder_pages(cursor_last_run)
+        for delta in page.entries
+        if isinstance(delta, DeletedMetadata)
+    }
     if deleted_files:  # test not empty
         log.note("The following files were deleted on Dropbox since last run")
         for deleted_file in deleted_files:
@@ -192,12 +927,14 @@ def _determine_remotely_deleted_files() -> List[str]:
 
 
 @cache
-def remotely_deleted_files() -> List[str]:
-    """Gets a cached list of remotely deleted files."""
+def remotely_deleted_files() -> Set[str]:
+    """Gets a cached set of remotely deleted files."""
     # uses cache decorator, so after first call, just returns cache of last call
     return _determine_remotely_deleted_files()
 
 
 def get_latest_state() -> str:
     """Gets the latest cursor from Dropbox."""
-    return _db_client.files_list_folder_get_latest_cursor("", recursive=True).cursor
+    return _db_client.files_list_folder_get_latest_cursor(
+        config.remote_root_path, recursive=True
+    ).cursor
@@ -0,0 +1,31 @@
+from typing import Optional, Tuple
+
+import state_cache
+
+
+def resumable_part(local_file_path: str) -> Optional[Tuple[str, int]]:
+    """Gets the revision and full size of the file an interrupted download was of."""
+    with state_cache.transaction() as db:
+        return db.execute(
+            "SELECT rev, size FROM download_parts WHERE local_file_path = ?",
+            (local_file_path,),
+        ).fetchone()
+
+
+def store_part(local_file_path: str, rev: str, size: int):
+    """Records which revision of a file is being downloaded, so it can be resumed next run."""
+    with state_cache.transaction() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO download_parts (local_file_path, rev, size) "
+            "VALUES (?, ?, ?)",
+            (local_file_path, rev, size),
+        )
+
+
+def discard_part(local_file_path: str):
+    """Forgets a download once it is finished or can no longer be resumed."""
+    with state_cache.transaction() as db:
+        db.execute(
+            "DELETE FROM download_parts WHERE local_file_path = ?",
+            (local_file_path,),
+        )
@@ -1,24 +1,43 @@
 #!/usr/bin/env python3
 
+import sys
+
 if __name__ == "__main__":
+    if len(sys.argv) == 1:
+        # a plain run, such as from cron, stops here if there is nothing to sync,
+        # before the imports that can take a few seconds on raspberry pi
+        import quick_check
+
+        if quick_check.nothing_to_sync():
+            print("Drupebox found nothing to sync")
+            sys.exit()
     # print early to give user feedback as imports can take a few seconds on raspberry pi
     print("Initiating libraries")
 
-import os
+import argparse
 import time
+from typing import Dict, List, Optional, Set
 
+import config
+import daemon
 import db_utils as db
+import executor
+import hash_cache
 import local_tree
 import log
+import metrics
 import paths
 import state_cache as state
-from config import ok_to_delete_files, skip, get_local_file_path
-from paths import dbfmt
-from utils import readable_time, is_recent_last_run
+import sync_roots
+import transfers
+from config import get_local_file_path, get_remote_file_path
+from local_tree import LocalItem
+from planner import Action, Planner, print_plan
+from utils import readable_time
 
 
-def action_locally_deleted_files():
-    """Syncs locally deleted files to Dropbox."""
+def plan_locally_deleted_files(planner: Planner):
+    """Plans syncing locally deleted files to Dropbox."""
     log.fyi("Syncing any locally deleted files since last Drupebox run")
     if state.excluded_folders_changed():
         log.note(
@@ -26,96 +45,238 @@ def action_locally_deleted_files():
         )
         return
     locally_deleted_files = local_tree.determine_locally_deleted_files()
-    for locally_deleted_file in locally_deleted_files:
-        log.note("Found locally deleted file, so delete on Dropbox")
-        db.remote_delete(locally_deleted_file)
+    planner.plan_local_moves(local_tree.determine_local_moves(locally_deleted_files))
+    if locally_deleted_files:
+        log.note("Found locally deleted files, so delete on Dropbox")
+        planner.plan_remote_deletes(locally_deleted_files)
 
 
-def action_folder(remote_folder_path):
-    """Recursively syncs a folder between the local filesystem and Dropbox."""
-    log.fyi(remote_folder_path)
+def plan_changes(
+    planner: Planner, changed_local_paths: Set[str], changed_remote_paths: List[str]
+):
+    """Plans syncing only the folders affected by the given local and remote changes."""
+    log.fyi("Syncing changed files")
+    snapshot = local_tree.get_snapshot()
+    locally_deleted_files = []
+    deleted_items: List[LocalItem] = []
+    new_items: List[LocalItem] = []
+    for local_file_path in changed_local_paths:
+        items_before = snapshot.subtree(local_file_path)
+        local_tree.refresh(local_file_path)
+        paths_before = {local_item.path for local_item in items_before}
+        deleted_items += [
+            local_item
+            for local_item in items_before
+            if snapshot.get(local_item.path) is None
+        ]
+        new_items += [
+            local_item
+            for local_item in snapshot.subtree(local_file_path)
+            if local_item.path not in paths_before
+        ]
+        if items_before and snapshot.get(local_file_path) is None:
+            locally_deleted_files.append(local_file_path)
+    if not state.excluded_folders_changed():
+        planner.plan_local_moves(local_tree.match_moves(deleted_items, new_items))
+        if locally_deleted_files:
+            log.note("Found locally deleted files, so delete on Dropbox")
+            planner.plan_remote_deletes(locally_deleted_files)
+    planner.plan_remote_moves(db.remote_moves())
 
-    local_folder_path = get_local_file_path(remote_folder_path)
+    # sync the folder containing each change, and all of any folder that changed
+    folders_to_sync: Dict[str, bool] = {}  # remote folder path -> recursive
+    for remote_file_path in [
+        get_remote_file_path(local_file_path) for local_file_path in changed_local_paths
+    ] + changed_remote_paths:
+        folders_to_sync.setdefault(
+            paths.get_containing_db_folder_path(remote_file_path), False
+        )
+        local_item = local_tree.get_snapshot().get(
+            get_local_file_path(remote_file_path)
+        )
+        remote_item = db.get_remote_item(remote_file_path)
+        if (local_item is not None and local_item.is_dir) or (
+            remote_item is not None and remote_item.is_dir
+        ):
+            folders_to_sync[remote_file_path] = True
 
-    remote_folder = db.get_remote_folder(remote_folder_path)
+    for remote_folder_path, recursive in sorted(folders_to_sync.items()):
+        if not _inside_any(remote_folder_path, folders_to_sync):
+            planner.plan_folder(remote_folder_path, recursive)
 
-    # Go through remote items
-    for remote_item in remote_folder:
-        remote_file_path = remote_item.path_display
-        local_file_path = get_local_file_path(remote_file_path)
-        if skip(local_file_path):
-            continue
 
-        if (
-            not paths.exists(local_file_path)
-            or db.is_file(remote_item)
-            and db.remote_modified_time(remote_item)
-            > db.local_modified_time(local_file_path)
-        ):
-            if paths.exists(local_file_path):
-                log.note("Found updated file on remote Dropbox, so download")
-            else:
-                log.note("Found new file on remote Dropbox, so download")
-
-            if db.is_file(remote_item):
-                db.download_file(remote_file_path, local_file_path)
-            else:
-                db.create_local_folder(remote_file_path, local_file_path)
-
-        elif db.is_file(remote_item) and db.local_modified_time(
-            local_file_path
-        ) > db.remote_modified_time(remote_item):
-
-            log.note("Local file has been updated, so upload")
-            db.upload(local_file_path, remote_file_path)
-
-    # Go through local items
-    for local_item in os.listdir(local_folder_path):
-        remote_file_path = dbfmt(paths.join(remote_folder_path, local_item))
-        local_file_path = paths.join(local_folder_path, local_item)
-
-        if skip(local_file_path):
-            continue
-        if db.item_not_found_at_remote(remote_folder, remote_file_path):
-            if (
-                state.time_last_run > db.local_modified_time(local_file_path)
-                and is_recent_last_run(state.time_last_run)
-                and remote_file_path in db.remotely_deleted_files()
-                and ok_to_delete_files()
-            ):
-                log.note(
-                    "Found local item that is deleted on remote Dropbox, so delete"
-                )
-                db.local_delete(local_file_path)
-            else:
-                if os.path.isdir(local_file_path):
-                    log.note(
-                        "Found local folder that isn't on remote Dropbox, so create"
-                    )
-                    db.create_remote_folder(remote_file_path)
-                else:
-                    log.note("Found local file that isn't on remote Dropbox, so upload")
-                    db.upload(local_file_path, remote_file_path)
-
-    # Go through sub-folders and repeat
-    for sub_folder in os.listdir(local_folder_path):
-        local_sub_folder_path = paths.join(local_folder_path, sub_folder)
-        if os.path.isdir(local_sub_folder_path) and not skip(local_sub_folder_path):
-            action_folder(dbfmt(paths.join(remote_folder_path, sub_folder)))
+def _inside_any(remote_file_path: str, folders_to_sync: Dict[str, bool]) -> bool:
+    """Checks if a path is already synced by recursively syncing a folder above it."""
+    while remote_file_path != "":
+        remote_file_path = paths.get_containing_db_folder_path(remote_file_path)
+        if folders_to_sync.get(remote_file_path):
+            return True
+    return False
 
 
-def main():
-    """The main function of the Drupebox sync script."""
+def _changed_folders() -> Optional[Set[str]]:
+    """Gets the remote folders, in lower case, with anything changed in or below them since the last sync.
+
+    Returns:
+        The folders changed locally or on Dropbox, and each folder above them, or
+        None if every folder needs to be checked.
+    """
+    changed_remote_paths = db.remote_changes()
+    changed_local_folders = local_tree.changed_folders()
+    if (
+        changed_local_folders is None
+        or not state.last_sync_complete()
+        # walked again, for the transfers left for the off-peak hours to be found
+        or state.transfers_deferred()
+    ):
+        return None
+    changed_folders: Set[str] = set()
+    for remote_file_path in changed_remote_paths | {
+        get_remote_file_path(local_folder_path).lower()
+        for local_folder_path in changed_local_folders
+    }:
+        # the path and each folder above it, stopping at one already added
+        while remote_file_path not in changed_folders:
+            changed_folders.add(remote_file_path)
+            if remote_file_path == "":
+                break
+            remote_file_path = paths.get_containing_db_folder_path(remote_file_path)
+    return changed_folders
+
+
+def _new_planner(skip_unchanged: bool = False) -> Planner:
+    """Creates a planner for the current local and remote files."""
+    with metrics.phase("local_scan"):
+        local_snapshot = local_tree.get_snapshot()
+    with metrics.phase("remote_listing"):
+        remote_index = db.get_remote_index()
+        # taken for every sync, so a later one never skips by what was found before it
+        changed_folders = _changed_folders()
+    return Planner(
+        local_snapshot,
+        remote_index,
+        state.time_last_run,
+        db.remotely_deleted_files,
+        changed_folders if skip_unchanged else None,
+    )
+
+
+def sync_all(dry_run: bool = False, full: bool = False):
+    """Syncs every local and remote file change.
+
+    Args:
+        full: Whether to check folders found unchanged too, as a periodic full
+            sync does, rather than skipping them.
+    """
     print("Drupebox sync started at", readable_time(time.time()))
-    action_locally_deleted_files()
+    if state.time_of_checkpoint():
+        log.note(
+            "Carrying on from the sync stopped part way, with its progress from "
+            + readable_time(state.time_of_checkpoint())
+        )
+    with metrics.reporting("sync_all", dry_run=dry_run):
+        planner = _new_planner(skip_unchanged=not full)
+        with metrics.phase("local_deletion_scan"):
+            plan_locally_deleted_files(planner)
+            planner.plan_remote_moves(db.remote_moves())
+
+        log.fyi("Syncing all other local and remote files changes")
+        with metrics.phase("folder_walk"):
+            planner.plan_folder(config.remote_root_path)
+        run_plan(planner.actions, dry_run, planner.checks_every_folder())
+        if not dry_run:
+            db.forget_synced_remote_changes()
 
-    log.fyi("Syncing all other local and remote files changes")
-    action_folder("")
 
-    state.store_state(db.get_latest_state())
-    local_tree.store_current_tree()
+def sync_changes(changed_local_paths: Set[str], changed_remote_paths: List[str]):
+    """Syncs only what is affected by the given local and remote changes."""
+    print("Drupebox sync of changes started at", readable_time(time.time()))
+    with metrics.reporting("sync_changes"):
+        planner = _new_planner()
+        with metrics.phase("folder_walk"):
+            plan_changes(planner, changed_local_paths, changed_remote_paths)
+        run_plan(planner.actions)
+
+
+def run_plan(actions: List[Action], dry_run: bool = False, full_sync: bool = False):
+    """Carries out a plan, or only prints it for a dry run.
+
+    Args:
+        full_sync: Whether the plan checked every folder, rather than only
+            those with changes.
+    """
+    if dry_run:
+        print_plan(actions)
+        print("Drupebox dry run complete at", readable_time(time.time()))
+        return
+    state.mark_sync_started()
+    with metrics.phase("transfers"):
+        executor.execute(actions)
+    finish_sync(full_sync)
+
+
+def finish_sync(full_sync: bool = False):
+    """Finishes queued work and stores state for the next sync."""
+    with metrics.phase("transfers"):
+        db.finish_transfers()
+
+    with metrics.phase("state_store"):
+        state.store_state(db.get_latest_state(), transfers.take_deferred(), full_sync)
+        db.remotely_deleted_files.cache_clear()  # now relative to the stored state
+        db.forget_synced_remote_moves()
+        local_tree.store_current_tree()
+        hash_cache.compact_hashes()
     print("Drupebox sync complete at", readable_time(time.time()))
 
 
+def _run(args: argparse.Namespace):
+    """Syncs the local folder as asked on the command line."""
+    if args.daemon:
+        daemon.run(sync_all, sync_changes)
+    else:
+        sync_all(args.dry_run, full=state.full_sync_due())
+
+
+def _run_sync_root(args: argparse.Namespace):
+    """Syncs one of several sync roots, as asked on the command line."""
+    print(
+        "Drupebox syncing",
+        config.dropbox_local_path,
+        "with Dropbox folder",
+        config.remote_root_path,
+    )
+    if not args.daemon and not args.dry_run:
+        import quick_check
+
+        # as for a plain run of a single local folder
+        if quick_check.nothing_to_sync():
+            print("Drupebox found nothing to sync in", config.dropbox_local_path)
+            return
+    _run(args)
+
+
+def main():
+    """The main function of the Drupebox sync script."""
+    parser = argparse.ArgumentParser(description="Sync a folder with Dropbox.")
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running, syncing local and remote changes as they happen",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="print what would be synced, and how much, without changing anything",
+    )
+    args = parser.parse_args()
+    if args.daemon and args.dry_run:
+        parser.error("--dry-run cannot be used with --daemon")
+
+    if config.sync_roots and config.sync_root_name == "":
+        sync_roots.run(_run_sync_root, args)
+    else:
+        _run(args)
+
+
 if __name__ == "__main__":
     main()
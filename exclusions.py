@@ -0,0 +1,159 @@
+import re
+from typing import Iterable, Pattern
+
+
+def _set_to_regex(characters: str) -> str:
+    """Translates the inside of a "[...]" glob set into a regular expression set."""
+    regex = []
+    if characters.startswith(("!", "^")):
+        regex.append("^")
+        characters = characters[1:]
+    i = 0
+    while i < len(characters):
+        if characters[i] == "\\" and i + 1 < len(characters):
+            regex.append(re.escape(characters[i + 1]))
+            i += 2
+        elif characters[i] == "-":
+            regex.append("-")  # a range, or a literal "-" at either end
+            i += 1
+        else:
+            regex.append(re.escape(characters[i]))
+            i += 1
+    return "[" + "".join(regex) + "]"
+
+
+def _set_end(pattern: str, start: int) -> int:
+    """Finds the "]" closing a glob set opened at start, or -1 if it is not closed."""
+    i = start + 1
+    if pattern.startswith(("!", "^"), i):
+        i += 1
+    if pattern.startswith("]", i):
+        i += 1  # a "]" straight after the "[" is one of the characters
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+        elif pattern[i] == "]":
+            return i
+        else:
+            i += 1
+    return -1
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translates a gitignore-style glob into a regular expression.
+
+    "*" and "?" match within a path component, "**" matches across components,
+    "[...]" matches one of a set of characters, and a backslash makes the
+    character after it match only itself.
+    """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        elif pattern[i] == "[" and _set_end(pattern, i) != -1:
+            end = _set_end(pattern, i)
+            regex.append(_set_to_regex(pattern[i + 1 : end]))
+            i = end + 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(regex)
+
+
+def _compile(alternatives: Iterable[str]) -> Pattern:
+    """Compiles regular expressions into one that matches any of them."""
+    alternatives = list(alternatives)
+    if not alternatives:
+        return re.compile("(?!)")  # never matches
+    return re.compile("(?:" + "|".join(alternatives) + ")", re.DOTALL)
+
+
+class ExclusionMatcher:
+    """Decides which local paths are not synced, from rules compiled once into a few lookups.
+
+    Each rule is a fixed file name, a file name prefix or suffix, an excluded
+    folder, or a gitignore-style glob. A glob without a slash matches a name at
+    any depth, and one with a slash matches from the top of the Dropbox folder.
+    A trailing slash is ignored, so "build/" excludes a file named build as well
+    as a folder, and everything in the folder. Unlike gitignore, a leading "!"
+    cannot re-include what another rule excludes; write "\\!" for a name
+    starting with "!".
+    """
+
+    def __init__(
+        self,
+        root_path: str,
+        names: Iterable[str],
+        prefixes: Iterable[str],
+        suffixes: Iterable[str],
+        excluded_folder_paths: Iterable[str],
+        patterns: Iterable[str],
+    ):
+        self._root_path = root_path  # with a trailing slash
+        # the rules as given, to tell if they have changed since a scan was stored
+        self.rules = [
+            sorted(names),
+            sorted(prefixes),
+            sorted(suffixes),
+            sorted(excluded_folder_paths),
+            list(patterns),
+        ]
+        self._names = set(names)
+        self._excluded_folder_paths = {
+            path.rstrip("/") for path in excluded_folder_paths
+        }
+        name_patterns = [re.escape(prefix) + ".*" for prefix in prefixes] + [
+            ".*" + re.escape(suffix) for suffix in suffixes
+        ]
+        path_patterns = []
+        for pattern in patterns:
+            pattern = pattern.rstrip("/")
+            if "/" in pattern:
+                path_patterns.append(_glob_to_regex(pattern.lstrip("/")))
+            elif pattern != "":
+                name_patterns.append(_glob_to_regex(pattern))
+        self._name_regex = _compile(name_patterns)
+        self._path_regex = _compile(path_patterns) if path_patterns else None
+
+    def excludes_entry(self, local_file_path: str) -> bool:
+        """Checks if a path is excluded, given that the folder containing it is not."""
+        local_file_name = local_file_path.rsplit("/", 1)[1]
+        return (
+            local_file_name in self._names
+            or local_file_path in self._excluded_folder_paths
+            or self._name_regex.fullmatch(local_file_name) is not None
+            or (
+                self._path_regex is not None
+                and self._path_regex.fullmatch(local_file_path[len(self._root_path) :])
+                is not None
+            )
+        )
+
+    def excludes(self, local_file_path: str) -> bool:
+        """Checks if a path is excluded, by itself or by any folder containing it."""
+        local_file_path = local_file_path.rstrip("/")
+        if len(local_file_path) < len(self._root_path):
+            return False  # the Dropbox folder itself
+        # each folder down from the top of the Dropbox folder, then the path itself
+        end = len(self._root_path) - 1
+        while end != -1:
+            end = local_file_path.find("/", end + 1)
+            if self.excludes_entry(
+                local_file_path[:end] if end != -1 else local_file_path
+            ):
+                return True
+        return False
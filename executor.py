@@ -0,0 +1,104 @@
+import os
+from typing import Callable, Dict, List, Optional
+
+import config
+import db_utils as db
+import hash_cache
+from config import get_local_file_path
+from planner import (
+    DELETE_LOCAL,
+    DELETE_REMOTE,
+    DOWNLOAD,
+    FIX_MTIME,
+    MKDIR_LOCAL,
+    MKDIR_REMOTE,
+    MOVE_LOCAL,
+    MOVE_REMOTE,
+    UPLOAD,
+    Action,
+)
+
+_RUNNERS: Dict[str, Callable[[Action], None]] = {
+    UPLOAD: lambda action: db.upload(
+        action.local_file_path, action.remote_file_path, action.remote_item
+    ),
+    DOWNLOAD: lambda action: db.download_file(
+        action.remote_file_path, action.local_file_path, action.size, action.remote_item
+    ),
+    MKDIR_LOCAL: lambda action: db.create_local_folder(
+        action.remote_file_path, action.local_file_path
+    ),
+    MKDIR_REMOTE: lambda action: db.create_remote_folder(action.remote_file_path),
+    DELETE_LOCAL: lambda action: db.local_delete(action.local_file_path),
+    FIX_MTIME: lambda action: _fix_mtime(action),
+}
+
+
+def _fix_mtime(action: Action):
+    """Sets a local file's modified time to match the remote file with the same contents."""
+    assert action.remote_item is not None  # planned along with the remote file
+    # checked again, as the file may have changed since the sync was planned,
+    # and if it has it is left for the next sync to find
+    if os.path.isfile(action.local_file_path):
+        version = hash_cache.file_version(action.local_file_path)
+        if db.known_same_contents(action.remote_item, action.local_file_path):
+            db.fix_local_time(action.remote_item, action.remote_file_path, version)
+
+
+def _in_move_order(actions: List[Action]) -> List[Action]:
+    """Orders moves so that nothing moves into or out of a folder that has already moved."""
+    return sorted(
+        actions,
+        key=lambda action: (
+            -action.moved_from.count("/"),
+            action.remote_file_path.count("/"),
+        ),
+    )
+
+
+# sort keys for each order transfers can be made in, with ties kept in walk order
+_TRANSFER_ORDER_KEYS: Dict[str, Optional[Callable[[Action], float]]] = {
+    "small_first": lambda action: action.size,
+    "newest_first": lambda action: -action.modified,
+    "walk": None,
+}
+
+
+def _in_transfer_order(actions: List[Action]) -> List[Action]:
+    """Orders transfers as configured, so that a large file does not hold up small ones."""
+    key = _TRANSFER_ORDER_KEYS[config.transfer_order]
+    return actions if key is None else sorted(actions, key=key)
+
+
+_BATCHED_KINDS = (MOVE_LOCAL, MOVE_REMOTE, DELETE_REMOTE)
+_TRANSFER_KINDS = (UPLOAD, DOWNLOAD)
+
+
+def execute(actions: List[Action]):
+    """Carries out a plan, queueing its transfers on the worker pool."""
+    # moves go first, so nothing is transferred to where an item is moving to,
+    # then remote deletes, in as few batches as possible
+    for action in _in_move_order(
+        [action for action in actions if action.kind == MOVE_LOCAL]
+    ):
+        db.local_move(get_local_file_path(action.moved_from), action.local_file_path)
+    remote_moves = _in_move_order(
+        [action for action in actions if action.kind == MOVE_REMOTE]
+    )
+    if remote_moves:
+        db.remote_move(
+            [(action.moved_from, action.remote_file_path) for action in remote_moves]
+        )
+    remote_deletes = [
+        action.local_file_path for action in actions if action.kind == DELETE_REMOTE
+    ]
+    if remote_deletes:
+        db.remote_delete(remote_deletes)
+    for action in actions:
+        if action.kind not in _BATCHED_KINDS + _TRANSFER_KINDS:
+            _RUNNERS[action.kind](action)
+    # transfers are queued last, once the local folders they go into are created
+    for action in _in_transfer_order(
+        [action for action in actions if action.kind in _TRANSFER_KINDS]
+    ):
+        _RUNNERS[action.kind](action)
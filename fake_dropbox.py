@@ -0,0 +1,586 @@
+import os
+import pickle
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from dropbox.async_ import PollError
+from dropbox.exceptions import ApiError, RateLimitError
+from dropbox.files import (
+    CommitInfo,
+    CreateFolderBatchJobStatus,
+    CreateFolderBatchLaunch,
+    CreateFolderBatchResult,
+    CreateFolderBatchResultEntry,
+    CreateFolderEntryError,
+    CreateFolderEntryResult,
+    DeleteBatchJobStatus,
+    DeleteBatchLaunch,
+    DeleteBatchResult,
+    DeleteBatchResultData,
+    DeleteBatchResultEntry,
+    DeletedMetadata,
+    DeleteError,
+    DownloadError,
+    FileMetadata,
+    FolderMetadata,
+    ListFolderGetLatestCursorResult,
+    ListFolderLongpollResult,
+    ListFolderResult,
+    LookupError,
+    RelocationBatchErrorEntry,
+    RelocationBatchResultEntry,
+    RelocationBatchV2JobStatus,
+    RelocationBatchV2Launch,
+    RelocationBatchV2Result,
+    RelocationError,
+    UploadSessionFinishBatchJobStatus,
+    UploadSessionFinishBatchLaunch,
+    UploadSessionFinishBatchResult,
+    UploadSessionCursor,
+    UploadSessionFinishBatchResultEntry,
+    UploadSessionFinishError,
+    UploadSessionLookupError,
+    UploadSessionOffsetError,
+    UploadSessionStartResult,
+    WriteConflictError,
+    WriteError,
+)
+
+import content_hash
+import paths
+
+_PAGE_SIZE = 2000  # entries in each page of a listing, as Dropbox returns
+_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class _Item(NamedTuple):
+    """A file or folder held by the fake."""
+
+    path_display: str
+    is_dir: bool
+    id: str
+    size: int
+    content_hash: str
+    client_modified: datetime
+    rev: str
+
+
+def _key(remote_file_path: str) -> str:
+    """Formats a remote path as a key, as Dropbox paths are case-insensitive."""
+    return remote_file_path.lower()
+
+
+def _name(remote_file_path: str) -> str:
+    """Gets the last component of a remote path."""
+    return remote_file_path.rsplit("/", 1)[1]
+
+
+def _now() -> datetime:
+    """Gets the current time, to the second, as Dropbox records it."""
+    return datetime.now(timezone.utc).replace(microsecond=0, tzinfo=None)
+
+
+def _inside(remote_file_path: str, remote_folder_path: str) -> bool:
+    """Checks if a remote path is a folder, or is anywhere below it."""
+    return (_key(remote_file_path) + "/").startswith(_key(remote_folder_path) + "/")
+
+
+def _to_metadata(item: _Item):
+    """Builds the metadata Dropbox would return for an item."""
+    if item.is_dir:
+        return FolderMetadata(
+            name=_name(item.path_display),
+            id=item.id,
+            path_lower=_key(item.path_display),
+            path_display=item.path_display,
+        )
+    return FileMetadata(
+        name=_name(item.path_display),
+        id=item.id,
+        client_modified=item.client_modified,
+        server_modified=item.client_modified,
+        rev=item.rev,
+        size=item.size,
+        path_lower=_key(item.path_display),
+        path_display=item.path_display,
+        content_hash=item.content_hash,
+    )
+
+
+def _deleted_metadata(remote_file_path: str) -> DeletedMetadata:
+    """Builds the metadata Dropbox returns for a deleted item."""
+    return DeletedMetadata(
+        name=_name(remote_file_path),
+        path_lower=_key(remote_file_path),
+        path_display=remote_file_path,
+    )
+
+
+class _Download:
+    """Streams a stored file, like the response to a Dropbox download request."""
+
+    def __init__(self, blob_path: str, offset: int, status_code: int):
+        self.status_code = status_code
+        self._file = open(blob_path, "rb")
+        self._file.seek(offset)
+
+    def iter_content(self, chunk_size: int) -> Iterator[bytes]:
+        """Yields the file in chunks."""
+        while chunk := self._file.read(chunk_size):
+            yield chunk
+
+    def close(self):
+        """Closes the stored file."""
+        self._file.close()
+
+
+class FakeDropbox:
+    """A Dropbox account held in a local folder, for measuring Drupebox without a network.
+
+    It implements the calls in backend.Backend, and keeps its state in the
+    folder between runs. Latency is added to every call, and calls beyond
+    requests_per_second are rejected with a RateLimitError, as Dropbox would.
+    Batch jobs can be run asynchronously, and writes in them can fail from too
+    many writes at once, to exercise how Drupebox waits for and retries them.
+    """
+
+    def __init__(
+        self,
+        storage_folder: str,
+        latency: float = 0.0,
+        requests_per_second: float = 0.0,
+        async_batch_jobs: bool = False,
+        write_contention: float = 0.0,
+    ):
+        """
+        Args:
+            async_batch_jobs: Whether batch calls start a job that is still in
+                progress when first checked, rather than completing at once.
+            write_contention: The chance of each write in a batch failing from too
+                many writes at once, drawn from a seeded random generator.
+        """
+        self._storage_folder = storage_folder
+        self._async_batch_jobs = async_batch_jobs
+        self._write_contention = write_contention
+        self._random = random.Random(0)
+        # async job id -> job status type, the job, and the checks left until done
+        self._jobs: Dict[str, Tuple[Any, Callable[[], Any], List[int]]] = {}
+        self._latency = latency
+        self._requests_per_second = requests_per_second
+        self._tokens = requests_per_second
+        self._updated = time.monotonic()
+        self._lock = threading.RLock()
+        self._items: Dict[str, _Item] = {}
+        # each change, in order, as the remote path and its new item, or None if deleted
+        self._changes: List[Tuple[str, Optional[_Item]]] = []
+        self._next_id = 0
+        os.makedirs(paths.join(storage_folder, "blobs"), exist_ok=True)
+        os.makedirs(paths.join(storage_folder, "sessions"), exist_ok=True)
+        state_file = paths.join(storage_folder, "state.pickle")
+        if os.path.exists(state_file):
+            with open(state_file, "rb") as f:
+                self._items, self._changes, self._next_id = pickle.load(f)
+
+    def save(self):
+        """Stores the account's state in its folder, for the next run."""
+        with self._lock, open(
+            paths.join(self._storage_folder, "state.pickle"), "wb"
+        ) as f:
+            pickle.dump(
+                (self._items, self._changes, self._next_id),
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+
+    def _request(self):
+        """Waits out the latency of a request, or rejects it if over the rate limit."""
+        if self._requests_per_second:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self._requests_per_second,
+                    self._tokens + (now - self._updated) * self._requests_per_second,
+                )
+                self._updated = now
+                if self._tokens < 1:
+                    backoff = (1 - self._tokens) / self._requests_per_second
+                    raise RateLimitError("fake", None, backoff)
+                self._tokens -= 1
+        if self._latency:
+            time.sleep(self._latency)
+
+    def _new_id(self) -> str:
+        """Gets an id for a new item, kept if the item is moved."""
+        self._next_id += 1
+        return "id:" + str(self._next_id)
+
+    def _put(self, item: _Item):
+        """Adds or replaces an item, and records the change."""
+        self._items[_key(item.path_display)] = item
+        self._changes.append((item.path_display, item))
+
+    def _make_folders(self, remote_folder_path: str):
+        """Creates a folder and any folders above it that are missing."""
+        remote_file_path = ""
+        for name in filter(None, remote_folder_path.split("/")):
+            remote_file_path += "/" + name
+            if _key(remote_file_path) not in self._items:
+                self._put(
+                    _Item(remote_file_path, True, self._new_id(), 0, "", _now(), "")
+                )
+
+    def _subtree_keys(self, remote_file_path: str) -> List[str]:
+        """Gets the keys of an item and everything below it."""
+        key = _key(remote_file_path)
+        return [k for k in self._items if k == key or k.startswith(key + "/")]
+
+    def _blob_path(self, content_hash_value: str) -> str:
+        """Gets where the contents of a file are stored."""
+        return paths.join(self._storage_folder, "blobs", content_hash_value)
+
+    def _session_path(self, session_id: str) -> str:
+        """Gets where the data uploaded so far in an upload session is stored."""
+        return paths.join(self._storage_folder, "sessions", session_id)
+
+    def files_list_folder(self, path: str, recursive: bool = False, **kwargs):
+        self._request()
+        with self._lock:
+            # parents sort before their contents, as Dropbox lists them
+            entries = [
+                (item.path_display, item)
+                for _, item in sorted(self._items.items())
+                if (recursive and _inside(item.path_display, path))
+                or _key(paths.get_containing_db_folder_path(item.path_display))
+                == _key(path)
+            ]
+            return self._page(entries, len(self._changes), 0, path)
+
+    def _page(self, entries, position: int, start: int, path: str) -> ListFolderResult:
+        """Gets one page of a listing, with the cursor to continue from."""
+        page = entries[start : start + _PAGE_SIZE]
+        has_more = start + _PAGE_SIZE < len(entries)
+        # the folder listed goes last in the cursor, as it can hold a colon
+        cursor = (
+            "listing:" + str(position) + ":" + str(start + _PAGE_SIZE) + ":" + path
+            if has_more
+            else "changes:" + str(position) + ":" + path
+        )
+        return ListFolderResult(
+            entries=[
+                (
+                    _deleted_metadata(remote_file_path)
+                    if item is None
+                    else _to_metadata(item)
+                )
+                for remote_file_path, item in page
+            ],
+            cursor=cursor,
+            has_more=has_more,
+        )
+
+    def files_list_folder_continue(self, cursor: str):
+        self._request()
+        with self._lock:
+            kind, position_text, rest = cursor.split(":", 2)
+            position = int(position_text)
+            if kind == "listing":
+                # the rest of a full listing, as it was when the listing started
+                start, path = rest.split(":", 1)
+                entries = sorted(
+                    (item.path_display, item)
+                    for item in self._items.values()
+                    if _inside(item.path_display, path)
+                )
+                return self._page(entries, position, int(start), path)
+            next_position = min(position + _PAGE_SIZE, len(self._changes))
+            changes = [
+                (remote_file_path, item)
+                for remote_file_path, item in self._changes[position:next_position]
+                if _inside(remote_file_path, rest)
+            ]
+            return ListFolderResult(
+                entries=[
+                    (
+                        _deleted_metadata(remote_file_path)
+                        if item is None
+                        else _to_metadata(item)
+                    )
+                    for remote_file_path, item in changes
+                ],
+                cursor="changes:" + str(next_position) + ":" + rest,
+                has_more=next_position < len(self._changes),
+            )
+
+    def files_list_folder_get_latest_cursor(
+        self, path: str, recursive: bool = False, **kwargs
+    ):
+        self._request()
+        with self._lock:
+            return ListFolderGetLatestCursorResult(
+                "changes:" + str(len(self._changes)) + ":" + path
+            )
+
+    def files_list_folder_longpoll(self, cursor: str, timeout: int = 30):
+        position = int(cursor.split(":")[1])
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if position < len(self._changes):
+                return ListFolderLongpollResult(changes=True)
+            time.sleep(0.1)
+        return ListFolderLongpollResult(changes=False)
+
+    def files_upload_session_start(self, f: bytes, close: bool = False, **kwargs):
+        self._request()
+        with self._lock:
+            session_id = self._new_id().replace("id:", "session-")
+        with open(self._session_path(session_id), "wb") as session_file:
+            session_file.write(f)
+        return UploadSessionStartResult(session_id)
+
+    def _append(self, f: bytes, cursor):
+        """Adds data to an upload session, checking it carries on from the right offset."""
+        session_path = self._session_path(cursor.session_id)
+        if not os.path.exists(session_path):
+            raise ApiError("fake", UploadSessionLookupError.not_found, None, None)
+        offset = os.path.getsize(session_path)
+        if cursor.offset != offset:
+            raise ApiError(
+                "fake",
+                UploadSessionLookupError.incorrect_offset(
+                    UploadSessionOffsetError(offset)
+                ),
+                None,
+                None,
+            )
+        with open(session_path, "ab") as session_file:
+            session_file.write(f)
+
+    def files_upload_session_append_v2(self, f: bytes, cursor, close: bool = False):
+        self._request()
+        self._append(f, cursor)
+
+    def _commit(self, cursor, commit) -> FileMetadata:
+        """Turns a complete upload session into a file."""
+        session_path = self._session_path(cursor.session_id)
+        hasher = content_hash.ContentHasher()
+        with open(session_path, "rb") as session_file:
+            while chunk := session_file.read(_DOWNLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+        size = os.path.getsize(session_path)
+        content_hash_value = hasher.hexdigest()
+        os.replace(session_path, self._blob_path(content_hash_value))
+        with self._lock:
+            self._make_folders(paths.get_containing_db_folder_path(commit.path))
+            old_item = self._items.get(_key(commit.path))
+            item = _Item(
+                commit.path,
+                False,
+                old_item.id if old_item is not None else self._new_id(),
+                size,
+                content_hash_value,
+                commit.client_modified or _now(),
+                format(self._next_id, "09x"),
+            )
+            self._put(item)
+            return _to_metadata(item)
+
+    def files_upload_session_finish(self, f: bytes, cursor, commit):
+        self._request()
+        self._append(f, cursor)
+        return self._commit(cursor, commit)
+
+    def _contended(self) -> bool:
+        """Decides if a write in a batch fails from too many writes at once, as set up."""
+        return self._write_contention > 0 and (
+            self._random.random() < self._write_contention
+        )
+
+    def _launch(self, launch_type, status_type, run_job: Callable[[], Any]):
+        """Starts a batch job, running it at once, or once checked, as set up.
+
+        Args:
+            launch_type: The launch result type of the batch call.
+            status_type: The job status type of its check call.
+            run_job: Carries out the batch, returning its complete result.
+        """
+        if not self._async_batch_jobs:
+            return launch_type.complete(run_job())
+        with self._lock:
+            async_job_id = self._new_id().replace("id:", "job-")
+            # reported as still in progress when first checked
+            self._jobs[async_job_id] = (status_type, run_job, [1])
+        return launch_type.async_job_id(async_job_id)
+
+    def _check_job(self, async_job_id: str):
+        """Checks on a batch job, running it once it has been checked before."""
+        with self._lock:
+            job = self._jobs.get(async_job_id)
+            if job is None:
+                raise ApiError("fake", PollError.invalid_async_job_id, None, None)
+            status_type, run_job, checks_left = job
+            if checks_left[0] > 0:
+                checks_left[0] -= 1
+                # built from the tag, as in_progress is the base class's instance
+                return status_type("in_progress")
+            del self._jobs[async_job_id]
+        return status_type.complete(run_job())
+
+    # each its own method, rather than an alias, to be reported under its own name
+
+    def files_upload_session_finish_batch_check(self, async_job_id: str):
+        return self._check_job(async_job_id)
+
+    def files_create_folder_batch_check(self, async_job_id: str):
+        return self._check_job(async_job_id)
+
+    def files_delete_batch_check(self, async_job_id: str):
+        return self._check_job(async_job_id)
+
+    def files_move_batch_check_v2(self, async_job_id: str):
+        return self._check_job(async_job_id)
+
+    def files_upload_session_finish_batch(self, entries):
+        self._request()
+        return self._launch(
+            UploadSessionFinishBatchLaunch,
+            UploadSessionFinishBatchJobStatus,
+            lambda: UploadSessionFinishBatchResult(
+                [
+                    (
+                        UploadSessionFinishBatchResultEntry.failure(
+                            UploadSessionFinishError.too_many_write_operations
+                        )
+                        if self._contended()
+                        else UploadSessionFinishBatchResultEntry.success(
+                            self._commit(entry.cursor, entry.commit)
+                        )
+                    )
+                    for entry in entries
+                ]
+            ),
+        )
+
+    def files_create_folder_batch(self, paths: List[str], **kwargs):
+        self._request()
+        return self._launch(
+            CreateFolderBatchLaunch,
+            CreateFolderBatchJobStatus,
+            lambda: CreateFolderBatchResult(
+                [self._create_folder(remote_file_path) for remote_file_path in paths]
+            ),
+        )
+
+    def _create_folder(self, remote_file_path: str) -> CreateFolderBatchResultEntry:
+        """Creates a folder for a create folder batch."""
+        with self._lock:
+            if self._contended():
+                return CreateFolderBatchResultEntry.failure(
+                    CreateFolderEntryError.path(WriteError.too_many_write_operations)
+                )
+            if _key(remote_file_path) in self._items:
+                return CreateFolderBatchResultEntry.failure(
+                    CreateFolderEntryError.path(
+                        WriteError.conflict(WriteConflictError.folder)
+                    )
+                )
+            self._make_folders(remote_file_path)
+            return CreateFolderBatchResultEntry.success(
+                CreateFolderEntryResult(
+                    _to_metadata(self._items[_key(remote_file_path)])
+                )
+            )
+
+    def files_delete_batch(self, entries):
+        self._request()
+        return self._launch(
+            DeleteBatchLaunch,
+            DeleteBatchJobStatus,
+            lambda: DeleteBatchResult([self._delete(entry.path) for entry in entries]),
+        )
+
+    def _delete(self, remote_file_path: str) -> DeleteBatchResultEntry:
+        """Deletes an item, and anything below it, for a delete batch."""
+        with self._lock:
+            if self._contended():
+                return DeleteBatchResultEntry.failure(
+                    DeleteError.too_many_write_operations
+                )
+            item = self._items.get(_key(remote_file_path))
+            if item is None:
+                return DeleteBatchResultEntry.failure(
+                    DeleteError.path_lookup(LookupError.not_found)
+                )
+            for key in self._subtree_keys(remote_file_path):
+                del self._items[key]
+            self._changes.append((item.path_display, None))
+            return DeleteBatchResultEntry.success(
+                DeleteBatchResultData(_to_metadata(item))
+            )
+
+    def files_move_batch_v2(self, entries, **kwargs):
+        self._request()
+        return self._launch(
+            RelocationBatchV2Launch,
+            RelocationBatchV2JobStatus,
+            lambda: RelocationBatchV2Result(
+                [self._move(entry.from_path, entry.to_path) for entry in entries]
+            ),
+        )
+
+    def _move(self, from_path: str, to_path: str) -> RelocationBatchResultEntry:
+        """Moves an item, and anything below it, for a move batch."""
+        with self._lock:
+            if self._contended():
+                return RelocationBatchResultEntry.failure(
+                    RelocationBatchErrorEntry.too_many_write_operations
+                )
+            item = self._items.get(_key(from_path))
+            if item is None or _key(to_path) in self._items:
+                return RelocationBatchResultEntry.failure(
+                    RelocationBatchErrorEntry.relocation_error(
+                        RelocationError.from_lookup(LookupError.not_found)
+                        if item is None
+                        else RelocationError.to(
+                            WriteError.conflict(WriteConflictError.file)
+                        )
+                    )
+                )
+            self._make_folders(paths.get_containing_db_folder_path(to_path))
+            moved = [
+                self._items.pop(key) for key in sorted(self._subtree_keys(from_path))
+            ]
+            self._changes.append((item.path_display, None))
+            for moved_item in moved:
+                self._put(
+                    moved_item._replace(
+                        path_display=to_path + moved_item.path_display[len(from_path) :]
+                    )
+                )
+            return RelocationBatchResultEntry.success(
+                _to_metadata(self._items[_key(to_path)])
+            )
+
+    def files_download(self, path: str, rev: Optional[str] = None, extra_headers=None):
+        self._request()
+        with self._lock:
+            item = self._items.get(_key(path))
+        if item is None or item.is_dir:
+            raise ApiError(
+                "fake", DownloadError.path(LookupError.not_found), None, None
+            )
+        offset = 0
+        if extra_headers and "Range" in extra_headers:
+            offset = int(extra_headers["Range"].split("=")[1].rstrip("-"))
+        return _to_metadata(item), _Download(
+            self._blob_path(item.content_hash), offset, 206 if offset else 200
+        )
+
+    def put_file(self, remote_file_path: str, data: bytes):
+        """Adds a file as if it were uploaded by another device."""
+        session_id = self.files_upload_session_start(data).session_id
+        self._commit(
+            UploadSessionCursor(session_id, len(data)), CommitInfo(remote_file_path)
+        )
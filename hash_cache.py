@@ -0,0 +1,83 @@
+import os
+from typing import NamedTuple, Optional
+
+import content_hash
+import state_cache
+
+
+class FileVersion(NamedTuple):
+    """Identifies a version of a local file, which changes whenever its contents could have."""
+
+    inode: int
+    size: int
+    mtime_ns: int
+
+
+def file_version(local_file_path: str) -> FileVersion:
+    """Gets the version of a local file on disk now."""
+    stat = os.stat(local_file_path)
+    return FileVersion(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def unchanged_since(local_file_path: str, version: FileVersion) -> bool:
+    """Checks if a local file on disk is still the given version of it."""
+    try:
+        return file_version(local_file_path) == version
+    except FileNotFoundError:
+        return False
+
+
+def local_content_hash(local_file_path: str) -> str:
+    """Gets the Dropbox content hash of a local file, only reading it if it has changed."""
+    stat_key = file_version(local_file_path)
+    file_hash = _cached_hash(local_file_path, stat_key)
+    if file_hash is None:
+        file_hash = content_hash.local_content_hash(local_file_path)
+        _store_hash(local_file_path, stat_key, file_hash)
+    return file_hash
+
+
+def cached_content_hash(local_file_path: str) -> Optional[str]:
+    """Gets the Dropbox content hash of a local file if already known, without reading it."""
+    return _cached_hash(local_file_path, file_version(local_file_path))
+
+
+def _cached_hash(local_file_path: str, stat_key: FileVersion) -> Optional[str]:
+    """Gets the stored content hash of a version of a local file, if there is one."""
+    with state_cache.transaction() as db:
+        cached = db.execute(
+            "SELECT inode, size, mtime_ns, content_hash FROM content_hashes "
+            "WHERE path = ?",
+            (local_file_path,),
+        ).fetchone()
+    if cached is not None and cached[:-1] == stat_key:
+        return cached[-1]
+    return None
+
+
+def record_hash(local_file_path: str, file_hash: str, version: FileVersion):
+    """Records the already known content hash of a version of a local file, such as just after a transfer.
+
+    Nothing is recorded if the file has changed since, as the hash is not known
+    to be that of the version on disk now.
+    """
+    if unchanged_since(local_file_path, version):
+        _store_hash(local_file_path, version, file_hash)
+
+
+def _store_hash(local_file_path: str, stat_key: FileVersion, file_hash: str):
+    """Stores the content hash of a version of a local file."""
+    with state_cache.transaction() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO content_hashes "
+            "(path, inode, size, mtime_ns, content_hash) VALUES (?, ?, ?, ?, ?)",
+            (local_file_path, *stat_key, file_hash),
+        )
+
+
+def compact_hashes():
+    """Drops the cached content hashes of files no longer in the stored local tree."""
+    with state_cache.transaction() as db:
+        db.execute(
+            "DELETE FROM content_hashes WHERE path NOT IN (SELECT path FROM local_tree)"
+        )
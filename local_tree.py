@@ -1,54 +1,357 @@
 import os
-from itertools import chain
-from typing import List, Set
+import stat
+from functools import cache
+from typing import (
+    AbstractSet,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
 
 import config
+import metrics
 import paths
+import state_cache
 
-_tree_cache_file = paths.join(paths.cache_folder, config.APP_NAME + "_last_seen_files")
 
+class LocalItem(NamedTuple):
+    """Record of a file or folder in the local Dropbox folder."""
 
-def _get_live_local_tree() -> Set[str]:
-    """Gets a set of all files and directories in the local Dropbox folder."""
-    # get full list of local files in the Drupebox folder
-    tree: Set = set()
-    # remove trailing slashes from excluded paths
-    # (which are forced to have trailing slashes)
-    # to match format produced by paths.join
-    excluded_paths = set(path.rstrip("/") for path in config.excluded_folder_paths_set)
-    for root, dirs, files in os.walk(
-        config.dropbox_local_path, topdown=True, followlinks=True
-    ):
-        root = paths.unix_slash(root)  # format with forward slashes on all platforms
-        # filter out excluded directories
-        dirs[:] = (d for d in dirs if paths.join(root, d) not in excluded_paths)
-        tree.update(paths.join(root, name) for name in chain(files, dirs))
-    return tree
+    path: str
+    is_dir: bool
+    size: int
+    mtime: float
+    inode: int
 
 
-def _load_tree() -> Set[str]:
-    """Loads the local file tree from the cache file."""
-    if not paths.exists(_tree_cache_file):
-        return set()
-    with open(_tree_cache_file, "r", encoding="utf-8") as f:
-        return set(f.read().splitlines())
+def _folder_key(local_folder_path: str) -> str:
+    """Formats a local folder path as an index key."""
+    return local_folder_path.rstrip("/")
 
 
-def _store_tree(tree: Set[str]):
-    """Stores the local file tree to a cache file."""
-    with open(_tree_cache_file, "w", encoding="utf-8") as f:
-        f.write("\n".join(tree))
+def _containing_folder_key(local_file_path: str) -> str:
+    """Gets the index key of the folder containing a local path."""
+    return local_file_path.rstrip("/").rsplit("/", 1)[0]
+
+
+def _stat(entry: os.DirEntry) -> os.stat_result:
+    """Stats a directory entry, reusing the result cached by scandir."""
+    try:
+        return entry.stat()
+    except OSError:  # e.g. a broken symlink
+        return entry.stat(follow_symlinks=False)
+
+
+class LocalSnapshot:
+    """Snapshot of the local Dropbox folder, indexed by path and by containing folder."""
+
+    def __init__(self):
+        self._by_path: Dict[str, LocalItem] = {}
+        self._by_folder: Dict[str, Dict[str, LocalItem]] = {}
+
+    def _add_item(self, local_item: LocalItem):
+        """Adds or replaces an item in the index."""
+        self._by_path[local_item.path] = local_item
+        self._by_folder.setdefault(_containing_folder_key(local_item.path), {})[
+            local_item.path
+        ] = local_item
+
+    def _add_stat(self, local_file_path: str):
+        """Adds or replaces the item at a path from how it is on disk now."""
+        file_stat = os.stat(local_file_path)
+        self._add_item(
+            LocalItem(
+                local_file_path,
+                stat.S_ISDIR(file_stat.st_mode),
+                file_stat.st_size,
+                file_stat.st_mtime,
+                file_stat.st_ino,
+            )
+        )
+
+    def _update_containing_folder(self, local_file_path: str):
+        """Restats the folder containing a path, whose modified time changes with what is in it.
+
+        Otherwise the folder's old time would keep a later rename of it from
+        being matched as a move.
+        """
+        folder_path = _containing_folder_key(local_file_path)
+        if folder_path in self._by_path and os.path.isdir(folder_path):
+            self._add_stat(folder_path)
+
+    def add(self, local_file_path: str):
+        """Records a path that has been created or changed on disk."""
+        self._add_stat(local_file_path)
+        self._update_containing_folder(local_file_path)
+
+    def remove(self, local_file_path: str):
+        """Records a path, and anything below it, as gone from disk."""
+        if self._by_path.pop(local_file_path, None) is None:
+            return
+        folder = self._by_folder.get(_containing_folder_key(local_file_path))
+        if folder is not None:
+            folder.pop(local_file_path, None)
+        for child_path in list(self._by_folder.pop(local_file_path, {})):
+            self.remove(child_path)
+        self._update_containing_folder(local_file_path)
+
+    def get(self, local_file_path: str) -> Optional[LocalItem]:
+        """Gets the item at a local path, if it exists."""
+        return self._by_path.get(local_file_path)
+
+    def subtree(self, local_file_path: str) -> List[LocalItem]:
+        """Gets the item at a local path, and everything below it."""
+        local_item = self._by_path.get(local_file_path)
+        if local_item is None:
+            return []
+        local_items = [local_item]
+        for child_path in self._by_folder.get(local_file_path, {}):
+            local_items.extend(self.subtree(child_path))
+        return local_items
+
+    def get_folder(self, local_folder_path: str) -> List[LocalItem]:
+        """Gets the items directly inside a local folder."""
+        return list(self._by_folder.get(_folder_key(local_folder_path), {}).values())
+
+    def paths(self) -> AbstractSet[str]:
+        """Gets the paths of all items in the snapshot."""
+        return self._by_path.keys()
+
+    def items(self) -> Iterable[LocalItem]:
+        """Gets all items in the snapshot."""
+        return self._by_path.values()
+
+    def folder_paths(self) -> Iterator[str]:
+        """Gets the paths of all folders in the snapshot."""
+        return (path for path, item in self._by_path.items() if item.is_dir)
+
+    def scan(self, local_folder_path: str):
+        """Walks a local folder and everything below it into the snapshot."""
+        # one scandir per folder, and one stat per entry, for the whole sync
+        with os.scandir(paths.system_slash(local_folder_path)) as entries:
+            for entry in entries:
+                local_file_path = paths.join(local_folder_path, entry.name)
+                # excluded items are left out, and excluded folders never walked
+                if config.exclusions.excludes_entry(local_file_path):
+                    metrics.count(metrics.FILES_SKIPPED)
+                    continue
+                is_dir = entry.is_dir()
+                file_stat = _stat(entry)
+                self._add_item(
+                    LocalItem(
+                        local_file_path,
+                        is_dir,
+                        file_stat.st_size,
+                        file_stat.st_mtime,
+                        file_stat.st_ino,
+                    )
+                )
+                if is_dir:
+                    self.scan(local_file_path)
+
+
+@cache
+def get_snapshot() -> LocalSnapshot:
+    """Gets the snapshot of the local Dropbox folder, walking it on first call."""
+    # uses cache decorator, so after first call, just returns cache of last call
+    snapshot = LocalSnapshot()
+    snapshot.scan(config.dropbox_local_path)
+    return snapshot
+
+
+_EXCLUSIONS_KEY = "local_tree_exclusions"  # what was left out of the stored tree
+_PLANNING_CONFIG_KEY = "local_tree_planning_config"  # what else it was synced with
+
+
+def _containing_folder(local_file_path: str) -> str:
+    """Gets the local path of the folder containing a local path."""
+    folder_key = _containing_folder_key(local_file_path)
+    if folder_key == _folder_key(config.dropbox_local_path):
+        return config.dropbox_local_path  # always ends with a slash
+    return folder_key
+
+
+def changed_folders() -> Optional[Set[str]]:
+    """Gets the local folders with anything added, removed or changed directly in them since the last run.
+
+    Every file is statted by the walk, so one edited in place, which leaves its
+    folder's modified time alone, is found too.
+
+    Returns:
+        The local paths of the folders, or None if there is no stored tree to
+        compare with, or it was synced with another config than now.
+    """
+    tree_last = _load_tree()
+    if not tree_last or not synced_with_current_config():
+        return None
+    snapshot = get_snapshot()
+    changed: Set[str] = set()
+    for local_item in snapshot.items():
+        item_last = tree_last.get(local_item.path)
+        if item_last is None and local_item.is_dir:
+            changed.add(local_item.path)  # for a new folder to be synced even if empty
+        # a folder's modified time changes with the items in it, which are compared anyway
+        if item_last is None or (
+            item_last != local_item and not (local_item.is_dir and item_last.is_dir)
+        ):
+            changed.add(_containing_folder(local_item.path))
+    for path in tree_last.keys() - snapshot.paths():
+        changed.add(_containing_folder(path))
+    metrics.count(
+        metrics.FOLDERS_UNCHANGED,
+        sum(1 for path in snapshot.folder_paths() if path not in changed),
+    )
+    return changed
+
+
+def synced_with_current_config() -> bool:
+    """Checks if the stored tree was synced with the same exclusions and planning config as now.
+
+    If not, a folder with nothing changed in it may still hold files that are
+    synced differently now, such as a file that was too large to upload.
+    """
+    return (
+        state_cache.get_value(_EXCLUSIONS_KEY, None) == config.exclusions.rules
+        and state_cache.get_value(_PLANNING_CONFIG_KEY, None)
+        == config.planning_config()
+    )
+
+
+def refresh(local_file_path: str):
+    """Updates the snapshot for a path that may have changed since it was taken."""
+    snapshot = get_snapshot()
+    snapshot.remove(local_file_path)
+    if config.exclusions.excludes(local_file_path) or not paths.exists(local_file_path):
+        return
+    snapshot.add(local_file_path)
+    local_item = snapshot.get(local_file_path)
+    if local_item is not None and local_item.is_dir:
+        snapshot.scan(local_file_path)
+
+
+@cache
+def _load_tree() -> Dict[str, LocalItem]:
+    """Loads the local file tree stored at the end of the last run."""
+    # uses cache decorator, so after first call, just returns cache of last call
+    with state_cache.transaction() as db:
+        rows = db.execute(
+            "SELECT path, is_dir, size, mtime, inode FROM local_tree"
+        ).fetchall()
+    return {
+        path: LocalItem(path, bool(is_dir), size, mtime, inode)
+        for path, is_dir, size, mtime, inode in rows
+    }
+
+
+def _store_tree(snapshot: LocalSnapshot):
+    """Stores the local file tree, writing only what has changed since the last run."""
+    tree_last = _load_tree()
+    tree_now = snapshot.paths()
+    with state_cache.transaction() as db:
+        state_cache.set_value(db, _EXCLUSIONS_KEY, config.exclusions.rules)
+        state_cache.set_value(db, _PLANNING_CONFIG_KEY, config.planning_config())
+        db.executemany(
+            "DELETE FROM local_tree WHERE path = ?",
+            ((path,) for path in tree_last.keys() - tree_now),
+        )
+        db.executemany(
+            "INSERT OR REPLACE INTO local_tree (path, is_dir, size, mtime, inode) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                local_item
+                for local_item in snapshot.items()
+                if tree_last.get(local_item.path) != local_item
+            ),
+        )
+    # the stored tree now matches the snapshot, so a later store, such as at the
+    # next checkpoint of the same sync, only writes what changes after this
+    tree_last.clear()
+    tree_last.update((local_item.path, local_item) for local_item in snapshot.items())
+
+
+def unchanged_since_last_run() -> bool:
+    """Checks if the local folder is as it was stored at the end of the last run."""
+    tree_last = _load_tree()
+    snapshot = get_snapshot()
+    if snapshot.paths() != tree_last.keys():
+        return False
+    # a folder's modified time changes with the items in it, which are compared anyway
+    return all(
+        local_item.is_dir or snapshot.get(path) == local_item
+        for path, local_item in tree_last.items()
+    )
 
 
 def determine_locally_deleted_files() -> List[str]:
     """Determines which files have been deleted locally since the last run."""
-    tree_now = _get_live_local_tree()
-    tree_last = _load_tree()
+    tree_now = get_snapshot().paths()
+    tree_last = _load_tree().keys()
     deleted_files = tree_last - tree_now
     # Sort longest to smallest so that files get processed before their parent folders.
     return sorted(list(deleted_files), key=len, reverse=True)
 
 
+def match_moves(
+    deleted_items: Iterable[LocalItem], new_items: Iterable[LocalItem]
+) -> List[Tuple[str, str]]:
+    """Matches deleted items with new items that are the same file or folder, moved.
+
+    Moving keeps the inode, size and modified time, so together they identify
+    an item that has been moved or renamed.
+
+    Returns:
+        The old and new path of each move, leaving out moves that only follow
+        from moving the folder above.
+    """
+    new_paths = {
+        (item.inode, item.is_dir, item.size, item.mtime): item.path
+        for item in new_items
+    }
+    # old path -> new path, including where an item has moved along with its folder
+    moved_to: Dict[str, str] = {}
+    moves = []
+    # parents first, so that moving a folder is found before what is inside it
+    for old_item in sorted(deleted_items, key=lambda item: len(item.path)):
+        old_folder = _containing_folder_key(old_item.path)
+        new_folder = moved_to.get(old_folder)
+        moved_with_folder = (
+            None
+            if new_folder is None
+            else new_folder + old_item.path.removeprefix(old_folder)
+        )
+        new_path = new_paths.get(
+            (old_item.inode, old_item.is_dir, old_item.size, old_item.mtime)
+        )
+        if new_path is None or new_path == moved_with_folder:
+            if moved_with_folder is not None:
+                moved_to[old_item.path] = moved_with_folder
+            continue
+        moved_to[old_item.path] = new_path
+        moves.append((old_item.path, new_path))
+    return moves
+
+
+def determine_local_moves(locally_deleted_files: List[str]) -> List[Tuple[str, str]]:
+    """Determines which locally deleted files were moved since the last run."""
+    tree_last = _load_tree()
+    snapshot = get_snapshot()
+    return match_moves(
+        (tree_last[path] for path in locally_deleted_files),
+        (
+            local_item
+            for local_item in snapshot.items()
+            if local_item.path not in tree_last
+        ),
+    )
+
+
 def store_current_tree():
-    """Stores the current local file tree to the cache file."""
-    _store_tree(_get_live_local_tree())
+    """Stores the current local file tree to the state database."""
+    # the snapshot is kept up to date with the changes made during the sync,
+    # so there is no need to walk the local folder again
+    _store_tree(get_snapshot())
@@ -0,0 +1,126 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import threading
+from typing import Callable, Dict, Iterable, Optional
+
+import log
+import paths
+
+# from linux/inotify.h
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (
+    _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+)
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+_READ_SIZE = 64 * 1024
+
+
+class LocalWatcher:
+    """Watches local folders with inotify, reporting each changed path."""
+
+    def __init__(
+        self, on_change: Callable[[str], None], on_overflow: Callable[[], None]
+    ):
+        """
+        Args:
+            on_change: Called, from the watcher thread, with each local path that changed.
+            on_overflow: Called if changes were lost, so everything needs checking.
+
+        Raises:
+            OSError: If inotify is not available on this system.
+        """
+        self._on_change = on_change
+        self._on_overflow = on_overflow
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self._libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watched_folders: Dict[int, str] = {}
+        self._warned_watch_limit = False
+
+    def watch(self, local_folder_paths: Iterable[str]):
+        """Starts watching folders for changes to their direct contents."""
+        for local_folder_path in local_folder_paths:
+            wd = self._libc.inotify_add_watch(
+                self._fd,
+                os.fsencode(paths.system_slash(local_folder_path)),
+                _WATCH_MASK,
+            )
+            if wd >= 0:
+                self._watched_folders[wd] = local_folder_path.rstrip("/")
+            elif ctypes.get_errno() == errno.ENOSPC and not self._warned_watch_limit:
+                log.note(
+                    "Reached inotify watch limit, raise fs.inotify.max_user_watches "
+                    "to watch every folder"
+                )
+                self._warned_watch_limit = True
+
+    def start(self):
+        """Starts reporting changes from a background thread."""
+        threading.Thread(target=self._run, name="local-watcher", daemon=True).start()
+
+    def _run(self):
+        """Reads inotify events forever."""
+        while True:
+            self._handle_events(os.read(self._fd, _READ_SIZE))
+
+    def _handle_events(self, data: bytes):
+        """Reports the paths changed by a buffer of inotify events."""
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            if mask & _IN_Q_OVERFLOW:
+                self._on_overflow()
+                continue
+            if mask & _IN_IGNORED:  # folder was deleted or moved away
+                self._watched_folders.pop(wd, None)
+                continue
+            local_folder_path = self._watched_folders.get(wd)
+            if local_folder_path is None or name == "":
+                continue
+            local_file_path = paths.join(local_folder_path, name)
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self.watch(_folders_below(local_file_path))
+            self._on_change(local_file_path)
+
+
+def _folders_below(local_folder_path: str) -> Iterable[str]:
+    """Yields a new folder and every folder inside it, so they can be watched too."""
+    yield local_folder_path
+    for root, dirs, _ in os.walk(paths.system_slash(local_folder_path)):
+        for d in dirs:
+            yield paths.join(paths.unix_slash(root), d)
+
+
+def create_watcher(
+    on_change: Callable[[str], None], on_overflow: Callable[[], None]
+) -> Optional[LocalWatcher]:
+    """Creates a watcher for local changes, or None if inotify is not available."""
+    try:
+        return LocalWatcher(on_change, on_overflow)
+    except (OSError, AttributeError, TypeError) as err:
+        log.note("Cannot watch for local changes: " + str(err))
+        return None
@@ -0,0 +1,130 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import log
+import paths
+
+# the reports of the most recent runs, one JSON object per line, oldest first
+REPORT_FILE = paths.join(paths.cache_folder, "drupebox_run_reports.jsonl")
+_MAX_REPORTS = 1000
+
+BYTES_UPLOADED = "bytes_uploaded"
+BYTES_DOWNLOADED = "bytes_downloaded"
+FILES_SKIPPED = "files_skipped"
+THROTTLED = "throttled"  # times Dropbox asked to slow down
+FOLDERS_UNCHANGED = "folders_unchanged"  # local folders found unchanged
+_COUNTERS = (
+    BYTES_UPLOADED,
+    BYTES_DOWNLOADED,
+    FILES_SKIPPED,
+    THROTTLED,
+    FOLDERS_UNCHANGED,
+)
+
+# transfer workers record calls and bytes too, so update under a lock
+_lock = threading.Lock()
+
+
+def _new_api_call_stats() -> dict:
+    """Creates the statistics kept for each Dropbox API endpoint."""
+    return {"count": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0}
+
+
+def _reset():
+    """Starts recording a new run."""
+    global _started, _phases, _api_calls, _counters
+    _started = time.time()
+    _phases = defaultdict(float)
+    _api_calls = defaultdict(_new_api_call_stats)
+    _counters = {name: 0 for name in _COUNTERS}
+
+
+_started = 0.0
+_phases: Dict[str, float] = {}
+_api_calls: Dict[str, dict] = {}
+_counters: Dict[str, int] = {}
+_reset()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Times a phase of the run, adding to any earlier time spent in the same phase."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        with _lock:
+            _phases[name] += time.perf_counter() - start
+
+
+def record_api_call(endpoint: str, seconds: float, failed: bool):
+    """Records a request made to Dropbox, and how long it took."""
+    with _lock:
+        stats = _api_calls[endpoint]
+        stats["count"] += 1
+        stats["errors"] += failed
+        stats["seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+
+def count(name: str, amount: int = 1):
+    """Adds to one of the counters, such as of bytes uploaded or files skipped."""
+    with _lock:
+        _counters[name] += amount
+
+
+def write_report(kind: str, succeeded: bool, **details):
+    """Adds a report of the run so far to the report file, and starts recording a new run."""
+    with _lock:
+        report = {
+            "kind": kind,
+            "succeeded": succeeded,
+            **details,
+            "started": _started,
+            "finished": time.time(),
+            "phases": {name: round(seconds, 6) for name, seconds in _phases.items()},
+            "api_calls": {
+                endpoint: {
+                    **stats,
+                    "seconds": round(stats["seconds"], 6),
+                    "max_seconds": round(stats["max_seconds"], 6),
+                }
+                for endpoint, stats in sorted(_api_calls.items())
+            },
+            **_counters,
+        }
+        _reset()
+    try:
+        _append_report(report)
+    except OSError as err:
+        log.note("Could not write run report: " + str(err))
+
+
+def _append_report(report: dict):
+    """Adds a report to the report file, dropping the oldest beyond the most kept."""
+    try:
+        with open(REPORT_FILE, encoding="utf-8") as f:
+            reports = f.readlines()[-(_MAX_REPORTS - 1) :]
+    except FileNotFoundError:
+        reports = []
+    reports.append(json.dumps(report) + "\n")
+    # replaced in one step, so a reader never sees a partly written file
+    with open(REPORT_FILE + ".tmp", "w", encoding="utf-8") as f:
+        f.writelines(reports)
+    os.replace(REPORT_FILE + ".tmp", REPORT_FILE)
+
+
+@contextmanager
+def reporting(kind: str, **details) -> Iterator[None]:
+    """Records a run, writing its report once it finishes or fails."""
+    succeeded = False
+    try:
+        yield
+        succeeded = True
+    finally:
+        write_report(kind, succeeded, **details)
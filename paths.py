@@ -67,10 +67,31 @@ def get_file_name(local_file_path: str) -> str:
     return local_file_path.rstrip("/").rsplit("/", 1)[1]
 
 
-if not utils.is_windows:
+if "DRUPEBOX_CACHE_FOLDER" in os.environ:
+    # such as to keep a benchmark's state apart from the real state
+    cache_folder = unix_slash(os.environ["DRUPEBOX_CACHE_FOLDER"])
+    state_folder = cache_folder
+elif not utils.is_windows:
+    # disposable files, such as run reports, go to memory to spare the SD card
     if exists("/dev/shm"):
         cache_folder = "/dev/shm"
     else:
         cache_folder = "/tmp"
+    # the state a run carries on from has to outlast a power cut or a reboot
+    state_folder = join(
+        unix_slash(os.environ.get("XDG_STATE_HOME") or join(home, ".local", "state")),
+        "drupebox",
+    )
 else:
     cache_folder = join(home, ".config")
+    state_folder = cache_folder
+
+# each worker process syncing one of several sync roots is named in its environment,
+# and keeps its state apart from the others
+SYNC_ROOT_ENV = "DRUPEBOX_SYNC_ROOT"
+sync_root_name = os.environ.get(SYNC_ROOT_ENV, "")
+if sync_root_name != "":
+    cache_folder = join(cache_folder, "drupebox_" + sync_root_name)
+    state_folder = join(state_folder, "drupebox_" + sync_root_name)
+os.makedirs(cache_folder, exist_ok=True)
+os.makedirs(state_folder, exist_ok=True)
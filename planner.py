@@ -0,0 +1,475 @@
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import db_utils as db
+import log
+import paths
+from config import (
+    get_local_file_path,
+    get_remote_file_path,
+    ok_to_delete_files,
+    skip,
+    skip_entry,
+)
+from local_tree import LocalItem, LocalSnapshot
+from remote_index import RemoteIndex, RemoteItem
+from utils import is_recent_last_run, readable_size
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+MKDIR_LOCAL = "mkdir_local"
+MKDIR_REMOTE = "mkdir_remote"
+DELETE_LOCAL = "delete_local"
+DELETE_REMOTE = "delete_remote"
+FIX_MTIME = "fix_mtime"
+MOVE_LOCAL = "move_local"
+MOVE_REMOTE = "move_remote"
+
+
+class Action(NamedTuple):
+    """A single step that brings the local folder and Dropbox in sync."""
+
+    kind: str
+    remote_file_path: str
+    local_file_path: str
+    size: int = 0  # bytes to transfer
+    remote_item: Optional[RemoteItem] = None
+    moved_from: str = ""  # remote path the item is moved from, for moves
+    modified: float = 0.0  # unix time the file transferred was last modified
+
+
+class _Moves:
+    """Items moved by the plan, but not yet moved on disk or on Dropbox."""
+
+    def __init__(self):
+        self._old_paths: Dict[str, str] = {}  # new path -> old path
+        self._new_paths: Dict[str, str] = {}  # old path -> new path
+        self._moved_into: Dict[str, List[str]] = {}  # folder -> new paths in it
+
+    def __bool__(self) -> bool:
+        return bool(self._old_paths)
+
+    def add(self, old_path: str, new_path: str):
+        """Records an item as moved."""
+        self._old_paths[new_path] = old_path
+        self._new_paths[old_path] = new_path
+        self._moved_into.setdefault(new_path.rsplit("/", 1)[0], []).append(new_path)
+
+    def old_path(self, path: str) -> str:
+        """Gets where the item at a path was, before it or a folder above it moved."""
+        return _follow_moves(path, self._old_paths)
+
+    def new_path(self, path: str) -> str:
+        """Gets where the item at a path will be, once it or a folder above it moves."""
+        return _follow_moves(path, self._new_paths)
+
+    def is_moved_away(self, path: str) -> bool:
+        """Checks if the item at a path, or a folder above it, has moved elsewhere."""
+        return self.new_path(path) != path
+
+    def is_move_source(self, path: str) -> bool:
+        """Checks if the item at a path has itself moved elsewhere."""
+        return path in self._new_paths
+
+    def moved_into(self, folder_path: str) -> List[str]:
+        """Gets the new paths of items moved into a folder."""
+        return self._moved_into.get(folder_path, [])
+
+
+def _follow_moves(path: str, moves: Dict[str, str]) -> str:
+    """Maps a path through the move of it, or of the nearest folder above it."""
+    if not moves:
+        return path
+    prefix = path
+    while True:
+        if prefix in moves:
+            return moves[prefix] + path[len(prefix) :]
+        if "/" not in prefix:
+            return path
+        prefix = prefix.rsplit("/", 1)[0]
+
+
+def _top_most_moves(moves: Dict[str, str]) -> List[Tuple[str, str]]:
+    """Drops moves that only follow from moving the folder above.
+
+    Args:
+        moves: The old path of each moved item, by its new path.
+
+    Returns:
+        The old and new path of each remaining move, folders first.
+    """
+    top_most_moves = []
+    for new_path, old_path in sorted(moves.items(), key=lambda move: len(move[0])):
+        new_folder, old_folder = new_path.rsplit("/", 1)[0], old_path.rsplit("/", 1)[0]
+        if moves.get(new_folder) != old_folder:
+            top_most_moves.append((old_path, new_path))
+    return top_most_moves
+
+
+class Planner:
+    """Decides the actions that sync the local folder with Dropbox, without making any changes.
+
+    Nothing is sent to Dropbox or changed on disk while planning, so a plan can be
+    reviewed, reordered or run in parallel before it is carried out.
+    """
+
+    def __init__(
+        self,
+        local_snapshot: LocalSnapshot,
+        remote_index: RemoteIndex,
+        time_last_run: float,
+        remotely_deleted_files: Callable[[], Set[str]],
+        changed_folders: Optional[Set[str]] = None,
+    ):
+        """
+        Args:
+            local_snapshot: The local folder as it is now.
+            remote_index: The Dropbox folder as it is now.
+            time_last_run: When the last sync finished.
+            remotely_deleted_files: Gets the remote paths deleted since the last sync,
+                only called if needed as it asks Dropbox.
+            changed_folders: The remote folder paths, in lower case, with anything
+                changed in or below them since the last sync, so the rest are left
+                out, or None to check every folder.
+        """
+        self._local_snapshot = local_snapshot
+        self._remote_index = remote_index
+        self._time_last_run = time_last_run
+        self._remotely_deleted_files = remotely_deleted_files
+        self._changed_folders = changed_folders
+        self._deleted_remote_paths: Set[str] = set()
+        self._local_moves = _Moves()  # moves to make locally, of local paths
+        self._remote_moves = _Moves()  # moves to make on Dropbox, of remote paths
+        self.actions: List[Action] = []
+
+    def checks_every_folder(self) -> bool:
+        """Checks if every folder is planned, rather than only those with changes."""
+        return self._changed_folders is None
+
+    def _plan(self, kind: str, remote_file_path: str, local_file_path: str, **kwargs):
+        """Adds an action to the plan."""
+        self.actions.append(Action(kind, remote_file_path, local_file_path, **kwargs))
+
+    def plan_local_moves(self, local_moves: List[Tuple[str, str]]):
+        """Plans moving items on Dropbox that were moved locally, rather than uploading them again.
+
+        Args:
+            local_moves: The old and new local path of each moved item.
+        """
+        for old_local_file_path, new_local_file_path in local_moves:
+            old_remote_file_path = get_remote_file_path(old_local_file_path)
+            new_remote_file_path = get_remote_file_path(new_local_file_path)
+            if (
+                skip(new_local_file_path)
+                or self._remote_index.get(old_remote_file_path) is None
+                or self._remote_index.get(new_remote_file_path) is not None
+            ):
+                continue  # not a plain move on Dropbox, so sync it as usual
+            log.note("Found locally moved item, so move on Dropbox")
+            self._plan(
+                MOVE_REMOTE,
+                new_remote_file_path,
+                new_local_file_path,
+                moved_from=old_remote_file_path,
+            )
+            self._remote_moves.add(old_remote_file_path, new_remote_file_path)
+
+    def plan_remote_moves(self, remote_moves: Dict[str, str]):
+        """Plans moving local items that were moved on Dropbox, rather than downloading them again.
+
+        Args:
+            remote_moves: The old remote path of each moved item, by its new remote path.
+        """
+        for old_remote_file_path, new_remote_file_path in _top_most_moves(remote_moves):
+            old_local_file_path = get_local_file_path(old_remote_file_path)
+            new_local_file_path = get_local_file_path(new_remote_file_path)
+            if (
+                skip(old_local_file_path)
+                or skip(new_local_file_path)
+                or self._local_item(old_local_file_path) is None
+                or self._local_item(new_local_file_path) is not None
+                or self._remote_index.get(old_remote_file_path) is not None
+            ):
+                continue  # not a plain move locally, so sync it as usual
+            log.note("Found item moved on remote Dropbox, so move")
+            self._plan(
+                MOVE_LOCAL,
+                new_remote_file_path,
+                new_local_file_path,
+                moved_from=old_remote_file_path,
+            )
+            self._local_moves.add(old_local_file_path, new_local_file_path)
+
+    def plan_remote_deletes(self, local_file_paths: Iterable[str]):
+        """Plans deleting files, deleted locally, from Dropbox."""
+        for local_file_path in local_file_paths:
+            if skip(local_file_path):
+                continue  # never synced, such as a partial download
+            remote_file_path = get_remote_file_path(local_file_path)
+            if self._remote_moves.is_moved_away(remote_file_path):
+                # inside a moved folder, so only deleted if it did not move with it
+                remote_file_path = self._remote_moves.new_path(remote_file_path)
+                local_file_path = get_local_file_path(remote_file_path)
+                if self._local_snapshot.get(local_file_path) is not None:
+                    continue
+            self._deleted_remote_paths.add(remote_file_path)
+            self._plan(DELETE_REMOTE, remote_file_path, local_file_path)
+
+    def _is_deleted_remotely(self, remote_file_path: str) -> bool:
+        """Checks if a remote path is, or is inside, one already planned for deletion."""
+        if not self._deleted_remote_paths:
+            return False
+        while remote_file_path != "":
+            if remote_file_path in self._deleted_remote_paths:
+                return True
+            remote_file_path = paths.get_containing_db_folder_path(remote_file_path)
+        return False
+
+    def plan_folder(self, remote_folder_path: str, recursive: bool = True):
+        """Plans syncing a folder between the local filesystem and Dropbox."""
+        if skip(get_local_file_path(remote_folder_path)):
+            return  # such as a change inside an excluded folder
+        self._plan_folder(remote_folder_path, recursive)
+
+    def _plan_folder(self, remote_folder_path: str, recursive: bool = True):
+        """Plans syncing a folder, which is not excluded, between the local filesystem and Dropbox."""
+        if (
+            self._changed_folders is not None
+            and remote_folder_path.lower() not in self._changed_folders
+        ):
+            return  # in sync at the end of the last sync, and unchanged since
+        log.fyi(remote_folder_path)
+
+        local_folder_path = get_local_file_path(remote_folder_path).rstrip("/")
+        if self._remote_moves.is_moved_away(
+            remote_folder_path
+        ) or self._local_moves.is_moved_away(local_folder_path):
+            return  # synced at where it is moving to instead
+        get_local_item = (
+            self._local_item if self._local_moves else self._local_snapshot.get
+        )
+        local_items = self._local_folder(local_folder_path)
+        remote_items: Dict[str, RemoteItem] = {
+            remote_item.path_display: remote_item
+            for remote_item in self._remote_folder(remote_folder_path)
+            if not self._is_deleted_remotely(remote_item.path_display)
+        }
+        folders_to_recurse = []
+        skipped_remote_paths = set()
+
+        # Go through remote items
+        for remote_file_path, remote_item in remote_items.items():
+            local_file_path = get_local_file_path(remote_file_path)
+            if skip_entry(local_file_path):
+                skipped_remote_paths.add(remote_file_path)
+                continue
+            local_item = get_local_item(local_file_path)
+            if local_item is not None and (
+                remote_item.is_dir or remote_item.client_modified == local_item.mtime
+            ):
+                continue  # already in sync, the common case, so checked up front
+            self._plan_remote_item(remote_item, local_item, local_file_path)
+            if local_item is None and remote_item.is_dir:
+                folders_to_recurse.append(remote_file_path)
+
+        # Go through local items
+        for local_item in local_items:
+            local_file_path = local_item.path
+            # same as joining the folder path and file name, without the overhead
+            remote_file_path = (
+                remote_folder_path + local_file_path[len(local_folder_path) :]
+            )
+            if remote_file_path in skipped_remote_paths:
+                continue
+            # excluded items are already left out of the local snapshot
+            if remote_file_path not in remote_items:
+                if not self._plan_local_only_item(local_item, remote_file_path):
+                    continue  # deleted locally, so nothing left below it
+            if local_item.is_dir:
+                folders_to_recurse.append(remote_file_path)
+
+        if not recursive:
+            return
+
+        # Go through sub-folders and repeat
+        for remote_file_path in folders_to_recurse:
+            self._plan_folder(remote_file_path)
+
+    def _local_item(self, local_file_path: str) -> Optional[LocalItem]:
+        """Gets the local item at a path, as it will be once the planned moves are made."""
+        if self._local_moves.is_moved_away(local_file_path):
+            return None
+        old_local_file_path = self._local_moves.old_path(local_file_path)
+        local_item = self._local_snapshot.get(old_local_file_path)
+        if local_item is None or old_local_file_path == local_file_path:
+            return local_item
+        return local_item._replace(path=local_file_path)
+
+    def _local_folder(self, local_folder_path: str) -> List[LocalItem]:
+        """Gets the items in a local folder, as they will be once the planned moves are made."""
+        if not self._local_moves:
+            return self._local_snapshot.get_folder(local_folder_path)
+        old_local_folder_path = self._local_moves.old_path(local_folder_path)
+        local_items = [
+            local_item._replace(
+                path=local_folder_path + local_item.path[len(old_local_folder_path) :]
+            )
+            for local_item in self._local_snapshot.get_folder(old_local_folder_path)
+            if not self._local_moves.is_move_source(local_item.path)
+        ]
+        for new_local_file_path in self._local_moves.moved_into(local_folder_path):
+            local_item = self._local_snapshot.get(
+                self._local_moves.old_path(new_local_file_path)
+            )
+            if local_item is not None:
+                local_items.append(local_item._replace(path=new_local_file_path))
+        return local_items
+
+    def _remote_folder(self, remote_folder_path: str) -> List[RemoteItem]:
+        """Gets the items in a remote folder, as they will be once the planned moves are made."""
+        if not self._remote_moves:
+            return self._remote_index.get_folder(remote_folder_path)
+        old_remote_folder_path = self._remote_moves.old_path(remote_folder_path)
+        remote_items = [
+            remote_item._replace(
+                path_display=remote_folder_path
+                + remote_item.path_display[len(old_remote_folder_path) :]
+            )
+            for remote_item in self._remote_index.get_folder(old_remote_folder_path)
+            if not self._remote_moves.is_move_source(remote_item.path_display)
+        ]
+        for new_remote_file_path in self._remote_moves.moved_into(remote_folder_path):
+            remote_item = self._remote_index.get(
+                self._remote_moves.old_path(new_remote_file_path)
+            )
+            if remote_item is not None:
+                remote_items.append(
+                    remote_item._replace(path_display=new_remote_file_path)
+                )
+        return remote_items
+
+    def _plan_remote_item(
+        self,
+        remote_item: RemoteItem,
+        local_item: Optional[LocalItem],
+        local_file_path: str,
+    ):
+        """Plans syncing an item on Dropbox with the local item at the same path."""
+        remote_file_path = remote_item.path_display
+        if (
+            local_item is not None
+            and db.is_file(remote_item)
+            and db.remote_modified_time(remote_item)
+            != db.local_modified_time(local_item)
+            # only a known hash, as reading the file is left to its transfer
+            and db.known_same_contents(remote_item, local_file_path)
+        ):
+            log.note("Found file with same contents on remote Dropbox, so fix time")
+            self._plan(
+                FIX_MTIME, remote_file_path, local_file_path, remote_item=remote_item
+            )
+
+        elif (
+            local_item is None
+            or db.is_file(remote_item)
+            and db.remote_modified_time(remote_item)
+            > db.local_modified_time(local_item)
+        ):
+            if local_item is not None:
+                log.note("Found updated file on remote Dropbox, so download")
+            else:
+                log.note("Found new file on remote Dropbox, so download")
+
+            if db.is_file(remote_item):
+                self._plan(
+                    DOWNLOAD,
+                    remote_file_path,
+                    local_file_path,
+                    size=remote_item.size,
+                    remote_item=remote_item,
+                    modified=remote_item.client_modified,
+                )
+            else:
+                self._plan(MKDIR_LOCAL, remote_file_path, local_file_path)
+
+        elif db.is_file(remote_item) and db.local_modified_time(
+            local_item
+        ) > db.remote_modified_time(remote_item):
+            log.note("Local file has been updated, so upload")
+            self._plan(
+                UPLOAD,
+                remote_file_path,
+                local_file_path,
+                size=local_item.size,
+                remote_item=remote_item,
+                modified=local_item.mtime,
+            )
+
+    def _plan_local_only_item(
+        self, local_item: LocalItem, remote_file_path: str
+    ) -> bool:
+        """Plans syncing a local item that is not on Dropbox.
+
+        Returns:
+            Whether the local item is kept.
+        """
+        local_file_path = local_item.path
+        if (
+            self._time_last_run > db.local_modified_time(local_item)
+            and is_recent_last_run(self._time_last_run)
+            and remote_file_path in self._remotely_deleted_files()
+            and ok_to_delete_files()
+        ):
+            log.note("Found local item that is deleted on remote Dropbox, so delete")
+            self._plan(DELETE_LOCAL, remote_file_path, local_file_path)
+            return False
+        if local_item.is_dir:
+            log.note("Found local folder that isn't on remote Dropbox, so create")
+            self._plan(MKDIR_REMOTE, remote_file_path, local_file_path)
+        else:
+            log.note("Found local file that isn't on remote Dropbox, so upload")
+            self._plan(
+                UPLOAD,
+                remote_file_path,
+                local_file_path,
+                size=local_item.size,
+                modified=local_item.mtime,
+            )
+        return True
+
+
+def bytes_to_transfer(actions: Iterable[Action]) -> Dict[str, int]:
+    """Adds up the estimated bytes each kind of transfer in a plan will send."""
+    totals = {UPLOAD: 0, DOWNLOAD: 0}
+    for action in actions:
+        if action.kind in totals:
+            totals[action.kind] += action.size
+    return totals
+
+
+def print_plan(actions: List[Action]):
+    """Prints each action in a plan, and how much it will transfer."""
+    for action in actions:
+        if action.kind in (UPLOAD, DOWNLOAD):
+            print(action.kind, action.remote_file_path, readable_size(action.size))
+        elif action.kind in (MOVE_LOCAL, MOVE_REMOTE):
+            print(action.kind, action.moved_from, "->", action.remote_file_path)
+        else:
+            print(action.kind, action.remote_file_path)
+    totals = bytes_to_transfer(actions)
+    print(
+        len(actions),
+        "actions, about",
+        readable_size(totals[UPLOAD]),
+        "to upload and",
+        readable_size(totals[DOWNLOAD]),
+        "to download",
+    )
@@ -0,0 +1,100 @@
+import json
+import time
+import urllib.parse
+import urllib.request
+
+import config
+import local_tree
+import log
+import metrics
+import state_cache
+
+# called directly rather than through the Dropbox SDK, which is slow to import
+_TOKEN_URL = "https://api.dropbox.com/oauth2/token"
+_LIST_FOLDER_CONTINUE_URL = "https://api.dropboxapi.com/2/files/list_folder/continue"
+
+_ACCESS_TOKEN_KEY = "quick_check_access_token"
+_ACCESS_TOKEN_MARGIN = 300  # seconds before expiry to get a new access token
+
+
+def _post(url: str, data: bytes, headers: dict) -> dict:
+    """Makes a request to Dropbox and decodes its JSON response."""
+    request = urllib.request.Request(url, data=data, headers=headers)
+    with urllib.request.urlopen(request, timeout=config.request_timeout) as response:
+        return json.load(response)
+
+
+def _access_token() -> str:
+    """Gets an access token for Dropbox, reusing the last one until it expires."""
+    token = state_cache.get_value(_ACCESS_TOKEN_KEY, None)
+    if token is not None and token["expires_at"] > time.time() + _ACCESS_TOKEN_MARGIN:
+        return token["access_token"]
+    result = _post(
+        _TOKEN_URL,
+        urllib.parse.urlencode(
+            {
+                "grant_type": "refresh_token",
+                "refresh_token": config.refresh_token,
+                "client_id": config.app_key,
+            }
+        ).encode(),
+        {"Content-Type": "application/x-www-form-urlencoded"},
+    )
+    token = {
+        "access_token": result["access_token"],
+        "expires_at": time.time() + result["expires_in"],
+    }
+    with state_cache.transaction() as db:
+        state_cache.set_value(db, _ACCESS_TOKEN_KEY, token)
+    return token["access_token"]
+
+
+def _remote_unchanged(cursor: str) -> bool:
+    """Checks if anything has changed on Dropbox since the cursor."""
+    result = _post(
+        _LIST_FOLDER_CONTINUE_URL,
+        json.dumps({"cursor": cursor}).encode(),
+        {
+            "Authorization": "Bearer " + _access_token(),
+            "Content-Type": "application/json",
+        },
+    )
+    return not result["entries"] and not result["has_more"]
+
+
+def nothing_to_sync() -> bool:
+    """Checks, cheaply, if nothing has changed locally or on Dropbox since the last sync.
+
+    A sync is still run every so often, in case the last one left something
+    that could not be synced to try again.
+    """
+    with metrics.phase("quick_check"):
+        nothing_changed = _nothing_changed()
+    if nothing_changed:
+        metrics.write_report("nothing_to_sync", True)
+    return nothing_changed
+
+
+def _nothing_changed() -> bool:
+    """Checks if nothing has changed since the last sync, and it is not yet time for a full sync."""
+    if (
+        # each of several sync roots is checked by its own worker process
+        (config.sync_roots and config.sync_root_name == "")
+        or not state_cache.last_sync_complete()
+        or (state_cache.transfers_deferred() and config.large_transfers_allowed())
+        or state_cache.cursor_from_last_run == ""
+        or state_cache.excluded_folders_changed()
+        or not local_tree.synced_with_current_config()
+        or state_cache.full_sync_due()
+        or not local_tree.unchanged_since_last_run()
+    ):
+        return False
+    try:
+        if not _remote_unchanged(state_cache.cursor_from_last_run):
+            return False
+    except (OSError, KeyError, ValueError) as err:  # such as being offline
+        log.note("Could not check Dropbox for changes, so sync anyway: " + str(err))
+        return False
+    # as for a sync, so a remote delete is still trusted as recent on the next run
+    state_cache.store_time_last_run()
+    return True
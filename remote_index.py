@@ -0,0 +1,273 @@
+from datetime import timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
+
+from dropbox.files import FolderMetadata, FileMetadata
+
+import paths
+import state_cache
+
+
+class RemoteItem(NamedTuple):
+    """Compact record of a file or folder on Dropbox."""
+
+    path_display: str
+    is_dir: bool
+    client_modified: float  # unix time, 0.0 for folders
+    size: int
+    content_hash: str
+    id: str  # kept by Dropbox when the item is moved or renamed
+
+
+def to_remote_item(remote_metadata: Union[FolderMetadata, FileMetadata]) -> RemoteItem:
+    """Shrinks Dropbox metadata down to a compact record."""
+    if isinstance(remote_metadata, FolderMetadata):
+        return RemoteItem(
+            remote_metadata.path_display, True, 0.0, 0, "", remote_metadata.id
+        )
+    db_naive_time = remote_metadata.client_modified
+    db_utc_time = db_naive_time.replace(tzinfo=timezone.utc)
+    return RemoteItem(
+        remote_metadata.path_display,
+        False,
+        db_utc_time.timestamp(),
+        remote_metadata.size,
+        remote_metadata.content_hash or "",
+        remote_metadata.id,
+    )
+
+
+def _key(remote_file_path: str) -> str:
+    """Formats a remote path as an index key."""
+    # dropbox paths are case-insensitive, so index on the lower-cased path
+    return remote_file_path.lower()
+
+
+_CURSOR_KEY = "remote_index_cursor"
+
+_MAX_QUERY_VARIABLES = 500  # stays under the lowest limit of any SQLite version
+
+_COLUMNS = "path_display, is_dir, client_modified, size, content_hash, id"
+
+# a change is the remote path and its new item, or None if it was deleted
+RemoteChange = Tuple[str, Optional[RemoteItem]]
+
+
+def _to_remote_item(row: tuple) -> RemoteItem:
+    """Converts a database row back into a record."""
+    path_display, is_dir, client_modified, size, content_hash, item_id = row
+    return RemoteItem(
+        path_display, bool(is_dir), client_modified, size, content_hash, item_id
+    )
+
+
+def _record_move(db, old_remote_path: str, new_remote_path: str):
+    """Records an item as moved, following on from any earlier move of it not yet synced."""
+    row = db.execute(
+        "SELECT old_path FROM remote_moves WHERE new_path = ?", (old_remote_path,)
+    ).fetchone()
+    if row is not None:
+        db.execute("DELETE FROM remote_moves WHERE new_path = ?", (old_remote_path,))
+        old_remote_path = row[0]
+    if old_remote_path != new_remote_path:  # unless moved back to where it was
+        # replacing a row gives it a new rowid, so a path moved again is kept
+        db.execute(
+            "INSERT OR REPLACE INTO remote_moves (new_path, old_path) VALUES (?, ?)",
+            (new_remote_path, old_remote_path),
+        )
+
+
+class RemoteIndex:
+    """Snapshot of the remote Dropbox listing, indexed by path and by containing folder.
+
+    The snapshot lives in the state database, together with the cursor it is up to
+    date with, so it carries over between runs without being held in memory.
+    """
+
+    def get_cursor(self) -> str:
+        """Gets the cursor the snapshot is up to date with, or "" if there is no snapshot."""
+        return state_cache.get_value(_CURSOR_KEY, "")
+
+    def clear(self):
+        """Empties the snapshot, ready for a full listing."""
+        with state_cache.transaction() as db:
+            db.execute("DELETE FROM remote_items")
+            state_cache.set_value(db, _CURSOR_KEY, "")
+
+    def apply_changes(
+        self, remote_changes: Iterable[RemoteChange], cursor: Optional[str] = None
+    ):
+        """Applies changes in order, and moves the snapshot on to the cursor, in one transaction.
+
+        Changes made by Drupebox itself can be applied without a cursor, as
+        they are listed again, harmlessly, once the snapshot catches up.
+        """
+        remote_changes = list(remote_changes)
+        with state_cache.transaction() as db:
+            self._find_moves(db, remote_changes)
+            for remote_file_path, remote_item in remote_changes:
+                if remote_item is None:
+                    self._remove(db, remote_file_path)
+                else:
+                    self._add(db, remote_item)
+            if cursor is not None:
+                # kept until a sync has checked them, for it to skip what has not changed
+                db.executemany(
+                    "INSERT OR REPLACE INTO remote_changes (path_lower) VALUES (?)",
+                    (
+                        (_key(remote_file_path),)
+                        for remote_file_path, _ in remote_changes
+                    ),
+                )
+                state_cache.set_value(db, _CURSOR_KEY, cursor)
+
+    @staticmethod
+    def _add(db, remote_item: RemoteItem):
+        """Adds or replaces an item in the index."""
+        db.execute(
+            "INSERT OR REPLACE INTO remote_items (path_lower, parent_lower, "
+            + _COLUMNS
+            + ") VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                _key(remote_item.path_display),
+                _key(paths.get_containing_db_folder_path(remote_item.path_display)),
+                *remote_item,
+            ),
+        )
+
+    @staticmethod
+    def _find_moves(db, remote_changes: List[RemoteChange]):
+        """Records added items that are already in the index at another path, as moves.
+
+        The moves are stored with the cursor, so they are not lost if nothing acts
+        on them, such as after a dry run or a run that is stopped part way.
+        """
+        added = {
+            remote_item.id: remote_item
+            for _, remote_item in remote_changes
+            if remote_item is not None and remote_item.id != ""
+        }
+        ids = list(added)
+        for i in range(0, len(ids), _MAX_QUERY_VARIABLES):
+            batch = ids[i : i + _MAX_QUERY_VARIABLES]
+            rows = db.execute(
+                "SELECT path_display, content_hash, id FROM remote_items WHERE id IN ("
+                + ", ".join("?" * len(batch))
+                + ")",
+                batch,
+            ).fetchall()
+            for old_path, old_content_hash, item_id in rows:
+                remote_item = added[item_id]
+                if (
+                    old_path != remote_item.path_display
+                    and old_content_hash == remote_item.content_hash
+                ):
+                    _record_move(db, old_path, remote_item.path_display)
+
+    def moves(self) -> Tuple[Dict[str, str], int]:
+        """Gets the items moved on Dropbox since they were last forgotten.
+
+        Returns:
+            The old remote path of each moved item, by its new remote path, and a
+            mark to forget them up to once they are synced.
+        """
+        with state_cache.transaction() as db:
+            rows = db.execute(
+                "SELECT rowid, new_path, old_path FROM remote_moves"
+            ).fetchall()
+        return {new_path: old_path for _, new_path, old_path in rows}, max(
+            (rowid for rowid, _, _ in rows), default=0
+        )
+
+    def forget_moves(self, mark: int):
+        """Forgets the moved items up to a mark, keeping any moved again since."""
+        with state_cache.transaction() as db:
+            db.execute("DELETE FROM remote_moves WHERE rowid <= ?", (mark,))
+
+    def changed_paths(self) -> Tuple[Set[str], int]:
+        """Gets the paths, in lower case, listed as changed on Dropbox since they were last forgotten.
+
+        Returns:
+            The paths, and a mark to forget them up to once they are synced.
+        """
+        with state_cache.transaction() as db:
+            rows = db.execute("SELECT rowid, path_lower FROM remote_changes").fetchall()
+        return {path for _, path in rows}, max((rowid for rowid, _ in rows), default=0)
+
+    def mark_changed(self, remote_file_paths: Iterable[str]):
+        """Records paths as changed, for the next sync to check them again, such as after they failed to sync."""
+        with state_cache.transaction() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO remote_changes (path_lower) VALUES (?)",
+                ((_key(remote_file_path),) for remote_file_path in remote_file_paths),
+            )
+
+    def forget_changes(self, mark: int):
+        """Forgets the changed paths up to a mark, keeping any listed again since."""
+        # replacing a row gives it a new rowid, so a path listed again is kept
+        with state_cache.transaction() as db:
+            db.execute("DELETE FROM remote_changes WHERE rowid <= ?", (mark,))
+
+    def move(self, old_remote_path: str, new_remote_path: str):
+        """Moves an item, and anything below it, to a new path in the index."""
+        old_key = _key(old_remote_path)
+        new_key = _key(new_remote_path)
+        with state_cache.transaction() as db:
+            self._remove(db, new_remote_path)
+            # "0" sorts straight after "/", so this range is everything below the path
+            db.execute(
+                "UPDATE remote_items SET path_lower = ? || substr(path_lower, ?), "
+                "parent_lower = ? || substr(parent_lower, ?), "
+                "path_display = ? || substr(path_display, ?) "
+                "WHERE path_lower >= ? AND path_lower < ?",
+                (
+                    new_key,
+                    len(old_key) + 1,
+                    new_key,
+                    len(old_key) + 1,
+                    new_remote_path,
+                    len(old_remote_path) + 1,
+                    old_key + "/",
+                    old_key + "0",
+                ),
+            )
+            db.execute(
+                "UPDATE remote_items SET path_lower = ?, parent_lower = ?, "
+                "path_display = ? WHERE path_lower = ?",
+                (
+                    new_key,
+                    _key(paths.get_containing_db_folder_path(new_remote_path)),
+                    new_remote_path,
+                    old_key,
+                ),
+            )
+
+    @staticmethod
+    def _remove(db, remote_file_path: str):
+        """Removes an item, and anything below it, from the index."""
+        key = _key(remote_file_path)
+        # "0" sorts straight after "/", so this range is everything below the path
+        db.execute(
+            "DELETE FROM remote_items WHERE path_lower = ? "
+            "OR (path_lower >= ? AND path_lower < ?)",
+            (key, key + "/", key + "0"),
+        )
+
+    def get(self, remote_file_path: str) -> Optional[RemoteItem]:
+        """Gets the item at a remote path, if it exists with exactly that path."""
+        with state_cache.transaction() as db:
+            row = db.execute(
+                "SELECT " + _COLUMNS + " FROM remote_items WHERE path_lower = ?",
+                (_key(remote_file_path),),
+            ).fetchone()
+        if row is None or row[0] != remote_file_path:
+            return None
+        return _to_remote_item(row)
+
+    def get_folder(self, remote_folder_path: str) -> List[RemoteItem]:
+        """Gets the items directly inside a remote folder."""
+        with state_cache.transaction() as db:
+            rows = db.execute(
+                "SELECT " + _COLUMNS + " FROM remote_items WHERE parent_lower = ?",
+                (_key(remote_folder_path),),
+            ).fetchall()
+        return [_to_remote_item(row) for row in rows]
@@ -0,0 +1,215 @@
+import random
+import threading
+import time
+from functools import cache
+from typing import Callable, Optional
+
+from dropbox.exceptions import ApiError, InternalServerError, RateLimitError
+
+import config
+import log
+import metrics
+
+_BACKOFF_BASE = 1.0  # seconds before the first retry, doubled on each retry
+_BACKOFF_MAX = 60.0
+
+# held open for minutes while waiting for changes, so not paced or counted as in flight
+_UNSCHEDULED_REQUESTS = {"files_list_folder_longpoll"}
+
+
+def is_too_many_write_operations(error) -> bool:
+    """Checks if a Dropbox error is from too many writes to the same namespace at once."""
+    if (
+        hasattr(error, "is_too_many_write_operations")
+        and error.is_too_many_write_operations()
+    ):
+        return True
+    # the reason is also nested inside path errors, such as for creating a folder
+    for tag in ("path", "path_write"):
+        if getattr(error, "is_" + tag, lambda: False)():
+            return is_too_many_write_operations(getattr(error, "get_" + tag)())
+    return False
+
+
+def _backoff(attempt: int) -> float:
+    """Gets how long to wait before a retry, as exponential backoff with full jitter."""
+    return random.uniform(0, min(_BACKOFF_MAX, _BACKOFF_BASE * 2**attempt))
+
+
+class _TokenBucket:
+    """Paces requests, or bytes, to an average rate, allowing a short burst of up to one second's worth."""
+
+    def __init__(self, rate: float):
+        self._rate = rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, amount: float = 1):
+        """Waits until a request, or an amount of bytes, is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._rate, self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            wait = -self._tokens / self._rate
+        # the token is taken in advance, so concurrent callers queue up behind it
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _ConcurrencyLimit:
+    """Limits the requests in flight, raising the limit additively and cutting it multiplicatively.
+
+    The limit creeps up by one for each limit's worth of requests that succeed,
+    and halves when Dropbox asks to slow down, so it settles around the most
+    Dropbox will allow at once.
+    """
+
+    def __init__(self, maximum: int):
+        self._maximum = maximum
+        self._limit = float(maximum)
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Waits until another request can be in flight."""
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                self._condition.wait()
+            self._in_flight += 1
+
+    def release(self):
+        """Marks a request as no longer in flight."""
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def increase(self):
+        """Raises the limit after a request succeeds."""
+        with self._condition:
+            limit = min(self._maximum, self._limit + 1 / self._limit)
+            if int(limit) > int(self._limit):
+                self._condition.notify()
+            self._limit = limit
+
+    def decrease(self):
+        """Halves the limit after Dropbox asks to slow down."""
+        with self._condition:
+            self._limit = max(1.0, self._limit / 2)
+
+    def limit(self) -> int:
+        """Gets the current limit."""
+        return int(self._limit)
+
+
+def _bandwidth_cap(bytes_per_second: float) -> Optional[_TokenBucket]:
+    """Creates a pacer for the bytes transferred, or None if they are not capped."""
+    return _TokenBucket(bytes_per_second) if bytes_per_second > 0 else None
+
+
+class Scheduler:
+    """Wraps a Dropbox client, pacing its requests and retrying those that are throttled or fail transiently.
+
+    Throttling pauses every request, not only the one that was throttled, for as
+    long as Dropbox asks, and reduces how many requests are made at once.
+    """
+
+    def __init__(self, create_client: Callable):
+        self._create_client = cache(create_client)
+        self._bucket = _TokenBucket(config.requests_per_second)
+        self._upload_bucket = _bandwidth_cap(config.upload_bytes_per_second)
+        self._download_bucket = _bandwidth_cap(config.download_bytes_per_second)
+        # the transfer workers, and the main thread
+        self._concurrency = _ConcurrencyLimit(config.transfer_concurrency + 1)
+        self._paused_until = 0.0
+        self._pause_lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        # the client is only created once a request is made
+        attribute = getattr(self._create_client(), name)
+        if not callable(attribute) or name in _UNSCHEDULED_REQUESTS:
+            return attribute
+        return lambda *args, **kwargs: self.call(attribute, *args, **kwargs)
+
+    def call(self, request: Callable, *args, **kwargs):
+        """Makes a request to Dropbox, retrying it until Dropbox accepts it."""
+        attempt = 0
+        while True:
+            self._wait_for_turn()
+            self._concurrency.acquire()
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = request(*args, **kwargs)
+                failed = False
+            except RateLimitError as err:
+                self.throttled(err.backoff, attempt)
+                delay = 0.0  # waited out by every request before its next turn
+            except ApiError as err:
+                if not is_too_many_write_operations(err.error):
+                    raise
+                self.throttled(None, attempt)
+                delay = 0.0
+            except InternalServerError as err:
+                if attempt >= config.max_request_retries:
+                    raise
+                delay = _backoff(attempt)
+                log.note(
+                    "Dropbox server error "
+                    + str(err.status_code)
+                    + ", retrying in "
+                    + f"{delay:.1f}"
+                    + " seconds"
+                )
+            else:
+                self._concurrency.increase()
+                return result
+            finally:
+                self._concurrency.release()
+                metrics.record_api_call(
+                    request.__name__, time.perf_counter() - start, failed
+                )
+            time.sleep(delay)
+            attempt += 1
+
+    def throttled(self, retry_after: Optional[float] = None, attempt: int = 0):
+        """Slows down all requests after Dropbox asks to, such as from a batch entry that failed.
+
+        Args:
+            retry_after: How long Dropbox asked to wait, in seconds, if it said.
+            attempt: How many times in a row the request has been throttled.
+        """
+        delay = retry_after if retry_after is not None else _backoff(attempt)
+        metrics.count(metrics.THROTTLED)
+        with self._pause_lock:
+            now = time.monotonic()
+            # requests already in flight when throttling began count as one event
+            if now >= self._paused_until:
+                self._concurrency.decrease()
+                log.note(
+                    "Dropbox asked to slow down, so pause for "
+                    + f"{delay:.1f}"
+                    + " seconds and make up to "
+                    + str(self._concurrency.limit())
+                    + " requests at once"
+                )
+            self._paused_until = max(self._paused_until, now + delay)
+
+    def pace_upload(self, size: int):
+        """Waits until sending more bytes keeps uploads within the bandwidth cap, if any."""
+        if self._upload_bucket is not None:
+            self._upload_bucket.take(size)
+
+    def pace_download(self, size: int):
+        """Waits until receiving more bytes keeps downloads within the bandwidth cap, if any."""
+        if self._download_bucket is not None:
+            self._download_bucket.take(size)
+
+    def _wait_for_turn(self):
+        """Waits out any pause asked for by Dropbox, then for the request to be allowed by the pacing."""
+        while (delay := self._paused_until - time.monotonic()) > 0:
+            time.sleep(delay)
+        self._bucket.take()
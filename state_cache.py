@@ -1,6 +1,10 @@
+import json
+import sqlite3
+import threading
 import time
-
-from configobj import ConfigObj
+from contextlib import contextmanager
+from functools import cache
+from typing import Any, Iterator
 
 import config
 import paths
@@ -8,35 +12,218 @@ import paths
 _CURSOR_FROM_LAST_RUN_KEY = "cursor_from_last_run"
 _TIME_FROM_LAST_RUN_KEY = "time_from_last_run"
 _EXCLUDED_FOLDER_PATHS_FROM_LAST_RUN_KEY = "excluded_folder_paths_from_last_run"
+_TIME_OF_LAST_FULL_SYNC_KEY = "time_of_last_full_sync"
+_LAST_SYNC_COMPLETE_KEY = "last_sync_complete"
+_TIME_OF_CHECKPOINT_KEY = "time_of_checkpoint"
+_TRANSFERS_DEFERRED_KEY = "transfers_deferred"
 
 _DEFAULTS = {
     _CURSOR_FROM_LAST_RUN_KEY: "",
     _TIME_FROM_LAST_RUN_KEY: 0.0,
     _EXCLUDED_FOLDER_PATHS_FROM_LAST_RUN_KEY: [],
+    _TIME_OF_LAST_FULL_SYNC_KEY: 0.0,
+    _LAST_SYNC_COMPLETE_KEY: False,
+    _TIME_OF_CHECKPOINT_KEY: 0.0,
+    _TRANSFERS_DEFERRED_KEY: False,
 }
 
-_state_cache_file = paths.join(paths.cache_folder, config.APP_NAME + "_last_state")
+_state_db_file = paths.join(paths.state_folder, config.APP_NAME + "_state.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS local_tree (
+    path TEXT PRIMARY KEY,
+    is_dir INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remote_items (
+    path_lower TEXT PRIMARY KEY,
+    parent_lower TEXT NOT NULL,
+    path_display TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    client_modified REAL NOT NULL,
+    size INTEGER NOT NULL,
+    content_hash TEXT NOT NULL,
+    id TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS remote_items_by_parent ON remote_items (parent_lower);
+CREATE TABLE IF NOT EXISTS remote_changes (
+    path_lower TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS remote_moves (
+    new_path TEXT PRIMARY KEY,
+    old_path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    path TEXT PRIMARY KEY,
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upload_sessions (
+    remote_file_path TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    committed_offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS download_parts (
+    local_file_path TEXT PRIMARY KEY,
+    rev TEXT NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+# transfer workers also record upload progress, so share the connection under a lock
+_lock = threading.RLock()
+
+
+@cache
+def _connect() -> sqlite3.Connection:
+    """Opens the state database, creating its tables if needed."""
+    # uses cache decorator, so after first call, just returns cache of last call
+    connection = sqlite3.connect(_state_db_file, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.executescript(_SCHEMA)
+    _migrate(connection)
+    return connection
+
+
+def _migrate(connection: sqlite3.Connection):
+    """Brings tables created by an older version up to date."""
+    remote_columns = {
+        row[1] for row in connection.execute("PRAGMA table_info(remote_items)")
+    }
+    if "id" not in remote_columns:
+        # filled in as items are next listed
+        connection.execute(
+            "ALTER TABLE remote_items ADD COLUMN id TEXT NOT NULL DEFAULT ''"
+        )
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS remote_items_by_id ON remote_items (id)"
+    )
+
 
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Runs statements against the state database, committing them together."""
+    with _lock:
+        connection = _connect()
+        with connection:  # commits on success, rolls back on error
+            yield connection
 
-def _load_last_run_state() -> ConfigObj:
-    """Loads the state from the last run, initializing if it doesn't exist."""
-    cache_tmp = ConfigObj(_state_cache_file, encoding="utf-8")
-    for key, value in _DEFAULTS.items():
-        if key not in cache_tmp:
-            cache_tmp[key] = value
-    cache_tmp[_TIME_FROM_LAST_RUN_KEY] = float(cache_tmp[_TIME_FROM_LAST_RUN_KEY])
-    return cache_tmp
 
+def get_value(key: str, default: Any) -> Any:
+    """Gets a single stored value."""
+    with transaction() as db:
+        row = db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return default if row is None else json.loads(row[0])
 
-def store_state(cursor: str):
-    """Stores the current state to the cache file."""
-    cached_tmp = ConfigObj(_state_cache_file)
-    cached_tmp[_CURSOR_FROM_LAST_RUN_KEY] = cursor
-    cached_tmp[_TIME_FROM_LAST_RUN_KEY] = time.time()
-    cached_tmp[_EXCLUDED_FOLDER_PATHS_FROM_LAST_RUN_KEY] = list(
+
+def set_value(db: sqlite3.Connection, key: str, value: Any):
+    """Stores a single value, as part of the caller's transaction."""
+    db.execute(
+        "INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+        (key, json.dumps(value)),
+    )
+
+
+def _load_last_run_state() -> dict:
+    """Loads the state from the last run, using defaults for anything not stored."""
+    return {key: get_value(key, value) for key, value in _DEFAULTS.items()}
+
+
+def store_state(cursor: str, transfers_deferred: bool = False, full_sync: bool = False):
+    """Stores the current state to the state database.
+
+    Args:
+        cursor: The cursor the remote files were synced up to.
+        transfers_deferred: Whether any transfer was left for the off-peak hours.
+        full_sync: Whether every folder was checked, rather than only those
+            with changes.
+    """
+    # a long-running daemon carries on from this state, rather than from the last run's
+    global time_last_run, cursor_from_last_run
+    time_last_run = time.time()
+    cursor_from_last_run = cursor
+    _state_last_run[_EXCLUDED_FOLDER_PATHS_FROM_LAST_RUN_KEY] = list(
         config.excluded_folder_paths_set
     )
-    cached_tmp.write()
+    _state_last_run[_LAST_SYNC_COMPLETE_KEY] = True
+    _state_last_run[_TRANSFERS_DEFERRED_KEY] = transfers_deferred
+    if full_sync:
+        _state_last_run[_TIME_OF_LAST_FULL_SYNC_KEY] = time_last_run
+    with transaction() as db:
+        set_value(db, _CURSOR_FROM_LAST_RUN_KEY, cursor)
+        set_value(db, _TIME_FROM_LAST_RUN_KEY, time_last_run)
+        set_value(
+            db,
+            _EXCLUDED_FOLDER_PATHS_FROM_LAST_RUN_KEY,
+            list(config.excluded_folder_paths_set),
+        )
+        if full_sync:
+            set_value(db, _TIME_OF_LAST_FULL_SYNC_KEY, time_last_run)
+        set_value(db, _LAST_SYNC_COMPLETE_KEY, True)
+        set_value(db, _TIME_OF_CHECKPOINT_KEY, 0.0)
+        set_value(db, _TRANSFERS_DEFERRED_KEY, transfers_deferred)
+
+
+def mark_sync_started():
+    """Records that a sync is making changes, until its state is stored at the end."""
+    # in memory too, for a daemon's next sync not to trust a tree stored part way
+    _state_last_run[_LAST_SYNC_COMPLETE_KEY] = False
+    with transaction() as db:
+        set_value(db, _LAST_SYNC_COMPLETE_KEY, False)
+
+
+def store_checkpoint():
+    """Records when a sync last stored its progress, before its state is stored at the end."""
+    with transaction() as db:
+        set_value(db, _TIME_OF_CHECKPOINT_KEY, time.time())
+
+
+def store_time_last_run():
+    """Stores the time of a run that found nothing to sync, keeping the rest of the state."""
+    global time_last_run
+    time_last_run = time.time()
+    with transaction() as db:
+        set_value(db, _TIME_FROM_LAST_RUN_KEY, time_last_run)
+
+
+def last_sync_complete() -> bool:
+    """Checks if the last sync finished, rather than being stopped or failing part way."""
+    return _state_last_run[_LAST_SYNC_COMPLETE_KEY]
+
+
+def time_of_checkpoint() -> float:
+    """Gets when a sync that was stopped part way last stored its progress, or 0 if none was."""
+    if last_sync_complete():
+        return 0.0
+    return float(_state_last_run[_TIME_OF_CHECKPOINT_KEY])
+
+
+def transfers_deferred() -> bool:
+    """Checks if the last sync left any transfer for the off-peak hours."""
+    return _state_last_run[_TRANSFERS_DEFERRED_KEY]
+
+
+def full_sync_due() -> bool:
+    """Checks if it is time to sync everything, checking folders found unchanged too.
+
+    Done every so often, to retry anything that could not be synced before.
+    """
+    return (
+        time.time()
+        > float(_state_last_run[_TIME_OF_LAST_FULL_SYNC_KEY])
+        + config.full_sync_interval
+    )
 
 
 def excluded_folders_changed() -> bool:
@@ -49,5 +236,5 @@ def excluded_folders_changed() -> bool:
 
 _state_last_run = _load_last_run_state()
 
-time_last_run = _state_last_run[_TIME_FROM_LAST_RUN_KEY]
+time_last_run = float(_state_last_run[_TIME_FROM_LAST_RUN_KEY])
 cursor_from_last_run = _state_last_run[_CURSOR_FROM_LAST_RUN_KEY]
@@ -0,0 +1,49 @@
+import multiprocessing
+import os
+import sys
+from multiprocessing.synchronize import Semaphore
+from typing import Callable
+
+import config
+import log
+import paths
+import transfers
+
+
+def _worker(sync: Callable[..., None], args: tuple, transfer_slots: Semaphore):
+    """Syncs a sync root, in the worker process started for it."""
+    transfers.share_slots(transfer_slots)
+    sync(*args)
+
+
+def run(sync: Callable[..., None], *args):
+    """Syncs each sync root at once, in a worker process of its own, until all are done.
+
+    A large sync root no longer holds up a small one, and each uses another core,
+    but all share the transfers allowed at once by transfer_concurrency.
+
+    Args:
+        sync: Syncs the sync root configured for the process it is called in.
+        args: Passed on to sync.
+    """
+    # a fresh process, rather than a fork, loads the config for its own sync root
+    context = multiprocessing.get_context("spawn")
+    transfer_slots = context.BoundedSemaphore(config.transfer_concurrency)
+    workers = []
+    try:
+        for name in config.sync_roots:
+            # inherited by the worker process, for its config to pick its sync root
+            os.environ[paths.SYNC_ROOT_ENV] = name
+            worker = context.Process(
+                target=_worker, args=(sync, args, transfer_slots), name=name
+            )
+            worker.start()
+            workers.append(worker)
+    finally:
+        os.environ.pop(paths.SYNC_ROOT_ENV, None)
+    for worker in workers:
+        worker.join()
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        log.alert("Sync failed for sync roots: " + ", ".join(failed))
+        sys.exit(1)
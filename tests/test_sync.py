@@ -0,0 +1,480 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List
+
+import pytest
+
+_REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# upload_chunk_size set for the tests, and the download chunk size
+_CHUNK_SIZE = 1024 * 1024
+
+
+@pytest.fixture
+def work_folder(tmp_path: Path) -> Path:
+    """Sets up a home folder with a Drupebox config file, so that nothing is asked for."""
+    (tmp_path / "home" / "Dropbox").mkdir(parents=True)
+    (tmp_path / "home" / ".config").mkdir()
+    (tmp_path / "cache").mkdir()
+    (tmp_path / "home" / ".config" / "drupebox").write_text(
+        "refresh_token = test\n"
+        "dropbox_local_path = " + str(tmp_path / "home" / "Dropbox") + "/\n"
+        "excluded_folder_paths = ,\n"
+        "requests_per_second = 10000\n"
+        "upload_chunk_size = " + str(_CHUNK_SIZE) + "\n"
+    )
+    return tmp_path
+
+
+def _worker_process(work_folder: Path, *command: str) -> dict:
+    """Describes a worker process running a command against the fake Dropbox."""
+    env = dict(
+        os.environ,
+        HOME=str(work_folder / "home"),
+        DRUPEBOX_CACHE_FOLDER=str(work_folder / "cache"),
+    )
+    env.pop("DRUPEBOX_SYNC_ROOT", None)
+    return {
+        "args": [sys.executable, os.path.abspath(__file__), str(work_folder), *command],
+        "env": env,
+    }
+
+
+def _run(work_folder: Path, *command: str, check: bool = True) -> bytes:
+    """Runs a command in a fresh process, as each cron run of Drupebox is.
+
+    Returns:
+        What the command printed.
+    """
+    result = subprocess.run(
+        **_worker_process(work_folder, *command), capture_output=True
+    )
+    if check and result.returncode != 0:
+        raise AssertionError(result.stdout.decode() + result.stderr.decode())
+    return result.stdout
+
+
+def _last_report(work_folder: Path) -> dict:
+    """Gets the report of the last run."""
+    with open(work_folder / "cache" / "drupebox_run_reports.jsonl") as f:
+        return json.loads(f.readlines()[-1])
+
+
+def _local_folder(work_folder: Path) -> Path:
+    """Gets the local folder synced with the fake Dropbox."""
+    return work_folder / "home" / "Dropbox"
+
+
+def _reports(work_folder: Path) -> List[dict]:
+    """Gets the reports of every run so far."""
+    report_file = work_folder / "cache" / "drupebox_run_reports.jsonl"
+    if not report_file.exists():
+        return []
+    with open(report_file) as f:
+        return [json.loads(line) for line in f]
+
+
+def _wait_for(condition: Callable[[], bool], timeout: float = 20):
+    """Waits for something the daemon does in the background."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def _wait_until_quiet(work_folder: Path, quiet_seconds: float = 2):
+    """Waits for the daemon to stop syncing, including its own changes."""
+    runs = -1
+    while runs != len(_reports(work_folder)):
+        runs = len(_reports(work_folder))
+        time.sleep(quiet_seconds)
+
+
+class _Daemon:
+    """Talks to a daemon run in a worker process, to change and check its fake Dropbox."""
+
+    def __init__(self, process: subprocess.Popen):
+        self._process = process
+
+    def request(self, *command: str) -> str:
+        """Sends a command to the worker process, and gets its reply."""
+        assert self._process.stdin is not None and self._process.stdout is not None
+        self._process.stdin.write(" ".join(command) + "\n")
+        self._process.stdin.flush()
+        return self._process.stdout.readline().rstrip("\n")
+
+
+@contextmanager
+def _daemon(work_folder: Path) -> Iterator[_Daemon]:
+    """Runs the daemon in a worker process until done with."""
+    process = subprocess.Popen(
+        **_worker_process(work_folder, "daemon"),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        yield _Daemon(process)
+    finally:
+        process.kill()
+        process.wait()
+
+
+def test_remote_move_is_made_locally_after_a_dry_run(work_folder: Path):
+    photos = _local_folder(work_folder) / "photos"
+    photos.mkdir()
+    for i in range(3):
+        (photos / (str(i) + ".jpg")).write_bytes(b"photo " + bytes([i]))
+    _run(work_folder, "sync")
+    _run(work_folder, "sync")  # lists what the first sync uploaded
+    _run(work_folder, "move", "/photos", "/pictures")
+
+    _run(work_folder, "dry-run")
+    _run(work_folder, "sync")
+
+    assert not photos.exists()
+    pictures = _local_folder(work_folder) / "pictures"
+    assert sorted(os.listdir(pictures)) == ["0.jpg", "1.jpg", "2.jpg"]
+    assert "files_download" not in _last_report(work_folder)["api_calls"]
+
+
+def test_interrupted_upload_carries_on(work_folder: Path):
+    large_file = _local_folder(work_folder) / "large.bin"
+    large_file.write_bytes(os.urandom(3 * _CHUNK_SIZE))
+
+    _run(work_folder, "interrupted-sync", check=False)
+    _run(work_folder, "sync")
+
+    report = _last_report(work_folder)
+    assert "files_upload_session_start" not in report["api_calls"]
+    # the chunk whose answer was lost had reached Dropbox, so only the last is sent
+    assert report["bytes_uploaded"] == _CHUNK_SIZE
+    assert _run(work_folder, "cat", "/large.bin") == large_file.read_bytes()
+
+
+def test_interrupted_download_carries_on(work_folder: Path):
+    data = os.urandom(3 * _CHUNK_SIZE)
+    (work_folder / "large.bin").write_bytes(data)
+    _run(work_folder, "sync")
+    _run(work_folder, "put", "/large.bin", str(work_folder / "large.bin"))
+
+    _run(work_folder, "interrupted-sync", check=False)
+    output = _run(work_folder, "sync")
+
+    assert b"Resume interrupted download of /large.bin" in output
+    assert _last_report(work_folder)["bytes_downloaded"] == 2 * _CHUNK_SIZE
+    assert (_local_folder(work_folder) / "large.bin").read_bytes() == data
+
+
+def test_file_edited_before_its_upload_is_committed_is_uploaded_again(
+    work_folder: Path,
+):
+    notes = _local_folder(work_folder) / "notes.txt"
+    notes.write_text("v1")
+
+    _run(work_folder, "edit-while-committing", str(notes))
+    assert _run(work_folder, "cat", "/notes.txt") == b"v1"
+    _run(work_folder, "sync")
+
+    assert notes.read_text() == "v2, edited while v1 was committed"
+    assert _run(work_folder, "cat", "/notes.txt") == notes.read_bytes()
+
+
+def test_unchanged_folders_are_skipped_but_files_edited_in_place_are_found(
+    work_folder: Path,
+):
+    for folder in ("docs", "music"):
+        (_local_folder(work_folder) / folder).mkdir()
+        for i in range(3):
+            (_local_folder(work_folder) / folder / str(i)).write_text(folder)
+    _run(work_folder, "sync")
+    _run(work_folder, "sync")
+    report = _last_report(work_folder)
+    assert report["folders_unchanged"] == 2
+    assert "files_upload_session_start" not in report["api_calls"]
+
+    # written over in place, which leaves the folder's modified time alone
+    edited_file = _local_folder(work_folder) / "docs" / "1"
+    with open(edited_file, "r+") as f:
+        f.write("DOCS")
+    modified_time = edited_file.stat().st_mtime + 10
+    os.utime(edited_file, (modified_time, modified_time))
+    _run(work_folder, "sync")
+
+    assert _last_report(work_folder)["folders_unchanged"] == 1
+    assert _run(work_folder, "cat", "/docs/1") == b"DOCS"
+
+
+def test_file_too_large_to_upload_is_uploaded_once_max_file_size_is_raised(
+    work_folder: Path,
+):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_text = config_file.read_text()
+    config_file.write_text(config_text + "max_file_size = 10\n")
+    (_local_folder(work_folder) / "docs").mkdir()
+    (_local_folder(work_folder) / "docs" / "large").write_text("over ten bytes")
+    _run(work_folder, "sync")
+    _run(work_folder, "sync")
+    assert _run(work_folder, "cat", "/docs/large", check=False) == b""
+
+    config_file.write_text(config_text)
+    _run(work_folder, "sync")
+
+    assert _run(work_folder, "cat", "/docs/large") == b"over ten bytes"
+
+
+def test_excluded_patterns_match_escaped_characters_only_as_themselves(
+    work_folder: Path,
+):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_file.write_text(
+        config_file.read_text() + "excluded_patterns = draft\\*.txt, build/\n"
+    )
+    (_local_folder(work_folder) / "draft*.txt").write_text("excluded")
+    (_local_folder(work_folder) / "draft 2.txt").write_text("synced")
+    (_local_folder(work_folder) / "build").write_text("a file, excluded too")
+
+    _run(work_folder, "sync")
+
+    assert _run(work_folder, "cat", "/draft*.txt", check=False) == b""
+    assert _run(work_folder, "cat", "/draft 2.txt") == b"synced"
+    assert _run(work_folder, "cat", "/build", check=False) == b""
+
+
+def test_excluded_pattern_starting_with_an_exclamation_mark_is_refused(
+    work_folder: Path,
+):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_file.write_text(
+        config_file.read_text() + "excluded_patterns = *.txt, !keep.txt\n"
+    )
+
+    with pytest.raises(AssertionError, match="cannot re-include"):
+        _run(work_folder, "sync")
+
+
+def test_off_peak_hours_starting_and_ending_at_the_same_hour_are_refused(
+    work_folder: Path,
+):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_file.write_text(config_file.read_text() + "off_peak_hours = 6-6\n")
+
+    with pytest.raises(AssertionError, match="two different hours"):
+        _run(work_folder, "sync")
+
+
+def test_sync_after_a_failed_one_in_the_same_process_checks_its_folders(
+    work_folder: Path,
+):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_file.write_text(config_file.read_text() + "checkpoint_interval = 1\n")
+    (_local_folder(work_folder) / "docs").mkdir()
+    (_local_folder(work_folder) / "docs" / "base.txt").write_text("base")
+    _run(work_folder, "sync")
+    _run(work_folder, "sync")
+    (_local_folder(work_folder) / "docs" / "new.txt").write_text("new")
+    (_local_folder(work_folder) / "slow.txt").write_text("slow")
+
+    # as the daemon does, the second sync carrying on from the first in memory
+    _run(work_folder, "fail-after-checkpoint-then-sync")
+
+    assert _run(work_folder, "cat", "/docs/new.txt") == b"new"
+
+
+def test_daemon_syncs_changes_as_they_happen(work_folder: Path):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_file.write_text(config_file.read_text() + "daemon_debounce_seconds = 0.5\n")
+    with _daemon(work_folder) as daemon:
+        _wait_for(lambda: len(_reports(work_folder)) == 1)  # the first full sync
+
+        (_local_folder(work_folder) / "local.txt").write_text("local")
+        _wait_for(lambda: daemon.request("cat", "/local.txt") == "local")
+
+        # found through the longpoll
+        remote_file = _local_folder(work_folder) / "remote.txt"
+        daemon.request("put", "/remote.txt", "remote")
+        _wait_for(lambda: remote_file.exists() and remote_file.read_text() == "remote")
+
+        # written a little apart, but well within the debounce period of each other
+        _wait_until_quiet(work_folder)
+        runs = len(_reports(work_folder))
+        for i in range(10):
+            (_local_folder(work_folder) / ("burst" + str(i))).write_text(str(i))
+            time.sleep(0.05)
+        _wait_for(lambda: len(_reports(work_folder)) > runs)
+        burst_sync = _reports(work_folder)[runs]
+        assert burst_sync["kind"] == "sync_changes"
+        assert burst_sync["api_calls"]["files_upload_session_start"]["count"] == 10
+
+
+def test_daemon_moves_a_renamed_folder_in_one_go(work_folder: Path):
+    config_file = work_folder / "home" / ".config" / "drupebox"
+    config_file.write_text(config_file.read_text() + "daemon_debounce_seconds = 0.5\n")
+    (_local_folder(work_folder) / "docs").mkdir()
+    (_local_folder(work_folder) / "docs" / "a.txt").write_text("a")
+    with _daemon(work_folder) as daemon:
+        _wait_for(lambda: len(_reports(work_folder)) == 1)  # the first full sync
+        # changes the folder's modified time, after the daemon's snapshot of it
+        (_local_folder(work_folder) / "docs" / "b.txt").write_text("b")
+        _wait_for(lambda: daemon.request("cat", "/docs/b.txt") == "b")
+        _wait_until_quiet(work_folder)
+        runs = len(_reports(work_folder))
+
+        (_local_folder(work_folder) / "docs").rename(
+            _local_folder(work_folder) / "papers"
+        )
+        _wait_for(lambda: len(_reports(work_folder)) > runs)
+
+        # the folder moved, not each file into a new folder and the old one deleted
+        rename_sync = _reports(work_folder)[runs]
+        assert rename_sync["api_calls"]["files_move_batch_v2"]["count"] == 1
+        assert "files_create_folder_batch" not in rename_sync["api_calls"]
+        assert "files_delete_batch" not in rename_sync["api_calls"]
+        assert daemon.request("cat", "/papers/a.txt") == "a"
+        assert daemon.request("cat", "/papers/b.txt") == "b"
+        assert daemon.request("cat", "/docs/a.txt") == ""
+
+
+def test_batches_are_waited_for_and_retried(work_folder: Path):
+    for i in range(10):
+        (_local_folder(work_folder) / ("folder" + str(i))).mkdir()
+        (_local_folder(work_folder) / ("folder" + str(i)) / "file").write_text(str(i))
+
+    _run(work_folder, "contended-sync")
+
+    for i in range(10):
+        assert _run(work_folder, "cat", "/folder" + str(i) + "/file") == str(i).encode()
+
+
+def _interrupt(fake):
+    """Makes a transfer fail part way, as if the connection dropped."""
+    append = fake.files_upload_session_append_v2
+    download = fake.files_download
+
+    def files_upload_session_append_v2(*args, **kwargs):
+        append(*args, **kwargs)  # dropped on the way back
+        raise ConnectionResetError("interrupted")
+
+    def files_download(*args, **kwargs):
+        remote_file, response = download(*args, **kwargs)
+        iter_content = response.iter_content
+
+        def interrupted_content(chunk_size):
+            chunks = iter_content(chunk_size)
+            yield next(chunks)
+            raise ConnectionResetError("interrupted")
+
+        response.iter_content = interrupted_content
+        return remote_file, response
+
+    fake.files_upload_session_append_v2 = files_upload_session_append_v2
+    fake.files_download = files_download
+
+
+def _edit_while_committing(fake, local_file_path: str):
+    """Makes the user edit a file after it is uploaded, but before it is committed."""
+    finish_batch = fake.files_upload_session_finish_batch
+
+    def files_upload_session_finish_batch(*args, **kwargs):
+        with open(local_file_path, "w") as f:
+            f.write("v2, edited while v1 was committed")
+        return finish_batch(*args, **kwargs)
+
+    fake.files_upload_session_finish_batch = files_upload_session_finish_batch
+
+
+def _fail_after_checkpoint(fake):
+    """Makes the upload of new.txt fail once, after the sync stores a checkpoint."""
+    upload_session_start = fake.files_upload_session_start
+    failed = []
+
+    def files_upload_session_start(f: bytes, *args, **kwargs):
+        if f == b"slow":
+            time.sleep(1.5)  # for the sync to store a checkpoint meanwhile
+        elif f == b"new" and not failed:
+            failed.append(f)
+            raise ConnectionResetError("interrupted")
+        return upload_session_start(f, *args, **kwargs)
+
+    fake.files_upload_session_start = files_upload_session_start
+
+
+def _serve_daemon(fake, replies):
+    """Runs the daemon in the background, changing and checking the fake Dropbox as asked."""
+    import drupebox
+
+    threading.Thread(
+        target=drupebox._run,
+        args=(argparse.Namespace(daemon=True, dry_run=False),),
+        daemon=True,
+    ).start()
+    for request in sys.stdin:
+        command, remote_file_path, *args = request.split()
+        reply = ""
+        if command == "put":
+            fake.put_file(remote_file_path, args[0].encode())
+        elif command == "cat":
+            try:
+                _, response = fake.files_download(remote_file_path)
+            except Exception:  # not on the fake Dropbox yet
+                pass
+            else:
+                reply = b"".join(response.iter_content(_CHUNK_SIZE)).decode()
+                response.close()
+        print(reply, file=replies, flush=True)
+
+
+def _worker(work_folder: str, command: str, *args: str):
+    """Carries out a command against the fake Dropbox kept in the work folder."""
+    sys.path.insert(0, _REPO_FOLDER)
+    replies = sys.stdout
+    if command == "daemon":
+        # for what is printed, from loading the config on, to be kept out of the replies
+        sys.stdout = open(os.devnull, "w")
+    import db_utils
+    import drupebox
+    from dropbox.files import RelocationPath
+    from fake_dropbox import FakeDropbox
+
+    fake = FakeDropbox(
+        os.path.join(work_folder, "remote"),
+        async_batch_jobs=command == "contended-sync",
+        write_contention=0.3 if command == "contended-sync" else 0.0,
+    )
+    try:
+        if command == "move":
+            fake.files_move_batch_v2([RelocationPath(*args)])
+        elif command == "put":
+            with open(args[1], "rb") as f:
+                fake.put_file(args[0], f.read())
+        elif command == "daemon":
+            db_utils.use_client(fake)
+            _serve_daemon(fake, replies)
+        elif command == "cat":
+            _, response = fake.files_download(args[0])
+            for chunk in response.iter_content(_CHUNK_SIZE):
+                sys.stdout.buffer.write(chunk)
+            response.close()
+        else:
+            if command == "interrupted-sync":
+                _interrupt(fake)
+            elif command == "edit-while-committing":
+                _edit_while_committing(fake, *args)
+            db_utils.use_client(fake)
+            if command == "fail-after-checkpoint-then-sync":
+                _fail_after_checkpoint(fake)
+                with pytest.raises(ConnectionResetError):
+                    drupebox.sync_all()
+            drupebox.sync_all(dry_run=command == "dry-run")
+    finally:
+        fake.save()
+
+
+if __name__ == "__main__":
+    _worker(*sys.argv[1:])
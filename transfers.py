@@ -0,0 +1,103 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from multiprocessing.synchronize import Semaphore
+from typing import TYPE_CHECKING, Callable, List, Optional, Tuple
+
+import config
+import log
+
+if TYPE_CHECKING:  # only for annotations, so the worker pool needs no Dropbox imports
+    from hash_cache import FileVersion
+    from remote_index import RemoteItem
+
+# each transfer returns the resulting remote file and its path, for its local time
+# to be fixed, and the version of the local file it read or wrote, for the time
+# to be left alone if the file has changed since; or None if there is nothing to
+# fix yet
+Transferred = Tuple["RemoteItem", str, "FileVersion"]
+TransferResult = Optional[Transferred]
+
+_executor = ThreadPoolExecutor(
+    max_workers=config.transfer_concurrency, thread_name_prefix="transfer"
+)
+
+_queued_transfers: List[Future] = []
+
+# slots for transfers, shared with the processes syncing other sync roots, if any
+_shared_slots: Optional[Semaphore] = None
+
+
+class Deferred(Exception):
+    """Raised by a large transfer stopped part way as the off-peak hours end, to carry on with later."""
+
+
+# whether any transfer was left for a later run, in the off-peak hours
+_deferred = False
+
+
+def waits_for_off_peak(size: int) -> bool:
+    """Checks if a transfer of this many bytes has to wait for the off-peak hours."""
+    return size >= config.off_peak_min_size and not config.large_transfers_allowed()
+
+
+def defer(remote_file_path: str):
+    """Records that a transfer is left for a later run, in the off-peak hours."""
+    global _deferred
+    log.note("Large file left for off-peak hours: " + remote_file_path)
+    _deferred = True
+
+
+def take_deferred() -> bool:
+    """Gets, and forgets, whether any transfer was left for a later run since last taken."""
+    global _deferred
+    deferred, _deferred = _deferred, False
+    return deferred
+
+
+def share_slots(slots: Semaphore):
+    """Runs each transfer in one of the slots shared by the processes of several sync roots."""
+    global _shared_slots
+    _shared_slots = slots
+
+
+def _run_in_slot(transfer: Callable[..., TransferResult], *args) -> TransferResult:
+    """Runs a transfer, waiting for a shared slot first if there are any."""
+    if _shared_slots is None:
+        return transfer(*args)
+    with _shared_slots:
+        return transfer(*args)
+
+
+def queue(transfer: Callable[..., TransferResult], *args):
+    """Queues a transfer to run on the worker pool."""
+    _queued_transfers.append(_executor.submit(_run_in_slot, transfer, *args))
+
+
+def take_finished(
+    timeout: Optional[float] = None,
+) -> Tuple[List[Transferred], Optional[BaseException]]:
+    """Takes the queued transfers that have finished, waiting up to timeout for all of them.
+
+    Returns:
+        The results of the transfers that completed, and the first error raised
+        by a transfer that failed, if any.
+    """
+    finished, _ = wait(_queued_transfers, timeout)
+    completed = []
+    first_error = None
+    unfinished = []
+    for transfer in _queued_transfers:
+        if transfer not in finished:
+            unfinished.append(transfer)
+        elif isinstance(transfer.exception(), Deferred):
+            defer(str(transfer.exception()))
+        elif transfer.exception() is not None:
+            first_error = first_error or transfer.exception()
+        elif transfer.result() is not None:
+            completed.append(transfer.result())
+    _queued_transfers[:] = unfinished
+    return completed, first_error
+
+
+def pending() -> bool:
+    """Checks if any queued transfer has not been taken as finished yet."""
+    return bool(_queued_transfers)
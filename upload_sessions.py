@@ -0,0 +1,40 @@
+from typing import Optional, Tuple
+
+import state_cache
+
+
+def resumable_session(
+    remote_file_path: str, size: int, mtime_ns: int
+) -> Optional[Tuple[str, int]]:
+    """Gets the session id and committed offset of an interrupted upload of the same file."""
+    with state_cache.transaction() as db:
+        session = db.execute(
+            "SELECT session_id, committed_offset, size, mtime_ns FROM upload_sessions "
+            "WHERE remote_file_path = ?",
+            (remote_file_path,),
+        ).fetchone()
+    if session is None or session[2:] != (size, mtime_ns):
+        return None  # local file has changed since, so the uploaded chunks are stale
+    return session[0], session[1]
+
+
+def store_session(
+    remote_file_path: str, session_id: str, offset: int, size: int, mtime_ns: int
+):
+    """Records how far an upload session has got, so it can be resumed next run."""
+    with state_cache.transaction() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO upload_sessions "
+            "(remote_file_path, session_id, committed_offset, size, mtime_ns) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (remote_file_path, session_id, offset, size, mtime_ns),
+        )
+
+
+def discard_session(remote_file_path: str):
+    """Forgets an upload session once it is finished or can no longer be used."""
+    with state_cache.transaction() as db:
+        db.execute(
+            "DELETE FROM upload_sessions WHERE remote_file_path = ?",
+            (remote_file_path,),
+        )
@@ -2,6 +2,7 @@ import os
 import sys
 import time
 from datetime import datetime, timezone
+from typing import Tuple
 
 is_windows = os.path.sep == "\\" and sys.platform == "win32"
 
@@ -16,6 +17,27 @@ def readable_time(unix_time: float) -> str:
     )
 
 
+def readable_size(size: int) -> str:
+    """Converts a number of bytes to a human-readable string."""
+    amount: float = size
+    unit = "B"
+    for larger_unit in ("KB", "MB", "GB", "TB"):
+        if amount < 1000:
+            break
+        amount /= 1000
+        unit = larger_unit
+    return f"{amount:.1f} {unit}" if unit != "B" else f"{size} {unit}"
+
+
+def within_hours(hours: Tuple[int, int], unix_time: float) -> bool:
+    """Checks if a time, in local time, is from the first hour of the day until the second."""
+    start, end = hours
+    hour = time.localtime(unix_time).tm_hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end  # hours that span midnight
+
+
 def is_server_connection_stale(t: float) -> bool:
     """Checks if the server connection is stale."""
     return time.time() > t + 60